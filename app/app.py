@@ -1,19 +1,21 @@
+import time
+START_TIME = time.perf_counter()
+import os
+import sys
+from importlib import import_module
+from collections import OrderedDict
+from multiprocessing import freeze_support
 from PyQt5 import QtGui, QtCore
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QHBoxLayout,
     QDesktopWidget, QFrame
 )
-import sys
-from collections import OrderedDict
-from multiprocessing import freeze_support
 from app.components.navbar import NavBar
-from app.components.dataset import Dataset
-from app.components.model import Model
-from app.components.flickr import Flickr
-from app.components.export import Export
-from app.components.visualize import Visualize
 from app import resource_path
 
+# set IMAGE_TOOLS_TIMING=1 (or pass --timing) to print how long startup takes
+TIMING = bool(os.getenv('IMAGE_TOOLS_TIMING')) or '--timing' in sys.argv
+
 
 try:
     # Include in try/except block if you're also targeting Mac/Linux
@@ -43,6 +45,11 @@ TEXT_MEDIUM = "rgb(70,70,70)"
 TEXT_LIGHT = "rgb(182,182,182)"
 
 
+def log_timing(event):
+    if TIMING:
+        print(f"[startup] {event}: {(time.perf_counter() - START_TIME) * 1000:.0f}ms")
+
+
 class Tabs:
     DATASET = 'Dataset'
     MODEL = 'Model'
@@ -51,6 +58,16 @@ class Tabs:
     VISUALIZE = 'Visualize'
 
 
+# the module and class for each page, which are only imported and built the first time they are shown
+PAGES = OrderedDict([
+    (Tabs.DATASET, ('app.components.dataset', 'Dataset')),
+    (Tabs.MODEL, ('app.components.model', 'Model')),
+    (Tabs.EXPORT, ('app.components.export', 'Export')),
+    (Tabs.FLICKR, ('app.components.flickr', 'Flickr')),
+    (Tabs.VISUALIZE, ('app.components.visualize', 'Visualize')),
+])
+
+
 class MainWindow(QMainWindow):
 
     def __init__(self, app, *args, **kwargs):
@@ -59,6 +76,7 @@ class MainWindow(QMainWindow):
         self.app = app
         self.nav = None
         self.pages = OrderedDict()
+        self.app_layout = None
         self.init_ui()
 
     def init_ui(self):
@@ -68,30 +86,19 @@ class MainWindow(QMainWindow):
         self.center()
 
         # our main app consists of two sections -- nav on left and content on right
-        app_layout = QHBoxLayout()
+        self.app_layout = QHBoxLayout()
 
-        self.pages = OrderedDict([
-            (Tabs.DATASET, Dataset(self.app)),
-            (Tabs.MODEL, Model(self.app)),
-            (Tabs.EXPORT, Export(self.app)),
-            (Tabs.FLICKR, Flickr(self.app)),
-            (Tabs.VISUALIZE, Visualize(self.app)),
-        ])
-
-        navbar = NavBar(self.nav_click, list(self.pages.keys()))
+        navbar = NavBar(self.nav_click, list(PAGES.keys()))
+        self.app_layout.addWidget(navbar)
+        self.app_layout.setContentsMargins(0, 0, 0, 0)
+        self.app_layout.setSpacing(0)
         # we are on the first page by default
-        self.nav_click(list(self.pages.keys())[0])
-
-        app_layout.addWidget(navbar)
-        for page in self.pages.values():
-            app_layout.addWidget(page)
-        app_layout.setContentsMargins(0, 0, 0, 0)
-        app_layout.setSpacing(0)
+        self.nav_click(list(PAGES.keys())[0])
 
         # bind our widget and show
         window = QFrame()
         window.setObjectName("window")
-        window.setLayout(app_layout)
+        window.setLayout(self.app_layout)
         self.setCentralWidget(window)
         self.show()
 
@@ -101,19 +108,34 @@ class MainWindow(QMainWindow):
         qr.moveCenter(cp)
         self.move(qr.topLeft())
 
+    def get_page(self, name: str):
+        # build the page the first time we navigate to it
+        if name not in self.pages:
+            module_name, class_name = PAGES[name]
+            page = getattr(import_module(module_name), class_name)(self.app)
+            self.pages[name] = page
+            self.app_layout.addWidget(page)
+            log_timing(f"built {name} page")
+        return self.pages[name]
+
     def nav_click(self, button: str):
         if button != self.nav:
-            for name, page in self.pages.items():
-                page.show() if button == name else page.hide()
+            page = self.get_page(button)
+            for name, other in self.pages.items():
+                if other is not page:
+                    other.hide()
+            page.show()
             self.nav = button
 
 
 if __name__ == '__main__':
     freeze_support()
+    log_timing("imports done")
     app = QApplication(sys.argv)
     app.setWindowIcon(QtGui.QIcon(resource_path('icon.ico')))
 
     w = MainWindow(app)
+    log_timing("window built")
     w.setStyleSheet(f"""
         QFrame#window {{
             background: {DARK_0};
@@ -195,4 +217,6 @@ if __name__ == '__main__':
             margin-top: 15px;
         }}
     """)
+    # the event loop picks this up once the window is on screen
+    QtCore.QTimer.singleShot(0, lambda: log_timing("window shown"))
     app.exec()
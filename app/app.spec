@@ -11,7 +11,9 @@ a = Analysis(['app.py'],
              pathex=[os.path.join(spec_path, '..')],
              binaries=[],
              datas=[('assets/icon.ico', '.')],
-             hiddenimports=['cmath'],
+             # the pages are imported by name when they are first shown
+             hiddenimports=['cmath', 'app.components.dataset', 'app.components.model', 'app.components.export',
+                            'app.components.flickr', 'app.components.visualize'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
@@ -1,21 +1,21 @@
-import os
 from PyQt5.QtWidgets import (QPushButton, QVBoxLayout, QHBoxLayout, QFrame, QLabel, QFileDialog, QMessageBox, QComboBox,
                              QProgressBar, QSizePolicy)
 from app.components.stretch_wrapper import NoStretch
-import pandas as pd
-from dataset.download_from_file import create_dataset
+from app.components.jobs import Job
 
 
 class Dataset(QFrame):
 	default_text = "<i>Please select a file.<\i>"
 	download_text = "Download"
 	downloading_text = "Downloading..."
+	cancel_text = "Cancel"
 
 	def __init__(self, app):
 		super().__init__()
 		# initialize our variables
 		self.app = app
 		self.file = None
+		self.job = None
 		self.init_ui()
 
 	def init_ui(self):
@@ -71,7 +71,10 @@ class Dataset(QFrame):
 		self.download_button = QPushButton(self.download_text)
 		self.download_button.setEnabled(False)
 		self.download_button.clicked.connect(self.download)
-		download_container = NoStretch(self.download_button)
+		self.cancel_button = QPushButton(self.cancel_text)
+		self.cancel_button.clicked.connect(self.cancel)
+		self.cancel_button.hide()
+		download_container = NoStretch([self.download_button, self.cancel_button])
 		download_container.setObjectName("separate")
 
 		self.progress_bar = QProgressBar()
@@ -93,7 +96,7 @@ class Dataset(QFrame):
 		self.setLayout(layout)
 
 	def select_file(self):
-		self.file = QFileDialog.getOpenFileName(self, 'Select CSV File', filter="CSV (*.csv *.xlsx)")[0]
+		self.file = QFileDialog.getOpenFileName(self, 'Select CSV File', filter="Tables (*.csv *.xlsx *.txt *.parquet *.arrow *.feather)")[0]
 		self.path_label.setText(f"<i>{self.file}</i>" if self.file else self.default_text)
 		self.parse_headers()
 
@@ -101,14 +104,14 @@ class Dataset(QFrame):
 		if self.file:
 			# read the file for its headers and set our dropdown boxes appropriately
 			try:
-				if os.path.splitext(self.file)[1] == ".csv":
-					csv = pd.read_csv(self.file, header=0)
-				else:
-					csv = pd.read_excel(self.file, header=0)
+				# only reads the header row, and the result is cached for when the job runs
+				# (imported here since pandas is slow to import)
+				from dataset.introspect import inspect_file
+				headers = inspect_file(self.file).headers
 				self.label_dropdown.clear()
 				self.url_dropdown.clear()
 				self.label_dropdown.addItem(None)
-				for header in list(csv.columns):
+				for header in headers:
 					self.url_dropdown.addItem(header)
 					self.label_dropdown.addItem(header)
 				self.url_dropdown.adjustSize()
@@ -141,24 +144,30 @@ class Dataset(QFrame):
 		if not destination_directory:
 			self.done()
 			return
-		# otherwise try downloading to the desired location
-		try:
-			create_dataset(
-				filepath=self.file, url_col=url_col, label_col=label_col if label_col else None,
-				progress_hook=self.progress_hook, destination_directory=destination_directory,
-			)
-		except Exception as e:
-			QMessageBox.about(self, "Alert", f"Error creating dataset: {e}")
-			self.done()
+		# otherwise start downloading to the desired location in the background
+		from dataset.download_from_file import create_dataset
+		self.job = Job(
+			create_dataset, filepath=self.file, url_col=url_col, label_col=label_col if label_col else None,
+			destination_directory=destination_directory,
+		)
+		self.job.signals.progress.connect(self.progress_hook)
+		self.job.signals.error.connect(lambda e: QMessageBox.about(self, "Alert", f"Error creating dataset: {e}"))
+		self.job.signals.finished.connect(self.done)
+		self.job.start()
+		self.cancel_button.setEnabled(True)
+		self.cancel_button.show()
 
 	def progress_hook(self, current, total):
 		self.progress_bar.setValue(float(current) / total * 100)
-		if current == total:
-			self.done()
-		# make sure to update the UI
-		self.app.processEvents()
+
+	def cancel(self):
+		if self.job:
+			self.job.cancel()
+		self.cancel_button.setEnabled(False)
 
 	def done(self):
+		self.job = None
+		self.cancel_button.hide()
 		self.progress_bar.setValue(0)
 		self.progress_bar.hide()
 		self.download_button.setEnabled(True)
@@ -2,17 +2,20 @@ import os
 from PyQt5.QtWidgets import (QPushButton, QVBoxLayout, QHBoxLayout, QFrame, QLabel, QFileDialog, QMessageBox,
                              QProgressBar, QComboBox, QSizePolicy)
 from app.components.stretch_wrapper import NoStretch
+from app.components.jobs import Job
 from dataset.export_from_lobe import get_projects, export_dataset
 
 
 class Export(QFrame):
 	export_text = "Export"
 	exporting_text = "Exporting..."
+	cancel_text = "Cancel"
 
 	def __init__(self, app):
 		super().__init__()
 		# initialize our variables
 		self.app = app
+		self.job = None
 		self.export_button = None
 		self.progress_bar = None
 		self.projects = get_projects()
@@ -48,7 +51,10 @@ class Export(QFrame):
 		self.export_button = QPushButton(self.export_text)
 		self.export_button.setEnabled(True)
 		self.export_button.clicked.connect(self.export)
-		export_container = NoStretch(self.export_button)
+		self.cancel_button = QPushButton(self.cancel_text)
+		self.cancel_button.clicked.connect(self.cancel)
+		self.cancel_button.hide()
+		export_container = NoStretch([self.export_button, self.cancel_button])
 		export_container.setObjectName("separate")
 
 		self.progress_bar = QProgressBar()
@@ -86,28 +92,33 @@ class Export(QFrame):
 		if not destination_directory:
 			self.done()
 			return
-		# otherwise try exporting to the desired location
-		try:
-			project_name, project_id = self.projects[self.project_dropdown.currentIndex()]
-			export_dir = os.path.join(destination_directory, project_name)
-			# rename the directory if there is a conflict
-			rename_idx = 1
-			while os.path.exists(export_dir):
-				export_dir = os.path.abspath(os.path.join(destination_directory, f"{project_name} ({rename_idx})"))
-				rename_idx += 1
-			export_dataset(project_id=project_id, destination_dir=export_dir, progress_hook=self.progress_hook)
-		except Exception as e:
-			QMessageBox.about(self, "Alert", f"Error exporting dataset: {e}")
-			self.done()
+		# otherwise start exporting to the desired location in the background
+		project_name, project_id = self.projects[self.project_dropdown.currentIndex()]
+		export_dir = os.path.join(destination_directory, project_name)
+		# rename the directory if there is a conflict
+		rename_idx = 1
+		while os.path.exists(export_dir):
+			export_dir = os.path.abspath(os.path.join(destination_directory, f"{project_name} ({rename_idx})"))
+			rename_idx += 1
+		self.job = Job(export_dataset, project_id=project_id, destination_dir=export_dir)
+		self.job.signals.progress.connect(self.progress_hook)
+		self.job.signals.error.connect(lambda e: QMessageBox.about(self, "Alert", f"Error exporting dataset: {e}"))
+		self.job.signals.finished.connect(self.done)
+		self.job.start()
+		self.cancel_button.setEnabled(True)
+		self.cancel_button.show()
 
 	def progress_hook(self, current, total):
 		self.progress_bar.setValue(float(current) / total * 100)
-		if current == total:
-			self.done()
-		# make sure to update the UI
-		self.app.processEvents()
+
+	def cancel(self):
+		if self.job:
+			self.job.cancel()
+		self.cancel_button.setEnabled(False)
 
 	def done(self):
+		self.job = None
+		self.cancel_button.hide()
 		self.progress_bar.setValue(0)
 		self.progress_bar.hide()
 		self.export_button.setEnabled(True)
@@ -2,17 +2,19 @@ import os
 from PyQt5.QtWidgets import (QPushButton, QVBoxLayout, QHBoxLayout, QFrame, QLabel, QFileDialog, QMessageBox,
                              QProgressBar, QLineEdit)
 from app.components.stretch_wrapper import NoStretch
-from dataset.download_from_flickr import download_flickr
+from app.components.jobs import Job
 
 
 class Flickr(QFrame):
 	download_text = "Download"
 	downloading_text = "Downloading..."
+	cancel_text = "Cancel"
 
 	def __init__(self, app):
 		super().__init__()
 		# initialize our variables
 		self.app = app
+		self.job = None
 		self.api_textbox = None
 		self.min_lat_textbox = None
 		self.min_long_textbox = None
@@ -75,7 +77,10 @@ class Flickr(QFrame):
 		self.download_button = QPushButton(self.download_text)
 		self.download_button.setEnabled(True)
 		self.download_button.clicked.connect(self.download)
-		download_container = NoStretch(self.download_button)
+		self.cancel_button = QPushButton(self.cancel_text)
+		self.cancel_button.clicked.connect(self.cancel)
+		self.cancel_button.hide()
+		download_container = NoStretch([self.download_button, self.cancel_button])
 		download_container.setObjectName("separate")
 
 		self.progress_bar = QProgressBar()
@@ -118,30 +123,36 @@ class Flickr(QFrame):
 		if not destination_directory:
 			self.done()
 			return
-		# otherwise try downloading to the desired location
-		try:
-			download_flickr(
-				api_key=self.api_textbox.text(),
-				directory=destination_directory,
-				min_lat=self.min_lat_textbox.text() or None,
-				min_long=self.min_long_textbox.text() or None,
-				max_lat=self.max_lat_textbox.text() or None,
-				max_long=self.max_long_textbox.text() or None,
-				search=self.search_textbox.text() or None,
-				progress_hook=self.progress_hook,
-			)
-		except Exception as e:
-			QMessageBox.about(self, "Alert", f"Error creating dataset: {e}")
-			self.done()
+		# otherwise start downloading to the desired location in the background
+		from dataset.download_from_flickr import download_flickr
+		self.job = Job(
+			download_flickr,
+			api_key=self.api_textbox.text(),
+			directory=destination_directory,
+			min_lat=self.min_lat_textbox.text() or None,
+			min_long=self.min_long_textbox.text() or None,
+			max_lat=self.max_lat_textbox.text() or None,
+			max_long=self.max_long_textbox.text() or None,
+			search=self.search_textbox.text() or None,
+		)
+		self.job.signals.progress.connect(self.progress_hook)
+		self.job.signals.error.connect(lambda e: QMessageBox.about(self, "Alert", f"Error creating dataset: {e}"))
+		self.job.signals.finished.connect(self.done)
+		self.job.start()
+		self.cancel_button.setEnabled(True)
+		self.cancel_button.show()
 
 	def progress_hook(self, current, total):
 		self.progress_bar.setValue(float(current) / total * 100)
-		if current == total:
-			self.done()
-		# make sure to update the UI
-		self.app.processEvents()
+
+	def cancel(self):
+		if self.job:
+			self.job.cancel()
+		self.cancel_button.setEnabled(False)
 
 	def done(self):
+		self.job = None
+		self.cancel_button.hide()
 		self.progress_bar.setValue(0)
 		self.progress_bar.hide()
 		self.download_button.setEnabled(True)
@@ -0,0 +1,50 @@
+from threading import Event
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from dataset.utils import JobCancelled
+
+# our own pool so long jobs from different tabs can all run at once
+_pool = QThreadPool()
+_pool.setMaxThreadCount(max(_pool.maxThreadCount(), 8))
+
+
+class JobSignals(QObject):
+	progress = pyqtSignal(int, int)
+	error = pyqtSignal(str)
+	cancelled = pyqtSignal()
+	finished = pyqtSignal()
+
+
+class Job(QRunnable):
+	"""
+	Run a long dataset or model function off of the UI thread. The function is called with progress_hook and cancel_event
+	keyword arguments, and reports back through the Qt signals in self.signals, which are delivered on the UI thread.
+	Connect to the signals before calling start().
+	"""
+
+	def __init__(self, fn, *args, **kwargs):
+		super().__init__()
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self.signals = JobSignals()
+		self.cancel_event = Event()
+		# we keep a reference to the job in the component, so Qt shouldn't delete it
+		self.setAutoDelete(False)
+
+	def run(self):
+		try:
+			self.fn(*self.args, progress_hook=self.signals.progress.emit, cancel_event=self.cancel_event, **self.kwargs)
+		except JobCancelled:
+			self.signals.cancelled.emit()
+		except Exception as e:
+			self.signals.error.emit(str(e))
+		finally:
+			self.signals.finished.emit()
+
+	def start(self):
+		_pool.start(self)
+		return self
+
+	def cancel(self):
+		# stop the job the next time it checks, dropping any work that hasn't started
+		self.cancel_event.set()
@@ -1,10 +1,8 @@
-import os
 from PyQt5.QtWidgets import (QPushButton, QVBoxLayout, QHBoxLayout, QFrame, QLabel, QFileDialog, QMessageBox, QComboBox,
                              QProgressBar, QSizePolicy)
 from app.components.stretch_wrapper import NoStretch
-import pandas as pd
-from model.predict_from_file import predict_dataset
-from model.predict_from_folder import predict_folder
+from app.components.jobs import Job
+from model.registry import preload
 
 
 class Model(QFrame):
@@ -12,11 +10,13 @@ class Model(QFrame):
 	default_file_text = "<i>Please select a folder of images or a csv of URLs.<\i>"
 	predict_text = "Predict"
 	predicting_text = "Predicting..."
+	cancel_text = "Cancel"
 
 	def __init__(self, app):
 		super().__init__()
 		# initialize our variables
 		self.app = app
+		self.job = None
 		self.tf_directory = None
 		self.file = None
 		self.folder = None
@@ -69,7 +69,10 @@ class Model(QFrame):
 		self.predict_button = QPushButton(self.predict_text)
 		self.predict_button.setEnabled(False)
 		self.predict_button.clicked.connect(self.predict)
-		predict_container = NoStretch(self.predict_button)
+		self.cancel_button = QPushButton(self.cancel_text)
+		self.cancel_button.clicked.connect(self.cancel)
+		self.cancel_button.hide()
+		predict_container = NoStretch([self.predict_button, self.cancel_button])
 		predict_container.setObjectName("separate")
 
 		self.progress_bar = QProgressBar()
@@ -96,10 +99,13 @@ class Model(QFrame):
 	def select_directory(self):
 		self.tf_directory = QFileDialog.getExistingDirectory(self, "Select TensorFlow Model Directory")
 		self.model_label.setText(f"<i>{self.tf_directory}</i>" if self.tf_directory else self.default_model_text)
+		if self.tf_directory:
+			# start loading the model while they pick their images
+			preload(self.tf_directory)
 		self.check_predict_button()
 
 	def select_file(self):
-		self.file = QFileDialog.getOpenFileName(self, 'Select CSV File', filter="CSV (*.csv *.xlsx)")[0]
+		self.file = QFileDialog.getOpenFileName(self, 'Select CSV File', filter="Tables (*.csv *.xlsx *.txt *.parquet *.arrow *.feather)")[0]
 		self.path_label.setText(f"<i>{self.file}</i>" if self.file else self.default_file_text)
 		self.folder = None
 		self.parse_headers()
@@ -123,12 +129,12 @@ class Model(QFrame):
 		if self.file:
 			# read the file for its headers and set our dropdown boxes appropriately
 			try:
-				if os.path.splitext(self.file)[1] == ".csv":
-					csv = pd.read_csv(self.file, header=0)
-				else:
-					csv = pd.read_excel(self.file, header=0)
+				# only reads the header row, and the result is cached for when the job runs
+				# (imported here since pandas is slow to import)
+				from dataset.introspect import inspect_file
+				headers = inspect_file(self.file).headers
 				self.url_dropdown.clear()
-				for header in list(csv.columns):
+				for header in headers:
 					self.url_dropdown.addItem(header)
 				self.url_dropdown.adjustSize()
 				self.url_label.show()
@@ -155,26 +161,34 @@ class Model(QFrame):
 		self.progress_bar.show()
 		self.app.processEvents()
 		url_col = self.url_dropdown.currentText()
-		try:
-			if self.file:
-				predict_dataset(model_dir=self.tf_directory, filepath=self.file, url_col=url_col,
-				                progress_hook=self.progress_hook)
-			elif self.folder:
-				predict_folder(model_dir=self.tf_directory, img_dir=self.folder, move=True, csv=True,
-				               progress_hook=self.progress_hook)
-		except Exception as e:
-			QMessageBox.about(self, "Alert", f"Error predicting: {e}")
-		finally:
+		# run the prediction in the background
+		from model.predict_from_file import predict_dataset
+		from model.predict_from_folder import predict_folder
+		if self.file:
+			self.job = Job(predict_dataset, model_dir=self.tf_directory, filepath=self.file, url_col=url_col)
+		elif self.folder:
+			self.job = Job(predict_folder, model_dir=self.tf_directory, img_dir=self.folder, move=True, csv=True)
+		else:
 			self.done()
+			return
+		self.job.signals.progress.connect(self.progress_hook)
+		self.job.signals.error.connect(lambda e: QMessageBox.about(self, "Alert", f"Error predicting: {e}"))
+		self.job.signals.finished.connect(self.done)
+		self.job.start()
+		self.cancel_button.setEnabled(True)
+		self.cancel_button.show()
 
 	def progress_hook(self, current, total):
 		self.progress_bar.setValue(float(current) / total * 100)
-		if current == total:
-			self.done()
-		# make sure to update the UI
-		self.app.processEvents()
+
+	def cancel(self):
+		if self.job:
+			self.job.cancel()
+		self.cancel_button.setEnabled(False)
 
 	def done(self):
+		self.job = None
+		self.cancel_button.hide()
 		self.progress_bar.setValue(0)
 		self.progress_bar.hide()
 		self.predict_button.setEnabled(True)
@@ -3,7 +3,7 @@ from PyQt5.QtGui import QPixmap
 from PIL.ImageQt import ImageQt
 from PIL import Image
 from app.components.stretch_wrapper import NoStretch
-from lobe import ImageModel
+from model.registry import get_model, preload
 
 
 class Visualize(QFrame):
@@ -78,6 +78,9 @@ class Visualize(QFrame):
 		self.tf_directory = QFileDialog.getExistingDirectory(self, "Select TensorFlow Model Directory")
 		self.model_label.setText(f"<i>{self.tf_directory}</i>" if self.tf_directory else self.default_model_text)
 		self.model = None
+		if self.tf_directory:
+			# start loading the model while they pick an image
+			preload(self.tf_directory)
 		self.visualize()
 
 	def select_file(self):
@@ -96,7 +99,7 @@ class Visualize(QFrame):
 			self.app.processEvents()
 			try:
 				if self.model is None:
-					self.model = ImageModel.load(self.tf_directory)
+					self.model = get_model(self.tf_directory)
 				self.image = Image.open(self.file)
 				prediction = self.model.predict(self.image).prediction
 				self.prediction_label.setText(f"Predicted label: {prediction}")
@@ -104,7 +107,6 @@ class Visualize(QFrame):
 				self.image_label.setPixmap(QPixmap.fromImage(ImageQt(viz)))
 			except Exception as e:
 				self.image = None
-				self.model = None
 				QMessageBox.about(self, "Alert", f"Error visualizing: {e}")
 			finally:
 				self.done()
@@ -0,0 +1,106 @@
+"""
+Benchmark decoding images for prediction at full resolution against the reduced-resolution decode in model.decode,
+on synthetic photos with EXIF orientation tags. Reports images/sec and milliseconds per image for decoding and for
+decoding plus the model's center crop and resize, peak memory, and how far the reduced decode's model input is from
+the full decode's.
+
+python -m benchmarks.bench_decode --sizes 1024x768 4000x3000 --images 50
+"""
+import argparse
+import os
+import tempfile
+import time
+from benchmarks.common import run_isolated, save_results, print_results, synthetic_image, peak_rss_mb
+from model.decode import center_crop_resize
+
+CASES = ('full', 'reduced')
+FORMATS = {'jpg': 'JPEG', 'png': 'PNG'}
+# upright, and the two tags phones write for portrait photos
+ORIENTATIONS = (1, 6, 8)
+
+
+def size_arg(value):
+	# argparse type for WIDTHxHEIGHT, or a single number for a square
+	width, _, height = value.lower().partition('x')
+	return int(width), int(height or width)
+
+
+def make_images(directory, images, size, ext):
+	paths = []
+	for i in range(images):
+		path = os.path.join(directory, f"img{i}.{ext}")
+		with open(path, 'wb') as f:
+			f.write(synthetic_image(f"decode:{i}", size, format=FORMATS[ext], orientation=ORIENTATIONS[i % len(ORIENTATIONS)]))
+		paths.append(path)
+	return paths
+
+
+def _pixel_difference(a, b):
+	# mean absolute difference per channel, 0-255
+	from PIL import ImageChops, ImageStat
+	return sum(ImageStat.Stat(ImageChops.difference(a, b)).mean) / 3
+
+
+def bench_decode(paths, reduce, input_size):
+	from model.decode import open_image
+	decode_seconds = preprocess_seconds = 0.0
+	for path in paths:
+		start = time.perf_counter()
+		image = open_image(path, size=input_size, reduce=reduce)
+		decoded = time.perf_counter()
+		center_crop_resize(image, input_size)
+		decode_seconds += decoded - start
+		preprocess_seconds += time.perf_counter() - decoded
+	seconds = decode_seconds + preprocess_seconds
+	result = {
+		'images': len(paths), 'images_per_sec': len(paths) / seconds,
+		'decode_ms': decode_seconds / len(paths) * 1000, 'decode_and_resize_ms': seconds / len(paths) * 1000,
+		'peak_rss_mb': peak_rss_mb(),
+	}
+	if reduce:
+		# compare the model input against a full decode, outside the timing
+		differences = [
+			_pixel_difference(
+				center_crop_resize(open_image(path, size=input_size, reduce=True), input_size),
+				center_crop_resize(open_image(path, size=input_size, reduce=False), input_size),
+			)
+			for path in paths[:10]
+		]
+		result['mean_pixel_diff'] = sum(differences) / len(differences)
+	return result
+
+
+def run(sizes, images, formats, input_size, out_file=None):
+	"""
+	Time full and reduced decoding of every size and format, and save the results.
+
+	:param sizes: the list of (width, height) image sizes to try.
+	:param images: the number of images of each size.
+	:param formats: the image formats to try, from FORMATS.
+	:param input_size: the (width, height) model input size to decode for.
+	:param out_file: an optional path for the results json.
+	"""
+	results = []
+	for ext in formats:
+		for size in sizes:
+			with tempfile.TemporaryDirectory() as tmp_dir:
+				paths = make_images(tmp_dir, images, size, ext)
+				for case in CASES:
+					metrics = run_isolated(bench_decode, paths, case == 'reduced', input_size)
+					result = {'case': case, 'params': {'format': ext, 'size': f"{size[0]}x{size[1]}"}, 'metrics': metrics}
+					print_results([result])
+					results.append(result)
+	config = {'images': images, 'input_size': list(input_size)}
+	save_results('decode', config, results, out_file=out_file)
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark full against reduced-resolution image decoding.')
+	parser.add_argument('--sizes', nargs='+', type=size_arg, default=[(1024, 768), (4000, 3000)], help='Image sizes as WIDTHxHEIGHT.')
+	parser.add_argument('--images', type=int, default=30, help='Number of images of each size.')
+	parser.add_argument('--formats', nargs='+', choices=FORMATS, default=['jpg'], help='Formats of the synthetic images.')
+	parser.add_argument('--input-size', type=size_arg, default=(224, 224), help='The model input size as WIDTHxHEIGHT.')
+	parser.add_argument('--out', help='Path to write the results json to.')
+	args = parser.parse_args()
+	run(sizes=args.sizes, images=args.images, formats=args.formats, input_size=args.input_size, out_file=args.out)
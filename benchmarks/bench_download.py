@@ -0,0 +1,137 @@
+"""
+Benchmark download_image, create_dataset, and download_flickr against the local stand-in server, across
+concurrency settings. Each case runs in its own process, so peak memory is measured per case.
+
+python -m benchmarks.bench_download --images 500 --concurrency 1 8 32 --latency 0.05
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from benchmarks.common import latency_metrics, run_isolated, save_results, print_results
+from benchmarks.server import StandInServer
+
+CASES = ('download_image', 'create_dataset', 'download_flickr')
+
+
+def _count_images(directory):
+	return sum(
+		1 for _, _, files in os.walk(directory) for name in files if name.endswith('.jpg')
+	)
+
+
+def bench_download_image(urls, workers):
+	# call download_image directly so we can time every request from the client side
+	from dataset.utils import download_image
+	lock = Lock()
+	with tempfile.TemporaryDirectory() as tmp_dir:
+
+		def timed(url):
+			start = time.perf_counter()
+			filename = download_image(url=url, directory=tmp_dir, lock=lock)
+			return time.perf_counter() - start, filename
+
+		start = time.perf_counter()
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			results = list(executor.map(timed, urls))
+		seconds = time.perf_counter() - start
+	images = sum(1 for _, filename in results if filename)
+	return {
+		'images': images,
+		'errors': len(urls) - images,
+		'seconds': seconds,
+		'images_per_sec': images / seconds,
+		**latency_metrics([latency for latency, _ in results]),
+	}
+
+
+def bench_create_dataset(urls, workers):
+	from dataset.download_from_file import create_dataset
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		url_file = os.path.join(tmp_dir, 'urls.csv')
+		with open(url_file, 'w', encoding='utf-8') as f:
+			f.write('url\n')
+			f.writelines(f"{url}\n" for url in urls)
+		start = time.perf_counter()
+		create_dataset(url_file, url_col='url', destination_directory=tmp_dir, workers=workers)
+		seconds = time.perf_counter() - start
+		images = _count_images(os.path.join(tmp_dir, 'urls'))
+	return {'images': images, 'errors': len(urls) - images, 'seconds': seconds, 'images_per_sec': images / seconds}
+
+
+def bench_download_flickr(rest_url, img_url_template, workers):
+	from dataset.download_from_flickr import download_flickr
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		start = time.perf_counter()
+		download_flickr(
+			api_key='benchmark', directory=tmp_dir, search='benchmark',
+			base_url=rest_url, img_url_template=img_url_template, workers=workers,
+		)
+		seconds = time.perf_counter() - start
+		images = _count_images(tmp_dir)
+	return {'images': images, 'seconds': seconds, 'images_per_sec': images / seconds}
+
+
+def run(cases, concurrency, images, server_options, out_file=None):
+	"""
+	Run every case at every concurrency against a stand-in server, and save the results.
+
+	:param cases: the names of the cases to run, from CASES.
+	:param concurrency: the list of worker thread counts to try.
+	:param images: the number of image urls (or Flickr photos) to download in each case.
+	:param server_options: a dict of StandInServer options for latency, bandwidth, and failures.
+	:param out_file: an optional path for the results json.
+	"""
+	results = []
+	with StandInServer(flickr_photos=images, **server_options) as server:
+		urls = [server.image_url(i) for i in range(images)]
+		for case in cases:
+			for workers in concurrency:
+				server.reset_stats()
+				if case == 'download_image':
+					metrics = run_isolated(bench_download_image, urls, workers)
+				elif case == 'create_dataset':
+					metrics = run_isolated(bench_create_dataset, urls, workers)
+				else:
+					metrics = run_isolated(
+						bench_download_flickr, server.flickr_rest_url, server.flickr_image_template, workers
+					)
+				# the server's view of every request, including api calls and failures
+				server_latency = latency_metrics(server.latencies)
+				metrics['server_p50_ms'] = server_latency['p50_ms']
+				metrics['server_p99_ms'] = server_latency['p99_ms']
+				metrics['requests'] = len(server.latencies)
+				result = {'case': case, 'params': {'workers': workers}, 'metrics': metrics}
+				print_results([result])
+				results.append(result)
+	config = {'images': images, **server_options}
+	save_results('download', config, results, out_file=out_file)
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the downloaders against a local stand-in server.')
+	parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES), help='The cases to run.')
+	parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32], help='Worker thread counts to try.')
+	parser.add_argument('--images', type=int, default=500, help='Number of images to download in each case.')
+	parser.add_argument('--latency', type=float, default=0.02, help='Seconds the server waits before each response.')
+	parser.add_argument('--bandwidth', type=float, help='Bytes per second for each response body.')
+	parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of image urls that fail with a 500.')
+	parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of image urls that answer with a 429.')
+	parser.add_argument('--redirect-rate', type=float, default=0.0, help='Fraction of image urls that redirect once.')
+	parser.add_argument('--unique-images', type=int, default=100, help='Number of distinct images, the rest are duplicates.')
+	parser.add_argument('--flickr-duplicate-rate', type=float, default=0.0, help='Fraction of Flickr results that repeat.')
+	parser.add_argument('--image-size', type=int, default=256, help='Width and height of the served images.')
+	parser.add_argument('--out', help='Path to write the results json to.')
+	args = parser.parse_args()
+	run(
+		cases=args.cases, concurrency=args.concurrency, images=args.images, out_file=args.out,
+		server_options={
+			'latency': args.latency, 'bandwidth': args.bandwidth, 'error_rate': args.error_rate,
+			'throttle_rate': args.throttle_rate, 'redirect_rate': args.redirect_rate,
+			'unique_images': args.unique_images, 'flickr_duplicate_rate': args.flickr_duplicate_rate,
+			'image_size': args.image_size,
+		},
+	)
@@ -0,0 +1,70 @@
+"""
+Benchmark export_dataset on synthetic Lobe projects of increasing size, reporting examples/sec and peak memory.
+
+python -m benchmarks.bench_export --examples 10000 100000 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from benchmarks.common import run_isolated, save_results, print_results
+from benchmarks.lobe_project import make_project
+from dataset.export_from_lobe import get_projects
+
+
+def bench_export(projects_dir, project_id, examples, batch_size):
+	from dataset.export_from_lobe import export_dataset
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		start = time.perf_counter()
+		export_dataset(project_id, tmp_dir, batch_size=batch_size, projects_dir=projects_dir)
+		seconds = time.perf_counter() - start
+		exported = sum(len(files) for _, _, files in os.walk(tmp_dir))
+	return {
+		'examples': exported, 'errors': examples - exported, 'seconds': seconds, 'examples_per_sec': exported / seconds,
+	}
+
+
+def run(scales, batch_size, image_size, labels, projects_dir=None, out_file=None):
+	"""
+	Generate a project for every scale and time exporting it, and save the results.
+
+	:param scales: the list of project sizes in examples.
+	:param batch_size: the export_dataset batch size.
+	:param image_size: the width and height of the synthetic images.
+	:param labels: the number of distinct labels.
+	:param projects_dir: an optional directory to generate the projects in, which is kept so later runs can reuse them.
+		By default they go in a temporary directory.
+	:param out_file: an optional path for the results json.
+	"""
+	results = []
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		projects_dir = os.path.abspath(projects_dir or tmp_dir)
+		existing = dict(get_projects(projects_dir))
+		for examples in scales:
+			name = f"synthetic-{examples}-{labels}-{image_size}"
+			project_id = existing.get(name)
+			if not project_id:
+				print(f"Generating {name}...")
+				project_id = make_project(projects_dir, name, examples, labels=labels, image_size=image_size)
+			metrics = run_isolated(bench_export, projects_dir, project_id, examples, batch_size)
+			result = {'case': 'export_dataset', 'params': {'examples': examples}, 'metrics': metrics}
+			print_results([result])
+			results.append(result)
+	config = {'batch_size': batch_size, 'image_size': image_size, 'labels': labels}
+	save_results('export', config, results, out_file=out_file)
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark exporting synthetic Lobe projects.')
+	parser.add_argument('--examples', nargs='+', type=int, default=[10000, 100000], help='Project sizes to try.')
+	parser.add_argument('--batch-size', type=int, default=1000, help='Rows read from the project db at a time.')
+	parser.add_argument('--image-size', type=int, default=64, help='Width and height of the images.')
+	parser.add_argument('--labels', type=int, default=10, help='Number of distinct labels.')
+	parser.add_argument('--projects-dir', help='Generate the projects here instead of a temporary directory.')
+	parser.add_argument('--out', help='Path to write the results json to.')
+	args = parser.parse_args()
+	run(
+		scales=args.examples, batch_size=args.batch_size, image_size=args.image_size, labels=args.labels,
+		projects_dir=args.projects_dir, out_file=args.out,
+	)
@@ -0,0 +1,163 @@
+"""
+Benchmark predict_folder and predict_dataset with the stub model (or a real Lobe export) on a synthetic image
+corpus, across worker settings. Reports images/sec and peak memory, and the download, decode, inference, write, and
+organize time per image from the per-stage metrics. The predict_folder_cached case times a second run over the folder
+with the tensor cache filled by a first, untimed run.
+
+python -m benchmarks.bench_predict --images 500 --sizes 256 1024 --formats jpg png --workers 0 1 2 4
+"""
+import argparse
+import os
+import tempfile
+import time
+from benchmarks.common import run_isolated, save_results, print_results, synthetic_image
+from benchmarks.server import StandInServer
+from benchmarks.stub_model import StubModel
+
+CASES = ('predict_folder', 'predict_folder_cached', 'predict_dataset')
+FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'bmp': 'BMP'}
+
+
+def make_corpus(directory, images, sizes=(256,), formats=('jpg',), seed=0):
+	"""
+	Write a folder of synthetic noise images, cycling through the given sizes and formats, spread over a few
+	subdirectories like a real dataset.
+	"""
+	for i in range(images):
+		size = sizes[i % len(sizes)]
+		ext = formats[(i // len(sizes)) % len(formats)]
+		sub_dir = os.path.join(directory, f"dir{i % 10}")
+		os.makedirs(sub_dir, exist_ok=True)
+		with open(os.path.join(sub_dir, f"img{i}.{ext}"), 'wb') as f:
+			f.write(synthetic_image(f"{seed}:{i}", size, format=FORMATS[ext]))
+	return directory
+
+
+STAGES = ('download', 'decode', 'inference', 'write', 'organize')
+
+
+def _stage_metrics(metrics_dir, model, images):
+	# milliseconds per image in each stage -- these add up the time of every worker, so they are work, not wall time
+	from dataset import metrics
+	# stop recording before the temporary metrics directory is removed
+	metrics.disable()
+	stages, _ = metrics.summarize_events(metrics_dir)
+	per_image = {}
+	for stage in STAGES:
+		if stage in stages:
+			per_image[f"{stage}_ms"] = stages[stage]['sum'] / images * 1000 if images else None
+	if isinstance(model, StubModel):
+		# the stub's center crop and resize, which is part of inference
+		per_image['preprocess_ms'] = model.stage_totals()['preprocess'] / images * 1000 if images else None
+	return per_image
+
+
+def bench_predict_folder(corpus_dir, model, processes, tensor_cache=False):
+	from dataset import metrics
+	from model.predict_from_folder import predict_folder
+	from model.organize import apply_plan, read_plan
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		# predict a copy of the corpus made of hardlinks, so every run starts from the same folder
+		img_dir = os.path.join(tmp_dir, 'images')
+		for root, _, files in os.walk(corpus_dir):
+			dest_dir = os.path.join(img_dir, os.path.relpath(root, corpus_dir))
+			os.makedirs(dest_dir, exist_ok=True)
+			for name in files:
+				os.link(os.path.join(root, name), os.path.join(dest_dir, name))
+		if tensor_cache:
+			# fill the cache, so the timed run below is a repeat run
+			predict_folder(img_dir, model, move=False, csv=False, processes=processes, tensor_cache=True)
+		if isinstance(model, StubModel):
+			model.reset()
+		metrics_dir = os.path.join(tmp_dir, 'metrics')
+		metrics.enable(metrics_dir)
+		start = time.perf_counter()
+		predict_folder(img_dir, model, move=False, csv=True, processes=processes, tensor_cache=tensor_cache)
+		seconds = time.perf_counter() - start
+		# place the images into their label folders, the same way predict_folder does when it organizes
+		plan_file = os.path.join(img_dir, 'predictions.csv')
+		images = sum(1 for _ in read_plan(plan_file))
+		apply_plan(plan_file, os.path.join(tmp_dir, 'organized'), mode='hardlink')
+		stages = _stage_metrics(metrics_dir, model, images)
+	return {'images': images, 'seconds': seconds, 'images_per_sec': images / seconds, **stages}
+
+
+def bench_predict_dataset(urls, model, processes):
+	from dataset import metrics
+	from model.predict_from_file import predict_dataset
+	if isinstance(model, StubModel):
+		model.reset()
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		metrics_dir = os.path.join(tmp_dir, 'metrics')
+		metrics.enable(metrics_dir)
+		url_file = os.path.join(tmp_dir, 'urls.csv')
+		with open(url_file, 'w', encoding='utf-8') as f:
+			f.write('url\n')
+			f.writelines(f"{url}\n" for url in urls)
+		start = time.perf_counter()
+		predict_dataset(url_file, model, url_col='url', processes=processes)
+		seconds = time.perf_counter() - start
+		stages = _stage_metrics(metrics_dir, model, len(urls))
+	return {'images': len(urls), 'seconds': seconds, 'images_per_sec': len(urls) / seconds, **stages}
+
+
+def run(cases, workers, images, sizes, formats, model, out_file=None):
+	"""
+	Run every case at every worker setting, and save the results.
+
+	:param cases: the names of the cases to run, from CASES.
+	:param workers: the list of worker process counts to try, where 0 is one model shared by a thread pool.
+	:param images: the number of images to predict in each case.
+	:param sizes: the image sizes for the synthetic corpus.
+	:param formats: the image formats for the synthetic corpus.
+	:param model: a StubModel, or the path to a real Lobe export.
+	:param out_file: an optional path for the results json.
+	"""
+	results = []
+	with tempfile.TemporaryDirectory() as corpus_dir:
+		make_corpus(corpus_dir, images, sizes=sizes, formats=formats)
+		with StandInServer(image_size=max(sizes)) as server:
+			urls = [server.image_url(i) for i in range(images)]
+			for case in cases:
+				for processes in workers:
+					if case in ('predict_folder', 'predict_folder_cached'):
+						metrics = run_isolated(
+							bench_predict_folder, corpus_dir, model, processes or None,
+							tensor_cache=case == 'predict_folder_cached',
+						)
+					else:
+						metrics = run_isolated(bench_predict_dataset, urls, model, processes or None)
+					result = {'case': case, 'params': {'processes': processes}, 'metrics': metrics}
+					print_results([result])
+					results.append(result)
+	config = {
+		'images': images, 'sizes': list(sizes), 'formats': list(formats),
+		'model': model if isinstance(model, str) else {
+			'stub': True, 'inference_seconds': model.inference_seconds, 'call_seconds': model.call_seconds,
+			'spin': model.spin,
+		},
+	}
+	save_results('predict', config, results, out_file=out_file)
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the prediction entry points with a stub model.')
+	parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES), help='The cases to run.')
+	parser.add_argument('--workers', nargs='+', type=int, default=[0, 1, 2], help='Worker processes to try, 0 for threads.')
+	parser.add_argument('--images', type=int, default=300, help='Number of images to predict in each case.')
+	parser.add_argument('--sizes', nargs='+', type=int, default=[256, 1024], help='Sizes of the synthetic images.')
+	parser.add_argument('--formats', nargs='+', choices=FORMATS, default=['jpg'], help='Formats of the synthetic images.')
+	parser.add_argument('--inference-ms', type=float, default=5.0, help='Stub model cost per image in milliseconds.')
+	parser.add_argument('--call-ms', type=float, default=0.0, help='Stub model fixed cost per predict call in milliseconds.')
+	parser.add_argument('--spin', action='store_true', help='Make the stub model hold the GIL during inference.')
+	parser.add_argument('--model-dir', help='Benchmark a real Lobe export instead of the stub model.')
+	parser.add_argument('--out', help='Path to write the results json to.')
+	args = parser.parse_args()
+	run(
+		cases=args.cases, workers=args.workers, images=args.images, sizes=args.sizes, formats=args.formats,
+		model=args.model_dir or StubModel(
+			inference_seconds=args.inference_ms / 1000, call_seconds=args.call_ms / 1000, spin=args.spin,
+		),
+		out_file=args.out,
+	)
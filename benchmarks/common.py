@@ -0,0 +1,154 @@
+"""
+Shared helpers for the benchmarks: running a case in its own process so its peak memory is its own,
+latency percentiles, and saving results as json to compare between commits.
+"""
+import io
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import traceback
+from multiprocessing import get_context
+
+RESULTS_DIR = 'benchmark_results'
+
+
+def synthetic_image(key, size, format='JPEG', orientation=None):
+	"""
+	Return the bytes of a size x size image -- noise over a solid color picked from key, so each key looks
+	different and the image compresses like a photo instead of a flat color.
+
+	:param size: the width and height, or a (width, height) tuple.
+	:param orientation: an optional EXIF orientation tag to save with the image.
+	"""
+	from PIL import Image
+	size = (size, size) if isinstance(size, int) else tuple(size)
+	rng = random.Random(key)
+	color = Image.new('RGB', size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+	noise = Image.effect_noise(size, 64).convert('RGB')
+	buffer = io.BytesIO()
+	image = Image.blend(color, noise, 0.3)
+	if orientation:
+		exif = Image.Exif()
+		exif[0x0112] = orientation
+		image.save(buffer, format=format, exif=exif)
+	else:
+		image.save(buffer, format=format)
+	return buffer.getvalue()
+
+
+def percentile(values, pct):
+	# nearest rank percentile, or None if there are no values
+	if not values:
+		return None
+	values = sorted(values)
+	rank = max(math.ceil(pct / 100 * len(values)) - 1, 0)
+	return values[min(rank, len(values) - 1)]
+
+
+def latency_metrics(seconds):
+	# p50 and p99 in milliseconds from a list of durations in seconds
+	p50, p99 = percentile(seconds, 50), percentile(seconds, 99)
+	return {
+		'p50_ms': p50 * 1000 if p50 is not None else None,
+		'p99_ms': p99 * 1000 if p99 is not None else None,
+	}
+
+
+def peak_rss_mb():
+	# the peak resident memory of this process, or None where the resource module isn't available (Windows)
+	try:
+		# on linux ru_maxrss carries over from the parent through fork and exec, but the high water mark doesn't
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1]) / 1024
+	except OSError:
+		pass
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# linux reports kilobytes, mac reports bytes
+	return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_child(queue, fn, args, kwargs):
+	try:
+		metrics = fn(*args, **kwargs)
+		# a case can measure its own peak before any checks it doesn't want counted
+		metrics.setdefault('peak_rss_mb', peak_rss_mb())
+		queue.put((True, metrics))
+	except BaseException:
+		queue.put((False, traceback.format_exc()))
+
+
+def run_isolated(fn, *args, **kwargs):
+	"""
+	Run fn(*args, **kwargs) in a fresh process and return its dict of metrics with the process's peak_rss_mb added.
+	fn must be importable from the top level of a module.
+	"""
+	ctx = get_context('spawn')
+	queue = ctx.Queue()
+	process = ctx.Process(target=_run_child, args=(queue, fn, args, kwargs))
+	process.start()
+	ok, result = queue.get()
+	process.join()
+	if not ok:
+		raise RuntimeError(f"Benchmark case failed:\n{result}")
+	return result
+
+
+def git_commit():
+	try:
+		return subprocess.run(
+			['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+		).stdout.strip()
+	except Exception:
+		return None
+
+
+def save_results(benchmark, config, results, out_file=None):
+	"""
+	Write a benchmark run to json, along with the commit and machine it ran on.
+
+	:param benchmark: the name of the benchmark.
+	:param config: a dict of the settings shared by every case.
+	:param results: a list of {'case': name, 'params': {...}, 'metrics': {...}} dicts.
+	:param out_file: an optional path to write to, defaults to benchmark_results/<benchmark>-<commit>.json.
+	:return: the path written to.
+	"""
+	commit = git_commit()
+	if not out_file:
+		os.makedirs(RESULTS_DIR, exist_ok=True)
+		out_file = os.path.join(RESULTS_DIR, f"{benchmark}-{(commit or 'unknown')[:8]}.json")
+	run = {
+		'benchmark': benchmark,
+		'commit': commit,
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'config': config,
+		'results': results,
+	}
+	with open(out_file, 'w', encoding='utf-8') as f:
+		json.dump(run, f, indent=2)
+	print(f"Saved results to {out_file}")
+	return out_file
+
+
+def print_results(results):
+	for result in results:
+		params = ' '.join(f"{key}={value}" for key, value in result['params'].items())
+		metrics = ' | '.join(
+			f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}"
+			for key, value in result['metrics'].items()
+		)
+		print(f"{result['case']} {params} | {metrics}")
@@ -0,0 +1,68 @@
+"""
+Compare two benchmark result files, for example from before and after a change.
+"""
+import argparse
+import json
+
+# metric name endings where a bigger number is better (rates), and where a smaller one is (times, memory). Anything
+# else, like the images or errors counted, describes the workload and is shown without being judged
+HIGHER_IS_BETTER = ('_per_sec', 'hit_rate')
+LOWER_IS_BETTER = ('seconds', '_ms', '_mb')
+
+
+def _direction(metric):
+	# 1 if a bigger value is better, -1 if a smaller one is, or 0 if the metric isn't judged
+	if metric.endswith(HIGHER_IS_BETTER):
+		return 1
+	if metric.endswith(LOWER_IS_BETTER):
+		return -1
+	return 0
+
+
+def _key(result):
+	return result['case'], tuple(sorted(result['params'].items()))
+
+
+def compare(old_file, new_file, threshold=0.05):
+	"""
+	Print the change in every metric between two result files, flagging changes for the worse over threshold. Only
+	rates, times, and memory are flagged.
+	:return: the number of regressions.
+	"""
+	with open(old_file, encoding='utf-8') as f:
+		old = json.load(f)
+	with open(new_file, encoding='utf-8') as f:
+		new = json.load(f)
+	print(f"{old['benchmark']}: {(old['commit'] or 'unknown')[:8]} -> {(new['commit'] or 'unknown')[:8]}")
+	old_results = {_key(result): result['metrics'] for result in old['results']}
+	regressions = 0
+	for result in new['results']:
+		case, params = _key(result)
+		old_metrics = old_results.get((case, params))
+		label = f"{case} {' '.join(f'{key}={value}' for key, value in params)}"
+		if old_metrics is None:
+			print(f"{label}: new case")
+			continue
+		for metric, value in result['metrics'].items():
+			before = old_metrics.get(metric)
+			if not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or not before:
+				continue
+			change = (value - before) / before
+			worse = -change * _direction(metric)
+			flag = ''
+			if worse > threshold:
+				regressions += 1
+				flag = ' REGRESSION'
+			print(f"{label} {metric}: {before:.2f} -> {value:.2f} ({change:+.1%}){flag}")
+	return regressions
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+	parser.add_argument('old', help='The baseline results json.')
+	parser.add_argument('new', help='The results json to compare against the baseline.')
+	parser.add_argument('--threshold', type=float, default=0.05, help='Fraction a metric can get worse before it is flagged.')
+	args = parser.parse_args()
+	count = compare(args.old, args.new, threshold=args.threshold)
+	if count:
+		raise SystemExit(f"{count} metrics regressed.")
@@ -0,0 +1,108 @@
+"""
+Generate synthetic Lobe projects with the same layout export_from_lobe reads: a project.json, a db.sqlite with the
+example_images and example_labels tables, and image blobs named by their hash.
+
+python -m benchmarks.lobe_project path/to/projects --examples 10000 --labels 10
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import uuid
+from benchmarks.common import synthetic_image
+from dataset.export_from_lobe import PROJECT_JSON_FILE, PROJECT_DB_FILE, PROJECT_BLOBS
+
+SCHEMA = """
+CREATE TABLE example_images (example_id TEXT PRIMARY KEY, hash TEXT NOT NULL);
+CREATE TABLE example_labels (example_id TEXT PRIMARY KEY, label TEXT);
+"""
+INSERT_ROWS = 10000
+
+
+def make_project(
+		projects_dir, name, examples, labels=10, unlabeled_rate=0.0, image_size=64, unique_images=100, seed=0
+):
+	"""
+	Write a synthetic project to projects_dir and return its id.
+
+	:param projects_dir: the projects directory to create the project in.
+	:param name: the project name.
+	:param examples: the number of images in the project.
+	:param labels: the number of distinct labels.
+	:param unlabeled_rate: the fraction of images without a label.
+	:param image_size: the width and height of the images in pixels.
+	:param unique_images: the number of distinct images to render -- every example gets its own blob, but blobs with
+		the same image are hardlinked to each other where possible, to save time and disk space at large scales.
+	:param seed: the seed for labels and images.
+	"""
+	project_id = str(uuid.UUID(int=random.Random(f"{seed}:{name}").getrandbits(128)))
+	# project directory doesn't include the '-' from the project uuid
+	project_dir = os.path.join(projects_dir, project_id.replace('-', ''))
+	blob_dir = os.path.join(project_dir, PROJECT_BLOBS)
+	os.makedirs(blob_dir, exist_ok=True)
+	with open(os.path.join(project_dir, PROJECT_JSON_FILE), 'w') as f:
+		json.dump({'id': project_id, 'meta': {'name': name}}, f)
+
+	# render the distinct images once, and link every example's blob to one of them
+	templates = []
+	for i in range(min(unique_images, examples)):
+		template = os.path.join(project_dir, f"template{i}.jpg")
+		with open(template, 'wb') as f:
+			f.write(synthetic_image(f"{seed}:{i}", image_size))
+		templates.append(template)
+
+	rng = random.Random(seed)
+	db_file = os.path.join(project_dir, PROJECT_DB_FILE)
+	if os.path.exists(db_file):
+		os.remove(db_file)
+	conn = sqlite3.connect(db_file)
+	try:
+		conn.executescript(SCHEMA)
+		images, example_labels = [], []
+		for i in range(examples):
+			example_id = uuid.UUID(int=rng.getrandbits(128)).hex
+			blob_hash = f"{rng.getrandbits(160):040x}"
+			_link_or_copy(templates[i % len(templates)], os.path.join(blob_dir, blob_hash))
+			images.append((example_id, blob_hash))
+			if rng.random() >= unlabeled_rate:
+				example_labels.append((example_id, f"label{rng.randrange(labels)}"))
+			if len(images) >= INSERT_ROWS:
+				_insert(conn, images, example_labels)
+				images, example_labels = [], []
+		_insert(conn, images, example_labels)
+	finally:
+		conn.close()
+	for template in templates:
+		os.remove(template)
+	return project_id
+
+
+def _insert(conn, images, example_labels):
+	with conn:
+		conn.executemany("INSERT INTO example_images (example_id, hash) VALUES (?, ?)", images)
+		conn.executemany("INSERT INTO example_labels (example_id, label) VALUES (?, ?)", example_labels)
+
+
+def _link_or_copy(src, dest):
+	try:
+		os.link(src, dest)
+	except OSError:
+		with open(src, 'rb') as src_f, open(dest, 'wb') as dest_f:
+			dest_f.write(src_f.read())
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate a synthetic Lobe project.')
+	parser.add_argument('projects_dir', help='The projects directory to create the project in.')
+	parser.add_argument('--name', default='Synthetic', help='The project name.')
+	parser.add_argument('--examples', type=int, default=10000, help='Number of images in the project.')
+	parser.add_argument('--labels', type=int, default=10, help='Number of distinct labels.')
+	parser.add_argument('--unlabeled-rate', type=float, default=0.0, help='Fraction of images without a label.')
+	parser.add_argument('--image-size', type=int, default=64, help='Width and height of the images.')
+	args = parser.parse_args()
+	new_id = make_project(
+		os.path.abspath(args.projects_dir), args.name, args.examples, labels=args.labels,
+		unlabeled_rate=args.unlabeled_rate, image_size=args.image_size,
+	)
+	print(f"Created project {args.name} ({new_id}) in {args.projects_dir}")
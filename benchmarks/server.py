@@ -0,0 +1,230 @@
+"""
+A local HTTP stand-in for the image hosts and the Flickr REST api, so the downloaders can be benchmarked without
+the internet. Images are synthetic jpegs, and the latency, bandwidth, and failures are configurable.
+"""
+import argparse
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+from benchmarks.common import synthetic_image
+
+CHUNK_BYTES = 16 * 1024
+IMAGE_PATH = re.compile(r'^/images/(\d+)\.jpg$')
+FLICKR_IMAGE_PATH = re.compile(r'^/flickr/\w+/(\d+)_\w+_\w+\.jpg$')
+
+
+class StandInServer:
+	"""
+	Serve synthetic images at /images/<n>.jpg and a fake Flickr REST api at /services/rest/ on a background thread.
+	Faults are chosen from a hash of the path, so the same url behaves the same way on every run.
+
+	:param port: the port to listen on, or 0 for any free port.
+	:param latency: seconds to wait before answering each request.
+	:param bandwidth: an optional limit in bytes per second for each response body.
+	:param error_rate: the fraction of image urls that answer with a 500.
+	:param throttle_rate: the fraction of image urls that answer with a 429 and a Retry-After header.
+	:param redirect_rate: the fraction of image urls that redirect once before serving the image.
+	:param unique_images: the number of distinct images to serve -- image n has the same content as image n % unique_images.
+	:param image_size: the width and height of the images in pixels.
+	:param flickr_photos: the number of photos the fake Flickr search finds.
+	:param flickr_duplicate_rate: the fraction of Flickr search results that repeat a photo from an earlier result.
+	:param seed: the seed for choosing faults and duplicates.
+	"""
+
+	def __init__(
+			self, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, error_rate=0.0, throttle_rate=0.0,
+			redirect_rate=0.0, unique_images=100, image_size=256, flickr_photos=1000, flickr_duplicate_rate=0.0, seed=0
+	):
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.error_rate = error_rate
+		self.throttle_rate = throttle_rate
+		self.redirect_rate = redirect_rate
+		self.unique_images = max(unique_images, 1)
+		self.image_size = image_size
+		self.flickr_photos = flickr_photos
+		self.flickr_duplicate_rate = flickr_duplicate_rate
+		self.seed = seed
+		self.latencies = []
+		self.status_counts = {}
+		self._images = {}
+		self._lock = Lock()
+		self.httpd = ThreadingHTTPServer((host, port), _Handler)
+		self.httpd.daemon_threads = True
+		self.httpd.stand_in = self
+		self._thread = None
+
+	@property
+	def url(self):
+		host, port = self.httpd.server_address[:2]
+		return f"http://{host}:{port}"
+
+	def image_url(self, index):
+		return f"{self.url}/images/{index}.jpg"
+
+	@property
+	def flickr_rest_url(self):
+		return f"{self.url}/services/rest/"
+
+	@property
+	def flickr_image_template(self):
+		# the same fields as the real flickr static image urls
+		return self.url + "/flickr/{server_id}/{photo_id}_{secret}_{size}.jpg"
+
+	def start(self):
+		self._thread = Thread(target=self.httpd.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+
+	def reset_stats(self):
+		with self._lock:
+			self.latencies = []
+			self.status_counts = {}
+
+	def record(self, status, seconds):
+		with self._lock:
+			self.latencies.append(seconds)
+			self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+	def fault(self, path):
+		# one of None, 'error', 'throttle', or 'redirect' for this path
+		roll = random.Random(f"{self.seed}:{path}").random()
+		for fault, rate in (('error', self.error_rate), ('throttle', self.throttle_rate), ('redirect', self.redirect_rate)):
+			if roll < rate:
+				return fault
+			roll -= rate
+		return None
+
+	def image_bytes(self, index):
+		key = index % self.unique_images
+		with self._lock:
+			data = self._images.get(key)
+		if data is None:
+			data = synthetic_image(key, self.image_size)
+			with self._lock:
+				self._images[key] = data
+		return data
+
+	def flickr_photo_ids(self):
+		# the photo ids in search order, with some results repeating an earlier photo
+		rng = random.Random(self.seed)
+		ids = []
+		for i in range(self.flickr_photos):
+			if ids and rng.random() < self.flickr_duplicate_rate:
+				ids.append(rng.choice(ids))
+			else:
+				ids.append(i)
+		return ids
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		# keep the benchmark output clean
+		pass
+
+	def do_GET(self):
+		stand_in = self.server.stand_in
+		start = time.perf_counter()
+		if stand_in.latency:
+			time.sleep(stand_in.latency)
+		url = urlsplit(self.path)
+		query = parse_qs(url.query)
+		try:
+			if url.path == '/services/rest/':
+				status = self._flickr(stand_in, {key: values[0] for key, values in query.items()})
+			else:
+				status = self._image(stand_in, url.path, redirected='redirected' in query)
+		except (BrokenPipeError, ConnectionResetError):
+			status = 'disconnected'
+		stand_in.record(status, time.perf_counter() - start)
+
+	def _image(self, stand_in, path, redirected):
+		match = IMAGE_PATH.match(path) or FLICKR_IMAGE_PATH.match(path)
+		if not match:
+			return self._send(404, b'')
+		fault = None if redirected else stand_in.fault(path)
+		if fault == 'error':
+			return self._send(500, b'')
+		if fault == 'throttle':
+			return self._send(429, b'', headers={'Retry-After': '1'})
+		if fault == 'redirect':
+			return self._send(302, b'', headers={'Location': f"{path}?redirected=1"})
+		return self._send(200, stand_in.image_bytes(int(match.group(1))), content_type='image/jpeg')
+
+	def _flickr(self, stand_in, params):
+		method = params.get('method')
+		photo_id = escape(params.get('photo_id', ''), {'"': '&quot;'})
+		if method == 'flickr.photos.search':
+			ids = stand_in.flickr_photo_ids()
+			per_page = int(params.get('per_page', 100))
+			page = int(params.get('page', 1))
+			pages = max((len(ids) + per_page - 1) // per_page, 1)
+			photos = ''.join(
+				f'<photo id="{i}" owner="{i}@N00" secret="s{i}" server="{i % 10}" farm="1" title="photo {i}"/>'
+				for i in ids[(page - 1) * per_page:page * per_page]
+			)
+			body = f'<photos page="{page}" pages="{pages}" perpage="{per_page}" total="{len(ids)}">{photos}</photos>'
+		elif method == 'flickr.photos.geo.getLocation':
+			body = f'<photo id="{photo_id}"><location latitude="47.6" longitude="-122.3" accuracy="16"/></photo>'
+		elif method == 'flickr.photos.getInfo':
+			body = (
+				f'<photo id="{photo_id}"><owner nsid="{photo_id}@N00"/><title>photo {photo_id}</title>'
+				f'<dates taken="2020-01-01 00:00:00"/></photo>'
+			)
+		else:
+			body = '<err code="112" msg="Method not found"/>'
+		return self._send(200, f'<?xml version="1.0" encoding="utf-8" ?><rsp stat="ok">{body}</rsp>'.encode('utf-8'), content_type='text/xml')
+
+	def _send(self, status, body, content_type='application/octet-stream', headers=None):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.end_headers()
+		bandwidth = self.server.stand_in.bandwidth
+		if not bandwidth:
+			self.wfile.write(body)
+			return status
+		# trickle the body out at the configured rate
+		for i in range(0, len(body), CHUNK_BYTES):
+			chunk = body[i:i + CHUNK_BYTES]
+			self.wfile.write(chunk)
+			time.sleep(len(chunk) / bandwidth)
+		return status
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run the local stand-in image and Flickr server.')
+	parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+	parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each response.')
+	parser.add_argument('--bandwidth', type=float, help='Bytes per second for each response body.')
+	parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of image urls that fail with a 500.')
+	parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of image urls that answer with a 429.')
+	parser.add_argument('--redirect-rate', type=float, default=0.0, help='Fraction of image urls that redirect once.')
+	args = parser.parse_args()
+	server = StandInServer(
+		port=args.port, latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+		throttle_rate=args.throttle_rate, redirect_rate=args.redirect_rate,
+	)
+	print(f"Serving images at {server.image_url(0)} and the Flickr api at {server.flickr_rest_url}")
+	try:
+		server.httpd.serve_forever()
+	except KeyboardInterrupt:
+		server.stop()
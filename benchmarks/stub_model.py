@@ -0,0 +1,117 @@
+"""
+A deterministic stand-in for lobe's ImageModel, so the prediction entry points can be benchmarked without a
+SavedModel or TensorFlow. It decodes and preprocesses images the same way, then spends a configurable amount of
+time on "inference" and predicts a label from a hash of the pixels.
+"""
+import hashlib
+import io
+import time
+from multiprocessing import get_context
+from model.decode import center_crop_resize
+
+STAGES = ('decode', 'preprocess', 'inference')
+
+
+class StubSignature:
+	def __init__(self, labels, input_image_size):
+		self.classes = list(labels)
+		self.input_image_size = tuple(input_image_size)
+
+
+class StubResult:
+	def __init__(self, labels):
+		# (label, confidence) pairs from most to least confident, like lobe's PredictionResult
+		self.labels = labels
+		self.prediction = labels[0][0]
+
+
+class StubModel:
+	"""
+	Has the predict, predict_from_file, and predict_from_url methods and the signature of a lobe ImageModel.
+	Time spent in each stage is added up in shared memory, so it is still counted when the model is copied to
+	worker processes.
+
+	:param labels: the labels to predict.
+	:param inference_seconds: the cost of predicting each image.
+	:param call_seconds: an extra fixed cost for every call to predict, however many images it is given.
+	:param spin: a flag for whether inference busy-waits, holding the GIL like pure python work. By default it sleeps,
+		releasing the GIL like TensorFlow does.
+	:param input_image_size: the (width, height) images are resized to.
+	"""
+
+	def __init__(self, labels=('cat', 'dog', 'bird'), inference_seconds=0.005, call_seconds=0.0, spin=False, input_image_size=(224, 224)):
+		self.signature = StubSignature(labels, input_image_size)
+		self.inference_seconds = inference_seconds
+		self.call_seconds = call_seconds
+		self.spin = spin
+		# seconds per stage and the number of images predicted
+		self._totals = get_context('spawn').Array('d', len(STAGES) + 1)
+
+	def _add(self, stage, seconds, images=0):
+		with self._totals.get_lock():
+			self._totals[STAGES.index(stage)] += seconds
+			self._totals[len(STAGES)] += images
+
+	def stage_totals(self):
+		"""
+		Return the total seconds spent in each stage and the number of images predicted.
+		"""
+		with self._totals.get_lock():
+			totals = list(self._totals)
+		return {**dict(zip(STAGES, totals)), 'images': int(totals[len(STAGES)])}
+
+	def reset(self):
+		with self._totals.get_lock():
+			for i in range(len(self._totals)):
+				self._totals[i] = 0
+
+	def _wait(self, seconds):
+		if not seconds:
+			return
+		if not self.spin:
+			time.sleep(seconds)
+			return
+		end = time.perf_counter() + seconds
+		while time.perf_counter() < end:
+			pass
+
+	def predict_from_file(self, path):
+		from PIL import Image
+		start = time.perf_counter()
+		image = Image.open(path)
+		image.load()
+		self._add('decode', time.perf_counter() - start)
+		return self.predict(image)
+
+	def predict_from_url(self, url):
+		import requests
+		from PIL import Image
+		start = time.perf_counter()
+		response = requests.get(url, timeout=30)
+		response.raise_for_status()
+		image = Image.open(io.BytesIO(response.content))
+		image.load()
+		self._add('decode', time.perf_counter() - start)
+		return self.predict(image)
+
+	def predict(self, image):
+		"""
+		Predict one PIL image, or a list of them -- the results are a list then too.
+		"""
+		images = image if isinstance(image, list) else [image]
+		start = time.perf_counter()
+		pixels = [center_crop_resize(img, self.signature.input_image_size).tobytes() for img in images]
+		self._add('preprocess', time.perf_counter() - start)
+		start = time.perf_counter()
+		self._wait(self.call_seconds + self.inference_seconds * len(images))
+		results = [self._result(data) for data in pixels]
+		self._add('inference', time.perf_counter() - start, images=len(images))
+		return results if isinstance(image, list) else results[0]
+
+	def _result(self, data):
+		digest = hashlib.md5(data).digest()
+		labels = self.signature.classes
+		top = digest[0] % len(labels)
+		confidence = 0.5 + digest[1] / 510
+		rest = [(label, (1 - confidence) / max(len(labels) - 1, 1)) for i, label in enumerate(labels) if i != top]
+		return StubResult([(labels[top], confidence), *rest])
@@ -0,0 +1,399 @@
+"""
+A persistent catalog of a dataset folder, kept in a SQLite file in the folder, so counts, label distributions,
+predictions, and diffs between datasets are queries instead of a walk of the whole tree. Each image is recorded with
+its path relative to the folder, label, size, modification time, dimensions, SHA-1 of its bytes, the URL it was
+downloaded from, and the predictions of every model that has been run on it.
+
+The download and export jobs update the catalog as they write files when asked to, and prediction updates a folder
+that has one. A folder changed by hand is brought up to date with sync(), which only hashes the files whose size or
+modification time changed.
+
+python -m dataset.catalog DIR [--sync] [--diff OTHER_DIR]
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+from threading import Lock
+from dataset.utils import walk_images, image_label, read_fanout
+from dataset import metrics
+
+CATALOG_FILE = 'catalog.sqlite'
+SCHEMA_VERSION = 1
+# pending writes are committed together once there are this many
+FLUSH_ROWS = 500
+HASH_BLOCK = 1 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+	path TEXT PRIMARY KEY,
+	label TEXT,
+	size INTEGER,
+	mtime_ns INTEGER,
+	width INTEGER,
+	height INTEGER,
+	sha1 TEXT,
+	source_url TEXT,
+	added REAL
+);
+CREATE INDEX IF NOT EXISTS images_label ON images (label);
+CREATE INDEX IF NOT EXISTS images_sha1 ON images (sha1);
+CREATE TABLE IF NOT EXISTS predictions (
+	path TEXT NOT NULL,
+	model TEXT NOT NULL,
+	label TEXT,
+	confidence REAL,
+	predicted REAL,
+	PRIMARY KEY (path, model)
+);
+CREATE TABLE IF NOT EXISTS errors (
+	source_url TEXT,
+	label TEXT,
+	error TEXT,
+	time REAL
+);
+"""
+
+_UPSERT_IMAGE = """
+INSERT INTO images (path, label, size, mtime_ns, width, height, sha1, source_url, added)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (path) DO UPDATE SET
+	label = excluded.label, size = excluded.size, mtime_ns = excluded.mtime_ns, width = excluded.width,
+	height = excluded.height, sha1 = excluded.sha1, source_url = COALESCE(excluded.source_url, images.source_url)
+"""
+# a predicted image the catalog doesn't know yet gets a row without its metadata, which sync() fills in
+_INSERT_UNKNOWN = "INSERT INTO images (path, label, added) VALUES (?, ?, ?) ON CONFLICT (path) DO NOTHING"
+_UPSERT_PREDICTION = "INSERT OR REPLACE INTO predictions (path, model, label, confidence, predicted) VALUES (?, ?, ?, ?, ?)"
+_INSERT_ERROR = "INSERT INTO errors (source_url, label, error, time) VALUES (?, ?, ?, ?)"
+_DELETE_IMAGE = "DELETE FROM images WHERE path = ?"
+_DELETE_PREDICTIONS = "DELETE FROM predictions WHERE path = ?"
+_MOVE_IMAGE = "UPDATE images SET path = ?, label = ? WHERE path = ?"
+_MOVE_PREDICTIONS = "UPDATE predictions SET path = ? WHERE path = ?"
+_COPY_IMAGE = """
+INSERT OR REPLACE INTO images (path, label, size, mtime_ns, width, height, sha1, source_url, added)
+SELECT ?, ?, size, mtime_ns, width, height, sha1, source_url, added FROM images WHERE path = ?
+"""
+_COPY_PREDICTIONS = """
+INSERT OR REPLACE INTO predictions (path, model, label, confidence, predicted)
+SELECT ?, model, label, confidence, predicted FROM predictions WHERE path = ?
+"""
+
+
+def catalog_file(root):
+	return os.path.join(root, CATALOG_FILE)
+
+
+def has_catalog(root):
+	return os.path.isfile(catalog_file(root))
+
+
+def describe_file(path):
+	"""
+	Return the (size, mtime in ns, width, height, sha1) of an image file. The dimensions are read from the image
+	header without decoding it, and are None if it can't be opened.
+	"""
+	from PIL import Image
+	stat = os.stat(path)
+	digest = hashlib.sha1()
+	with metrics.timer('catalog_hash'):
+		with open(path, 'rb') as f:
+			for block in iter(lambda: f.read(HASH_BLOCK), b''):
+				digest.update(block)
+	try:
+		with Image.open(path) as image:
+			width, height = image.size
+	except Exception:
+		width, height = None, None
+	return stat.st_size, stat.st_mtime_ns, width, height, digest.hexdigest()
+
+
+class Catalog:
+	"""
+	The catalog of one dataset folder. It is safe to use from several threads: the file metadata is read in the
+	calling thread, and the writes are queued in order and committed in batches on one connection. Several processes
+	on one machine can update the same catalog, but SQLite's WAL mode isn't safe on a network filesystem, so the
+	sharded prediction runs, which may be on several machines, leave it alone.
+
+	:param root: the dataset folder, which the catalog file is kept in.
+	"""
+
+	def __init__(self, root):
+		self.root = os.path.abspath(root)
+		os.makedirs(self.root, exist_ok=True)
+		self._lock = Lock()
+		self._pending = []
+		# the folder's fan-out, to read the labels of the images in it from their paths
+		self.fanout = read_fanout(self.root)
+		# the catalog is shared with the job's worker threads, so every use of the connection holds the lock
+		self._conn = sqlite3.connect(catalog_file(self.root), timeout=30, check_same_thread=False)
+		self._conn.execute("PRAGMA journal_mode=WAL")
+		self._conn.execute("PRAGMA synchronous=NORMAL")
+		with self._conn:
+			self._conn.executescript(SCHEMA)
+			self._conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+	def key(self, path):
+		"""
+		The catalog's name for a file: its path relative to the dataset folder, with / separators.
+		"""
+		return os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/')
+
+	def _queue(self, *writes):
+		with self._lock:
+			self._pending.extend(writes)
+			if len(self._pending) >= FLUSH_ROWS:
+				self._flush()
+
+	def _flush(self):
+		if not self._pending:
+			return
+		with metrics.timer('catalog_write'):
+			with self._conn:
+				# consecutive writes of the same kind go in one executemany, in the order they were queued
+				for sql, writes in groupby(self._pending, key=itemgetter(0)):
+					self._conn.executemany(sql, [params for _, params in writes])
+		self._pending = []
+		# the folder's fan-out, to read the labels of the images in it from their paths
+		self.fanout = read_fanout(self.root)
+
+	def flush(self):
+		"""
+		Commit the queued writes.
+		"""
+		with self._lock:
+			self._flush()
+
+	def close(self):
+		with self._lock:
+			self._flush()
+			self._conn.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def add_file(self, path, label=None, source_url=None):
+		"""
+		Record a new or changed image file, reading its size, dimensions, and hash.
+
+		:param path: the path to the image, inside the dataset folder.
+		:param label: the image's label, defaults to the folder it is in.
+		:param source_url: an optional URL the image came from. An existing URL is kept when this is None.
+		"""
+		key = self.key(path)
+		try:
+			size, mtime, width, height, sha1 = describe_file(path)
+		except OSError as e:
+			print(f"Problem adding {path} to the catalog: {e}")
+			return
+		if label is None:
+			label = image_label(key, self.fanout)
+		self._queue((_UPSERT_IMAGE, (key, label, size, mtime, width, height, sha1, source_url, time.time())))
+
+	def add_error(self, source_url, label=None, error=None):
+		"""
+		Record an image that couldn't be downloaded or exported.
+		"""
+		self._queue((_INSERT_ERROR, (source_url, label, error, time.time())))
+
+	def add_predictions(self, path, models, prediction):
+		"""
+		Record the predictions of an image.
+
+		:param path: the path to the image, inside the dataset folder.
+		:param models: the name of each model, from model.registry.model_names.
+		:param prediction: a list of (label, confidence) with one for each model. Models that failed on the image,
+			with a label of None, are skipped.
+		"""
+		key = self.key(path)
+		now = time.time()
+		self._queue(
+			(_INSERT_UNKNOWN, (key, image_label(key, self.fanout), now)),
+			*(
+				(_UPSERT_PREDICTION, (key, model, label, confidence, now))
+				for model, (label, confidence) in zip(models, prediction) if label is not None
+			),
+		)
+
+	def move(self, src, dest, label=None, copy=False):
+		"""
+		Record that an image was moved, or with copy, hardlinked or symlinked, to dest. Its predictions go with it.
+
+		:param label: the label of dest, defaults to the folder it is in.
+		"""
+		src, dest = self.key(src), self.key(dest)
+		if label is None:
+			label = image_label(dest, self.fanout)
+		writes = [(_DELETE_IMAGE, (dest,)), (_DELETE_PREDICTIONS, (dest,))]
+		if copy:
+			writes += [(_COPY_IMAGE, (dest, label, src)), (_COPY_PREDICTIONS, (dest, src))]
+		else:
+			writes += [(_MOVE_IMAGE, (dest, label, src)), (_MOVE_PREDICTIONS, (dest, src))]
+		self._queue(*writes)
+
+	def remove(self, path):
+		"""
+		Record that an image was deleted.
+		"""
+		key = self.key(path)
+		self._queue((_DELETE_IMAGE, (key,)), (_DELETE_PREDICTIONS, (key,)))
+
+	def query(self, sql, params=()):
+		"""
+		Run a query against the catalog after committing the queued writes, and return the rows.
+		"""
+		with self._lock:
+			self._flush()
+			return self._conn.execute(sql, params).fetchall()
+
+	def count(self, label=None):
+		"""
+		Return the number of images, or the number with a label.
+		"""
+		if label is None:
+			return self.query("SELECT count(*) FROM images")[0][0]
+		return self.query("SELECT count(*) FROM images WHERE label = ?", (label,))[0][0]
+
+	def labels(self):
+		"""
+		Return the (label, images) distribution, largest first. Images in the root folder have a label of None.
+		"""
+		return self.query("SELECT label, count(*) AS n FROM images GROUP BY label ORDER BY n DESC, label")
+
+	def error_count(self):
+		return self.query("SELECT count(*) FROM errors")[0][0]
+
+	def prediction_summary(self):
+		"""
+		Return (model, predicted label, images, mean confidence, images whose folder label agrees) for each model and
+		label it predicted.
+		"""
+		return self.query(
+			"""
+			SELECT p.model, p.label, count(*), avg(p.confidence), sum(p.label = i.label)
+			FROM predictions p JOIN images i ON p.path = i.path
+			GROUP BY p.model, p.label
+			ORDER BY p.model, count(*) DESC
+			"""
+		)
+
+	def diff(self, other_root):
+		"""
+		Compare this dataset with another catalogued one by image contents, so renamed and moved files match.
+
+		:param other_root: the other dataset folder.
+		:return: a dict of 'added' (path, label) images only in this dataset, 'removed' (path, label) images only in
+			the other one, and 'relabeled' (path, other label, label) images whose label differs.
+		"""
+		other_file = catalog_file(os.path.abspath(other_root))
+		if not os.path.isfile(other_file):
+			raise ValueError(f"{other_root} doesn't have a catalog.")
+		with self._lock:
+			self._flush()
+			self._conn.execute("ATTACH DATABASE ? AS other", (other_file,))
+			try:
+				return {
+					'added': self._conn.execute(
+						"SELECT path, label FROM images WHERE sha1 IS NOT NULL AND sha1 NOT IN "
+						"(SELECT sha1 FROM other.images WHERE sha1 IS NOT NULL) ORDER BY path"
+					).fetchall(),
+					'removed': self._conn.execute(
+						"SELECT path, label FROM other.images WHERE sha1 IS NOT NULL AND sha1 NOT IN "
+						"(SELECT sha1 FROM main.images WHERE sha1 IS NOT NULL) ORDER BY path"
+					).fetchall(),
+					'relabeled': self._conn.execute(
+						"SELECT DISTINCT a.path, b.label, a.label FROM main.images a JOIN other.images b ON a.sha1 = b.sha1 "
+						"WHERE a.label IS NOT b.label ORDER BY a.path"
+					).fetchall(),
+				}
+			finally:
+				self._conn.execute("DETACH DATABASE other")
+
+	def sync(self, workers=None, cancel_event=None):
+		"""
+		Bring the catalog up to date with the folder: hash the new and changed images, found by their size and
+		modification time, and forget the ones that are gone. Returns the number of images (added, removed).
+
+		:param workers: an optional number of threads to hash the images with.
+		:param cancel_event: an optional threading.Event that skips the remaining images when set.
+		"""
+		known = {
+			path: (size, mtime) for path, size, mtime, sha1 in
+			self.query("SELECT path, size, mtime_ns, sha1 FROM images") if sha1 is not None
+		}
+		found = set()
+		changed = []
+		for path in walk_images(self.root):
+			key = self.key(path)
+			found.add(key)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			if known.get(key) != (stat.st_size, stat.st_mtime_ns):
+				changed.append(path)
+
+		def add(path):
+			if cancel_event is None or not cancel_event.is_set():
+				self.add_file(path)
+
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='catalog') as executor:
+			list(executor.map(add, changed))
+		gone = [path for path, in self.query("SELECT path FROM images") if path not in found]
+		for path in gone:
+			self.remove(path)
+		self.flush()
+		return len(changed), len(gone)
+
+
+def open_catalog(root, enabled=True):
+	"""
+	Return the Catalog of a dataset folder for a job to update, or None: enabled can be True to create the catalog
+	if needed, None to only update a catalog the folder already has, or False.
+	"""
+	if enabled or (enabled is None and has_catalog(root)):
+		return Catalog(root)
+	return None
+
+
+def print_summary(catalog):
+	print(f"{catalog.count()} images in {catalog.root}")
+	for label, images in catalog.labels():
+		print(f"  {label if label is not None else '(no label)'}: {images}")
+	errors = catalog.error_count()
+	if errors:
+		print(f"{errors} failed downloads or exports")
+	summary = catalog.prediction_summary()
+	if summary:
+		print("Predictions:")
+		for model, label, images, confidence, agree in summary:
+			print(f"  {model} {label}: {images} images, mean confidence {confidence:.3f}, {agree or 0} agree with their folder")
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Show or update the catalog of a dataset folder.')
+	parser.add_argument('dir', help='Path to your dataset folder.')
+	parser.add_argument('--sync', action='store_true', help='Bring the catalog up to date with the files in the folder.')
+	parser.add_argument('--diff', metavar='OTHER_DIR', help='Compare with the catalog of another dataset folder.')
+	args = parser.parse_args()
+	# a mistyped folder would otherwise be created with an empty catalog
+	if not os.path.isdir(args.dir):
+		parser.error(f"{args.dir} isn't a directory.")
+	with Catalog(args.dir) as catalog:
+		if args.sync:
+			added, removed = catalog.sync()
+			print(f"Synced the catalog: {added} new or changed images, {removed} removed.")
+		print_summary(catalog)
+		if args.diff:
+			changes = catalog.diff(args.diff)
+			print(f"Compared with {os.path.abspath(args.diff)}:")
+			for name in ('added', 'removed', 'relabeled'):
+				print(f"  {len(changes[name])} {name}")
+				for row in changes[name][:10]:
+					print(f"    {' | '.join(str(value) for value in row)}")
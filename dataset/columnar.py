@@ -0,0 +1,197 @@
+"""
+Parquet and Arrow IPC support for the url files, and the cached parquet copies of csv and xlsx inputs.
+These need pyarrow, which is only imported when one of them is used.
+"""
+import os
+from itertools import islice
+from math import isnan
+
+PARQUET_EXTENSIONS = ['.parquet']
+ARROW_EXTENSIONS = ['.arrow', '.feather']
+COLUMNAR_EXTENSIONS = PARQUET_EXTENSIONS + ARROW_EXTENSIONS
+# parquet metadata key on a cached copy recording the size and modification time of the file it came from
+SOURCE_KEY = b'image_tools_source'
+
+
+def require_pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.ipc
+		import pyarrow.parquet
+	except ImportError:
+		raise ImportError("Parquet and Arrow files need pyarrow. Install it with `pip install pyarrow`.")
+	return pyarrow
+
+
+def is_columnar(filepath):
+	return os.path.splitext(filepath)[1].lower() in COLUMNAR_EXTENSIONS
+
+
+def _is_parquet(filepath):
+	return os.path.splitext(filepath)[1].lower() in PARQUET_EXTENSIONS
+
+
+def _open_arrow(filepath):
+	# memory map the ipc file, so reading a batch doesn't copy it
+	pa = require_pyarrow()
+	return pa.ipc.open_file(pa.memory_map(filepath, 'r'))
+
+
+def read_headers(filepath):
+	"""
+	Return the column names of a parquet or arrow file from its schema.
+	"""
+	pa = require_pyarrow()
+	if _is_parquet(filepath):
+		return list(pa.parquet.read_schema(filepath).names)
+	return list(_open_arrow(filepath).schema.names)
+
+
+def count_rows(filepath):
+	"""
+	Return the number of rows in a parquet or arrow file from its metadata, without reading any data.
+	"""
+	pa = require_pyarrow()
+	if _is_parquet(filepath):
+		return pa.parquet.ParquetFile(filepath).metadata.num_rows
+	reader = _open_arrow(filepath)
+	return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+
+def _batch_rows(batch, columns):
+	# the rows of a record batch as tuples, with just the given column indexes
+	columns = range(batch.num_columns) if columns is None else columns
+	return zip(*[batch.column(i).to_pylist() for i in columns])
+
+
+def iter_rows(filepath, columns=None, chunksize=None):
+	"""
+	Stream the rows of a parquet or arrow file as tuples. Parquet is read a batch at a time with only the
+	requested columns, so the other columns are never loaded.
+
+	:param filepath: path to a parquet or arrow ipc file.
+	:param columns: an optional list of column indexes to read -- each tuple then has just those values, in that order.
+	:param chunksize: the number of rows to read at a time.
+	"""
+	pa = require_pyarrow()
+	if _is_parquet(filepath):
+		parquet_file = pa.parquet.ParquetFile(filepath)
+		names = parquet_file.schema_arrow.names
+		kwargs = {'batch_size': chunksize} if chunksize else {}
+		if columns is None:
+			batches = parquet_file.iter_batches(**kwargs)
+		else:
+			batches = parquet_file.iter_batches(columns=[names[i] for i in columns], **kwargs)
+			columns = None
+		for batch in batches:
+			yield from _batch_rows(batch, columns)
+		return
+	reader = _open_arrow(filepath)
+	for i in range(reader.num_record_batches):
+		yield from _batch_rows(reader.get_batch(i), columns)
+
+
+def _to_string(value):
+	if value is None or (isinstance(value, float) and isnan(value)):
+		return None
+	return str(value)
+
+
+class ParquetRowWriter:
+	"""
+	Write rows to a parquet file with the same writerow interface as a csv writer, buffering them into row groups.
+	Every column is a nullable string, except the given float columns.
+	"""
+
+	def __init__(self, filepath, names, float_columns=(), metadata=None, row_group_size=10000):
+		pa = require_pyarrow()
+		self.pa = pa
+		fields = [pa.field(str(name), pa.float64() if name in float_columns else pa.string()) for name in names]
+		self.schema = pa.schema(fields, metadata=metadata)
+		self.row_group_size = row_group_size
+		self.rows = []
+		self.writer = pa.parquet.ParquetWriter(filepath, self.schema)
+
+	def writerow(self, row):
+		self.rows.append(row)
+		if len(self.rows) >= self.row_group_size:
+			self.flush()
+
+	def writerows(self, rows):
+		for row in rows:
+			self.writerow(row)
+
+	def flush(self):
+		if not self.rows:
+			return
+		arrays = []
+		for field, values in zip(self.schema, zip(*self.rows)):
+			if self.pa.types.is_floating(field.type):
+				values = [float(v) if v not in (None, '') else None for v in values]
+			else:
+				values = [_to_string(v) for v in values]
+			arrays.append(self.pa.array(values, type=field.type))
+		self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+		self.rows = []
+
+	def close(self):
+		self.flush()
+		self.writer.close()
+
+
+def cache_path(filepath):
+	"""
+	The path of the cached parquet copy of a csv, xlsx, or txt file, which sits hidden next to it.
+	"""
+	directory, filename = os.path.split(os.path.abspath(filepath))
+	return os.path.join(directory, f".{filename}.parquet")
+
+
+def _source_stamp(filepath):
+	stat = os.stat(filepath)
+	return f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')
+
+
+def valid_cache(filepath):
+	"""
+	Return the path to the cached parquet copy of a file, or None if it doesn't exist or the file changed since.
+	"""
+	cached = cache_path(filepath)
+	if not os.path.isfile(cached):
+		return None
+	try:
+		pa = require_pyarrow()
+		metadata = pa.parquet.read_schema(cached).metadata or {}
+	except Exception:
+		return None
+	return cached if metadata.get(SOURCE_KEY) == _source_stamp(filepath) else None
+
+
+def iter_rows_caching(filepath, rows, names, chunksize):
+	"""
+	Pass through the rows of a csv, xlsx, or txt file while also writing them to its cached parquet copy,
+	so the next run can skip parsing the file. The copy is only kept if every row was read.
+
+	:param filepath: the file the rows come from.
+	:param rows: an iterator of every row of the file, with all of the columns.
+	:param names: the column names.
+	:param chunksize: the number of rows per parquet row group.
+	"""
+	cached = cache_path(filepath)
+	tmp_file = f"{cached}.tmp"
+	writer = ParquetRowWriter(
+		tmp_file, names, metadata={SOURCE_KEY: _source_stamp(filepath)}, row_group_size=chunksize,
+	)
+	try:
+		while True:
+			chunk = list(islice(rows, chunksize))
+			if not chunk:
+				break
+			writer.writerows(chunk)
+			yield from chunk
+		writer.close()
+		os.replace(tmp_file, cached)
+	finally:
+		if os.path.exists(tmp_file):
+			writer.writer.close()
+			os.remove(tmp_file)
@@ -0,0 +1,332 @@
+"""
+Find near-duplicate images in a dataset folder -- resized copies, re-encodes, and thumbnails of the same picture --
+and report them, or drop or hardlink the extra copies. Each image gets a 64 bit difference hash (dHash), which
+changes little when an image is resized or recompressed, and the hashes are put in a multi-index hash table so
+finding every hash within a Hamming distance takes a few dictionary lookups instead of comparing every pair.
+"""
+import argparse
+import multiprocessing
+import os
+from collections import defaultdict, deque
+from itertools import combinations
+from math import comb
+from concurrent.futures import ProcessPoolExecutor
+from csv import writer as csv_writer
+from contextlib import nullcontext
+from dataset.utils import walk_images, stop_if_cancelled, image_label, read_fanout
+from dataset.catalog import open_catalog
+from dataset.progress import Progress, OK, ERROR, DUPLICATE
+from dataset import metrics, profiling
+
+HASH_SIZE = 8
+DEFAULT_RADIUS = 4
+ACTIONS = ('report', 'drop', 'hardlink')
+SCOPES = ('label', 'all')
+REPORT_FILE = 'duplicates.csv'
+REPORT_HEADER = ['Cluster', 'File', 'Label', 'Distance', 'Action']
+HASH_CHUNKSIZE = 64
+# the chunks in flight for each hashing process, so a cancel only waits on the ones already submitted
+HASH_CHUNKS_AHEAD = 2
+
+
+def dhash(image, hash_size=HASH_SIZE):
+	"""
+	Return the difference hash of a PIL image as an int of hash_size * hash_size bits: one bit for whether each pixel
+	of a small grayscale copy is brighter than its right neighbor.
+	"""
+	from PIL import Image
+	small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+	pixels = list(small.getdata())
+	value = 0
+	for row in range(hash_size):
+		offset = row * (hash_size + 1)
+		for col in range(hash_size):
+			value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+	return value
+
+
+def _hash_file(path, hash_size=HASH_SIZE):
+	# (path, hash, pixels, bytes) for an image, with a hash of None if it can't be read
+	from PIL import Image
+	try:
+		with metrics.timer('hash'):
+			with Image.open(path) as image:
+				pixels = image.size[0] * image.size[1]
+				# jpegs only need decoding at 1/8 scale for a 9x8 thumbnail
+				image.draft('L', (hash_size * 8, hash_size * 8))
+				value = dhash(image, hash_size)
+		return path, value, pixels, os.path.getsize(path)
+	except Exception as e:
+		print(f"Problem hashing image {path}: {e}")
+	return path, None, 0, 0
+
+
+def _hash_files(paths):
+	# _hash_file for a chunk of images, in one task
+	return [_hash_file(path) for path in paths]
+
+
+def hamming(a, b):
+	return bin(a ^ b).count('1')
+
+
+class HashIndex:
+	"""
+	Multi-index hashing: the bits of each hash are split into chunks, with a table per chunk. Two hashes within
+	radius bits of each other have at least one chunk within radius // chunks bits of each other, so a query only has
+	to look up the buckets near its own chunks instead of comparing every hash. The number of chunks is picked from
+	the expected number of hashes, so the buckets stay small as the index grows.
+
+	:param radius: the largest Hamming distance that queries find.
+	:param bits: the number of bits in each hash.
+	:param size: the number of hashes expected in the index.
+	"""
+
+	def __init__(self, radius, bits=HASH_SIZE * HASH_SIZE, size=1000000):
+		self.radius = radius
+		chunks = _best_chunks(radius, bits, size)
+		self.sub_radius = radius // chunks
+		# (shift, mask, flips) of each chunk, splitting the bits as evenly as possible, where flips are the xor masks
+		# that change at most sub_radius of the chunk's bits
+		self.chunks = []
+		start = 0
+		for i in range(chunks):
+			width = bits // chunks + (1 if i < bits % chunks else 0)
+			flips = [
+				sum(1 << bit for bit in flipped)
+				for k in range(self.sub_radius + 1) for flipped in combinations(range(width), k)
+			]
+			self.chunks.append((start, (1 << width) - 1, flips))
+			start += width
+		self.tables = [defaultdict(list) for _ in self.chunks]
+
+	def add(self, value):
+		for table, (shift, mask, _) in zip(self.tables, self.chunks):
+			table[(value >> shift) & mask].append(value)
+
+	def query(self, value):
+		"""
+		Return the {hash: distance} of every added hash within radius of value.
+		"""
+		found = {}
+		checked = set()
+		for table, (shift, mask, flips) in zip(self.tables, self.chunks):
+			chunk = (value >> shift) & mask
+			for flip in flips:
+				for candidate in table.get(chunk ^ flip, ()):
+					if candidate not in checked:
+						checked.add(candidate)
+						distance = hamming(value, candidate)
+						if distance <= self.radius:
+							found[candidate] = distance
+		return found
+
+
+def _best_chunks(radius, bits, size):
+	# the number of chunks with the fewest expected bucket lookups and candidate comparisons per query, for random hashes
+	best, best_cost = 1, None
+	for chunks in range(1, min(radius + 1, bits) + 1):
+		width = bits // chunks
+		lookups = sum(comb(width, k) for k in range(radius // chunks + 1))
+		cost = chunks * lookups * (1 + size / 2 ** width)
+		if best_cost is None or cost < best_cost:
+			best, best_cost = chunks, cost
+	return best
+
+
+def _find(parents, item):
+	# union-find root with path halving
+	while parents[item] != item:
+		parents[item] = parents[parents[item]]
+		item = parents[item]
+	return item
+
+
+def cluster_hashes(hashes, radius):
+	"""
+	Group hashes into clusters of hashes chained together by distances of at most radius.
+
+	:param hashes: an iterable of distinct hashes.
+	:return: a list of clusters, each a list of hashes, leaving out the hashes that are alone.
+	"""
+	hashes = list(hashes)
+	index = HashIndex(radius, size=len(hashes))
+	parents = {}
+	for value in hashes:
+		parents[value] = value
+		for match in index.query(value):
+			root, match_root = _find(parents, value), _find(parents, match)
+			if root != match_root:
+				parents[match_root] = root
+		index.add(value)
+	clusters = defaultdict(list)
+	for value in parents:
+		clusters[_find(parents, value)].append(value)
+	return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+
+def _label(path, directory, fanout=0):
+	# the label folder an image is in, or '' for images at the top of the dataset
+	return image_label(os.path.relpath(path, directory), fanout) or ''
+
+
+def find_duplicates(
+		directory, radius=DEFAULT_RADIUS, scope='label', processes=None, progress_hook=None, cancel_event=None
+):
+	"""
+	Hash every image in a dataset folder and group the near-duplicates.
+
+	:param directory: the dataset folder, with an optional subfolder per label.
+	:param radius: the largest number of the 64 hash bits two images can differ by and still be duplicates.
+		0 finds exact re-encodes and resizes, and 4 to 8 also finds light crops, edits, and watermarks.
+	:param scope: 'label' to only group duplicates within the same label folder, or 'all' to also group them across
+		label folders.
+	:param processes: an optional number of processes to hash the images with.
+	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
+	:param cancel_event: an optional threading.Event that stops the job with JobCancelled when set.
+	:return: a list of clusters, each a list of (file, label, distance) with the copy to keep first -- the one with
+		the most pixels, then the most bytes -- and each other copy's hash distance to it.
+	"""
+	if scope not in SCOPES:
+		raise ValueError(f"Scope {scope} is not one of {SCOPES}")
+	directory = os.path.abspath(directory)
+	fanout = read_fanout(directory)
+	image_files = list(walk_images(directory))
+	print(f"Hashing {len(image_files)} images...")
+	# hash -> [(path, pixels, bytes)], for each label when the scope is 'label'
+	groups = defaultdict(lambda: defaultdict(list))
+	with Progress(total=len(image_files), progress_hook=progress_hook) as progress:
+		# spawn, like the prediction workers, so the pool doesn't fork a process holding locks or a loaded model
+		context = multiprocessing.get_context('spawn')
+		with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+			# executor.map would submit every image up front, and leaving the pool waits for all of them, so keep a
+			# bounded window of chunks in flight and cancel the queued ones when the job is cancelled
+			pending = deque()
+
+			def handle(results):
+				for path, value, pixels, size in results:
+					stop_if_cancelled(cancel_event, pending)
+					if value is None:
+						progress.update(ERROR)
+						continue
+					group = _label(path, directory, fanout) if scope == 'label' else None
+					groups[group][value].append((path, pixels, size))
+					progress.update(OK)
+
+			ahead = HASH_CHUNKS_AHEAD * (processes or os.cpu_count() or 1)
+			for start in range(0, len(image_files), HASH_CHUNKSIZE):
+				stop_if_cancelled(cancel_event, pending)
+				pending.append(executor.submit(_hash_files, image_files[start:start + HASH_CHUNKSIZE]))
+				if len(pending) >= ahead:
+					handle(pending.popleft().result())
+			while pending:
+				handle(pending.popleft().result())
+	print(progress.summary())
+
+	clusters = []
+	for by_hash in groups.values():
+		stop_if_cancelled(cancel_event)
+		# identical hashes are a cluster without a search, and the index only needs each distinct hash once
+		hash_clusters = cluster_hashes(by_hash, radius)
+		in_cluster = {value for cluster in hash_clusters for value in cluster}
+		hash_clusters += [[value] for value, files in by_hash.items() if len(files) > 1 and value not in in_cluster]
+		for hash_cluster in hash_clusters:
+			files = [(path, pixels, size, value) for value in hash_cluster for path, pixels, size in by_hash[value]]
+			files.sort(key=lambda file: (-file[1], -file[2], file[0]))
+			keep_hash = files[0][3]
+			clusters.append([(path, _label(path, directory, fanout), hamming(keep_hash, value)) for path, _, _, value in files])
+	clusters.sort(key=lambda cluster: cluster[0][0])
+	return clusters
+
+
+def _hardlink(src, dest):
+	# replace dest with a hardlink to src, through a temporary name so dest is never missing
+	if os.path.samefile(src, dest):
+		return
+	tmp = f"{dest}.dedupe-tmp"
+	os.link(src, tmp)
+	os.replace(tmp, dest)
+
+
+def dedupe(
+		directory, radius=DEFAULT_RADIUS, scope='label', action='report', dry_run=False, processes=None,
+		progress_hook=None, cancel_event=None
+):
+	"""
+	Find the near-duplicate images in a dataset folder, write them to a duplicates.csv report in the folder, and
+	optionally drop or hardlink the extra copies.
+
+	:param directory: the dataset folder, with an optional subfolder per label.
+	:param radius: the largest hash distance between duplicates, see find_duplicates.
+	:param scope: 'label' to only look for duplicates within each label folder, or 'all' to look across labels too.
+	:param action: 'report' to only write the report, 'drop' to delete every copy but the one with the most pixels,
+		or 'hardlink' to replace the other copies with hardlinks to it, which keeps every file and label but frees the space.
+		Dropped copies are also removed from the folder's catalog, if it has one.
+	:param dry_run: a flag for whether to only write the report, with the action that would be taken.
+	:param processes: an optional number of processes to hash the images with.
+	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
+	:param cancel_event: an optional threading.Event that stops the job with JobCancelled when set.
+	:return: the list of clusters from find_duplicates.
+	"""
+	if action not in ACTIONS:
+		raise ValueError(f"Action {action} is not one of {ACTIONS}")
+	directory = os.path.abspath(directory)
+	clusters = find_duplicates(
+		directory, radius=radius, scope=scope, processes=processes, progress_hook=progress_hook,
+		cancel_event=cancel_event,
+	)
+	extra_copies = sum(len(cluster) - 1 for cluster in clusters)
+	mixed = sum(1 for cluster in clusters if len({label for _, label, _ in cluster}) > 1)
+	print(f"Found {len(clusters)} groups of near-duplicates with {extra_copies} extra copies.")
+	if mixed:
+		print(f"{mixed} groups have copies in more than one label folder.")
+
+	report_file = os.path.join(directory, REPORT_FILE)
+	with open(report_file, 'w', encoding="utf-8", newline='') as f, open_catalog(directory, None) or nullcontext() as catalog:
+		writer = csv_writer(f)
+		writer.writerow(REPORT_HEADER)
+		with Progress(total=extra_copies) as progress:
+			for cluster_idx, cluster in enumerate(clusters):
+				stop_if_cancelled(cancel_event)
+				keep_file, keep_label, _ = cluster[0]
+				writer.writerow([cluster_idx, keep_file, keep_label, 0, 'keep'])
+				for path, label, distance in cluster[1:]:
+					done = action
+					if action != 'report' and not dry_run:
+						try:
+							if action == 'drop':
+								os.remove(path)
+								if catalog:
+									catalog.remove(path)
+							else:
+								_hardlink(keep_file, path)
+							progress.update(DUPLICATE)
+						except OSError as e:
+							print(f"Problem with {action} of {path}: {e}")
+							done = 'error'
+							progress.update(ERROR)
+					else:
+						progress.update(DUPLICATE)
+					writer.writerow([cluster_idx, path, label, distance, done])
+	print(f"Wrote the duplicates to {report_file}")
+	return clusters
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Find near-duplicate images in a dataset folder.')
+	parser.add_argument('dir', help='Path to your dataset folder, with a subfolder per label.')
+	parser.add_argument('--radius', type=int, default=DEFAULT_RADIUS, help='Largest hash distance (of 64 bits) between duplicates.')
+	parser.add_argument('--scope', choices=SCOPES, default='label', help='Find duplicates within each label folder, or across all of them.')
+	parser.add_argument('--action', choices=ACTIONS, default='report', help='What to do with the extra copies.')
+	parser.add_argument('--dry-run', action='store_true', help='Only write the report of what would change.')
+	parser.add_argument('--processes', type=int, help='Number of processes to hash the images with.')
+	parser.add_argument('--metrics', help='Directory to write per-stage timing metrics to.')
+	profiling.add_arguments(parser)
+	args = parser.parse_args()
+	if args.metrics:
+		metrics.enable(args.metrics)
+	with profiling.profiled(args.profile, default_dir=os.path.dirname(os.path.abspath(args.dir)), modes=args.profile_mode):
+		dedupe(
+			directory=args.dir, radius=args.radius, scope=args.scope, action=args.action, dry_run=args.dry_run,
+			processes=args.processes,
+		)
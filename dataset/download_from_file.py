@@ -1,94 +1,235 @@
 """
-Given a csv or txt file, download the image urls to form the dataset.
+Given a csv or txt file, download the image urls to form the dataset. Local paths and file:// urls are linked or
+copied into the dataset instead of downloaded.
 """
 import argparse
 import os
+from collections import defaultdict, deque
+from queue import Queue
 from csv import writer as csv_writer
 import pandas as pd
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
-from dataset.utils import download_image
+from contextlib import nullcontext
+from dataset.utils import download_image, ingest_image, local_path, mark_fanout, normalize_url, stop_if_cancelled
+from dataset.catalog import open_catalog
+from dataset.progress import Progress, OK, ERROR, DUPLICATE, SKIPPED
+from dataset import metrics, profiling
+from dataset.introspect import TABLE_EXTENSIONS, inspect_file, iter_rows, column_index, has_header
 
 
-def create_dataset(filepath, url_col=None, label_col=None, progress_hook=None, destination_directory=None):
+def create_dataset(
+		filepath, url_col=None, label_col=None, progress_hook=None, destination_directory=None, cache=False,
+		workers=None, cancel_event=None, catalog=False, fanout=0, hardlink=True, per_label=None
+):
 	"""
 	Given a file with urls to images, downloads those images to a new directory that has the same name
 	as the file without the extension. If labels are present, further categorizes the directory to have
-	the labels as sub-directories.
+	the labels as sub-directories. Each url is only downloaded once: repeats of it under the same label are skipped,
+	and under other labels the downloaded image is hardlinked into their folders.
 
-	:param filepath: path to a valid txt or csv file with image urls to download.
+	:param filepath: path to a valid txt, csv, xlsx, parquet, or arrow file with image urls to download. The urls can
+		also be file:// urls or local paths, which are added without going through http or waiting on the downloads.
 	:param url_col: if this is a csv, the column header name for the urls to download.
 	:param label_col: if this is a csv, the column header name for the labels of the images.
 	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
 	:param destination_directory: an optional directory path to download the dataset to.
+	:param cache: a flag for whether to read a txt, csv, or xlsx file through a cached parquet copy, which is much faster
+		to read again on later runs.
+	:param workers: an optional number of download threads.
+	:param cancel_event: an optional threading.Event that stops the download with JobCancelled when set.
+	:param catalog: a flag for whether to record the images, their urls, and the failed downloads in the dataset's
+		catalog, see dataset.catalog.
+	:param fanout: an optional number of levels of hash-prefix folders to spread the images of each label over, like
+		label/ab/cd/image.jpg, for labels with too many images for one folder.
+	:param hardlink: a flag for whether local images can be added as hardlinks to the original files. Otherwise they
+		are copy-on-write clones where the filesystem supports them, or copies made inside the kernel.
+	:param per_label: an optional number of images to download for each label, or a dict of label to its number, to
+		sample a dataset from a long, skewed list. Only as many rows of a label are downloaded at once as it still
+		needs, the later rows are kept as spares to make up for failed downloads, and a label's rows are skipped once
+		it has its images. With a dict, the labels not in it are skipped, and the file stops being read once every
+		label has its images. Without a label column, this is the number of images in all.
 	"""
 	print(f"Processing {filepath}")
 	filepath = os.path.abspath(filepath)
 	filename, ext = _name_and_extension(filepath)
-	# read the file
+	# read just the headers and an estimate of the number of rows -- the rows themselves are streamed in chunks
 	# if this a .txt file, don't treat the first row as a header. Otherwise, use the first row for header column names.
-	if ext != '.xlsx':
-		csv = pd.read_csv(filepath, header=None if ext == '.txt' else 0)
-	else:
-		csv = pd.read_excel(filepath, header=0)
-	if ext in ['.csv', '.xlsx'] and not url_col:
+	info = inspect_file(filepath)
+	if has_header(filepath) and not url_col:
 		raise ValueError(f"Please specify an image url column for the csv.")
-	url_col_idx = 0
-	if url_col:
-		try:
-			url_col_idx = list(csv.columns).index(url_col)
-		except ValueError:
-			raise ValueError(f"Image url column {url_col} not found in csv headers {csv.columns}")
-	label_col_idx = None
+	# only read the url and label columns
+	columns = [column_index(info.headers, url_col) if url_col else 0]
 	if label_col:
-		try:
-			label_col_idx = list(csv.columns).index(label_col)
-		except ValueError:
-			raise ValueError(f"Label column {label_col} not found in csv headers {csv.columns}")
+		columns.append(column_index(info.headers, label_col, kind="Label"))
 
-	total_jobs = len(csv)
-	print(f"Downloading {total_jobs} items...")
+	total_jobs = info.rows
+	print(f"Downloading {'' if info.exact else '~'}{total_jobs} items...")
 
 	errors = []
 	dest = os.path.join(destination_directory, filename) if destination_directory else filename
+	mark_fanout(dest, fanout)
 
 	# try/catch for keyboard interrupt
 	try:
 		# iterate over the rows and add to our download processing job!
-		with tqdm(total=total_jobs) as pbar:
-			with ThreadPoolExecutor() as executor:
-				# for every image in the row, download it!
-				download_futures = {}
+		with open_catalog(dest, catalog) or nullcontext() as catalog_db, \
+				Progress(total=total_jobs, progress_hook=progress_hook) as progress:
+			# local files get their own pool, so they don't queue behind the downloads
+			with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download') as executor, \
+					ThreadPoolExecutor(thread_name_prefix='ingest') as ingest_executor:
 				lock = Lock()
-				for i, row in enumerate(csv.itertuples(index=False)):
+				# future -> the (index, url, label) row it is for, and whether it links in another row's download
+				pending = {}
+				# finished futures, handled on this thread as the rows are read
+				finished = Queue()
+				# normalized url -> (its download future, the labels it goes in)
+				fetches = {}
+				# download future -> the rows with the same url under other labels, linked in once it is done
+				copies = defaultdict(list)
+				# the images each label has, the ones on the way, and its spare rows to make up for failures
+				succeeded = defaultdict(int)
+				in_flight = defaultdict(int)
+				spares = defaultdict(deque)
+				# with a quota for each label given, the labels still short of it
+				open_labels = {label for label in per_label if per_label[label] > 0} if isinstance(per_label, dict) else None
+				duplicates = skipped = 0
+
+				def needed(label):
+					# the images a label still needs, or None without quotas
+					quota = _quota(per_label, label)
+					return None if quota is None else quota - succeeded[label]
+
+				def skip(n=1):
+					nonlocal skipped
+					if not n:
+						return
+					skipped += n
+					metrics.count('quota_skipped', n)
+					progress.update(SKIPPED, n)
+
+				def submit(pool, row, *args, copy=False, **kwargs):
+					future = pool.submit(*args, directory=dest, lock=lock, label=row[2], catalog=catalog_db, fanout=fanout, **kwargs)
+					pending[future] = (row, copy)
+					future.add_done_callback(finished.put)
+					return future
+
+				def link(fetch_future, row):
+					# hardlink a finished download into another label's folder
+					filename = fetch_future.result()
+					if filename:
+						submit(ingest_executor, row, ingest_image, filename, source_url=row[1], copy=True)
+					else:
+						finish(row, None)
+
+				def start(row):
+					index, url, label = row
+					in_flight[label] += 1
+					key = normalize_url(url) or url
+					fetch_future, labels = fetches[key]
+					if fetch_future is not None:
+						if fetch_future.done():
+							link(fetch_future, row)
+						else:
+							copies[fetch_future].append(row)
+						return
+					source = local_path(url)
+					if source is not None:
+						fetch_future = submit(ingest_executor, row, ingest_image, source, hardlink=hardlink)
+					else:
+						fetch_future = submit(executor, row, download_image, url=url)
+					fetches[key] = (fetch_future, labels)
+
+				def add_row(row):
+					nonlocal duplicates
+					index, url, label = row
+					key = normalize_url(url) or url
+					fetch = fetches.get(key)
+					if fetch is not None:
+						duplicates += 1
+						metrics.count('duplicate_urls')
+						if label in fetch[1]:
+							progress.update(DUPLICATE)
+							return
+						fetch[1].add(label)
+					else:
+						# claimed by this row, which starts the download once its label has room
+						fetches[key] = (None, {label})
+					need = needed(label)
+					if need is None or in_flight[label] < need:
+						start(row)
+					elif need <= 0:
+						skip()
+					else:
+						spares[label].append(row)
+
+				def finish(row, filename, copy=False):
+					index, url, label = row
+					in_flight[label] -= 1
+					need = needed(label)
+					if filename:
+						succeeded[label] += 1
+						progress.update(DUPLICATE if copy else OK)
+						if need is not None and need <= 1:
+							# the label has all of its images, so its spare rows aren't needed
+							skip(len(spares.pop(label, ())))
+							if open_labels is not None:
+								open_labels.discard(label)
+						return
+					error_row = [index, url]
+					if label_col:
+						error_row.append(label)
+					errors.append(error_row)
+					progress.update(ERROR)
+					# make up for the failure with a spare row
+					while spares.get(label) and in_flight[label] < need:
+						start(spares[label].popleft())
+
+				def handle(future):
+					row, copy = pending.pop(future)
+					filename = future.result()
+					if not copy:
+						for waiting in copies.pop(future, ()):
+							link(future, waiting)
+					finish(row, filename, copy)
+
+				index = 0
+				for index, row in enumerate(iter_rows(filepath, columns=columns, cache=cache), start=1):
+					stop_if_cancelled(cancel_event, pending)
 					# job is passed to our worker processes
-					index = i + 1
-					url = row[url_col_idx]
+					url = row[0]
 					label = None
-					if label_col_idx:
-						label = row[label_col_idx]
+					if label_col:
+						label = row[1]
 						label = None if pd.isnull(label) else label
-					download_futures[
-						executor.submit(download_image, url=url, directory=dest, lock=lock, label=label)
-					] = (index, url, label)
+					if open_labels is not None and label not in per_label:
+						skip()
+					else:
+						add_row((index, url, label))
+					# handle the finished downloads as we go, and wait on them when a label has enough spare rows
+					while not finished.empty() or (label in spares and len(spares[label]) >= (needed(label) or 0) > 0):
+						handle(finished.get())
+					if open_labels is not None and not open_labels:
+						print("Every label has its images, stopping early.")
+						break
+				# now we know exactly how many rows there were
+				progress.set_total(index)
 
-
-				# iterate over the results to update our progress bar and write any errors to the error csv
-				num_processed = 0
-				for future in as_completed(download_futures):
-					index, url, label = download_futures[future]
-					filename = future.result()
-					if not filename:
-						error_row = [index, url]
-						if label_col_idx:
-							error_row.append(label)
-						errors.append(error_row)
-					# update progress
-					pbar.update(1)
-					num_processed += 1
-					if progress_hook:
-						progress_hook(num_processed, total_jobs)
+				while pending:
+					stop_if_cancelled(cancel_event, pending)
+					handle(finished.get())
+				# rows that were never needed
+				skip(sum(len(rows) for rows in spares.values()))
+			print(progress.summary())
+			fetched = sum(1 for future, _ in fetches.values() if future is not None)
+			print(f"Fetched urls: {fetched} | Duplicate rows: {duplicates} | Skipped rows: {skipped}")
+			if per_label is not None:
+				short = {
+					label: succeeded[label] for label in (per_label if isinstance(per_label, dict) else succeeded)
+					if needed(label) > 0
+				}
+				for label, images in short.items():
+					print(f"Only found {images} of {_quota(per_label, label)} images for label {label}")
 
 		print('Cleaning up...')
 		# write out the error csv
@@ -97,7 +238,7 @@ def create_dataset(filepath, url_col=None, label_col=None, progress_hook=None, d
 			fname, ext = os.path.splitext(filepath)
 			error_file = f"{fname}_errors.csv"
 			with open(error_file, 'w', newline='') as f:
-				header = f"index,url{',label' if label_col_idx else ''}\n"
+				header = f"index,url{',label' if label_col else ''}\n"
 				f.write(header)
 				writer = csv_writer(f)
 				writer.writerows(errors)
@@ -106,6 +247,15 @@ def create_dataset(filepath, url_col=None, label_col=None, progress_hook=None, d
 		raise
 
 
+def _quota(per_label, label):
+	# a label's number of images from one number for every label or a dict of them, or None without quotas
+	if per_label is None:
+		return None
+	if isinstance(per_label, dict):
+		return per_label.get(label, 0)
+	return per_label
+
+
 def _name_and_extension(filepath):
 	# returns a tuple of the filename and the extension, ignoring any other prefixes in the filepath
 	# raises if not a file
@@ -119,7 +269,7 @@ def _name_and_extension(filepath):
 
 def _valid_file(filepath):
 	# file must exist and have a valid extension
-	valid_extensions = ['.txt', '.csv', '.xlsx']
+	valid_extensions = TABLE_EXTENSIONS
 	_, extension = _name_and_extension(filepath)
 	if extension not in valid_extensions:
 		raise ValueError(f"File {filepath} doesn't have one of the valid extensions: {valid_extensions}")
@@ -129,8 +279,21 @@ def _valid_file(filepath):
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Download an image dataset from csv or txt file.')
-	parser.add_argument('file', help='Path to your csv or txt file.')
+	parser.add_argument('file', help='Path to your csv, xlsx, txt, parquet, or arrow file.')
 	parser.add_argument('--url', help='If this is a csv with column headers, the column that contains the image urls to download.')
 	parser.add_argument('--label', help='If this is a csv with column headers, the column that contains the labels to assign the images.')
+	parser.add_argument('--cache', action='store_true', help='Read the file through a cached parquet copy, creating it if needed.')
+	parser.add_argument('--per-label', type=int, help='Only download this many images for each label.')
+	parser.add_argument('--fanout', type=int, default=0, help='Levels of hash-prefix folders to spread each label over.')
+	parser.add_argument('--catalog', action='store_true', help="Record the images in the dataset's catalog, creating it if needed.")
+	parser.add_argument('--no-hardlink', action='store_true', help='Clone or copy local images instead of hardlinking them.')
+	parser.add_argument('--metrics', help='Directory to write per-stage timing metrics to.')
+	profiling.add_arguments(parser)
 	args = parser.parse_args()
-	create_dataset(filepath=args.file, url_col=args.url, label_col=args.label)
+	if args.metrics:
+		metrics.enable(args.metrics)
+	with profiling.profiled(args.profile, default_dir=os.path.dirname(os.path.abspath(args.file)), modes=args.profile_mode):
+		create_dataset(
+			filepath=args.file, url_col=args.url, label_col=args.label, cache=args.cache, catalog=args.catalog,
+			fanout=args.fanout, hardlink=not args.no_hardlink, per_label=args.per_label,
+		)
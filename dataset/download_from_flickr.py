@@ -7,18 +7,26 @@ import csv
 import xml.etree.ElementTree as ET
 from typing import Optional, Tuple
 import requests
-from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
-from dataset.utils import download_image
+from itertools import chain
+from contextlib import nullcontext
+from dataset.utils import download_image, mark_fanout, stop_if_cancelled
+from dataset.catalog import open_catalog
+from dataset.progress import Progress, OK, ERROR, DUPLICATE
+from dataset import metrics, profiling
+
+FLICKR_REST_URL = 'https://www.flickr.com/services/rest/'
+# the image download url from the search result info
+FLICKR_IMAGE_URL = "https://farm{farm_id}.staticflickr.com/{server_id}/{photo_id}_{secret}_{size}.jpg"
 
 
 def download_flickr(
 		api_key, directory,
 		min_lat=None, min_long=None, max_lat=None, max_long=None,
-		search=None, size='z', progress_hook=None
+		search=None, size='z', progress_hook=None, base_url=FLICKR_REST_URL, img_url_template=FLICKR_IMAGE_URL,
+		workers=None, cancel_event=None, catalog=False, fanout=0
 ):
-	base_url = 'https://www.flickr.com/services/rest/'
 	search_params = {
 		'api_key': api_key,
 		'method': 'flickr.photos.search',
@@ -38,10 +46,9 @@ def download_flickr(
 		search_errors = 0
 		download_errors = 0
 		downloaded_images = 0
-		img_urls = []
+		img_urls = set()
 		csv_lock = Lock()
 		filesystem_lock = Lock()
-		num_processed = 0
 		search_imgs = 0
 		if response.ok:
 			root = ET.fromstring(response.content)
@@ -50,8 +57,10 @@ def download_flickr(
 			pages = int(page.get('pages'))
 			print(f"Found {total_images} images for location min: ({min_lat}, {min_long}) max: ({max_lat}, {max_long}) and search term '{search}' | {pages} pages")
 			total_jobs = pages+total_images
-			with tqdm(total=total_jobs) as pbar:
-				with ThreadPoolExecutor() as executor:
+			mark_fanout(directory, fanout)
+			with open_catalog(directory, catalog) or nullcontext() as catalog_db, \
+					Progress(total=total_jobs, progress_hook=progress_hook) as progress:
+				with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flickr') as executor:
 					# run the search page parser
 					search_futures = []
 					for i in range(1, pages+1):
@@ -63,53 +72,45 @@ def download_flickr(
 					# now for all the search results, start downloading
 					download_futures = {}
 					for future in as_completed(search_futures):
+						stop_if_cancelled(cancel_event, chain(search_futures, download_futures))
 						try:
 							for farm_id, server_id, photo_id, secret in future.result():
 								search_imgs += 1
-								# the image download url from the search result info
-								img_url = f"https://farm{farm_id}.staticflickr.com/{server_id}/{photo_id}_{secret}_{size}.jpg"
+								img_url = img_url_template.format(
+									farm_id=farm_id, server_id=server_id, photo_id=photo_id, secret=secret, size=size
+								)
 								# don't download duplicates
 								if img_url not in img_urls:
-									img_urls.append(img_url)
+									img_urls.add(img_url)
 									# submit job to download the image
 									download_futures[
-										executor.submit(download_image, url=img_url, directory=directory, lock=filesystem_lock)
+										executor.submit(
+											download_image, url=img_url, directory=directory, lock=filesystem_lock,
+											catalog=catalog_db, fanout=fanout,
+										)
 									] = (photo_id, secret, img_url)
 								else:
-									# duplicate found, so don't count this image for jobs
+									# duplicate found, so it is done without a download
 									duplicates += 1
-									total_jobs -= 1
-									pbar.total = total_jobs
-									pbar.refresh()
-									if progress_hook:
-										progress_hook(num_processed, total_jobs)
+									metrics.count('flickr_duplicates')
+									progress.update(DUPLICATE)
 							# update progress bar for search page
-							pbar.update(1)
-							num_processed += 1
-							if progress_hook:
-								progress_hook(num_processed, total_jobs)
+							progress.update(OK)
 						except Exception:
-							# search page error, so don't count this page for jobs
 							search_errors += 1
-							total_jobs -= 1
-							pbar.total = total_jobs
-							pbar.refresh()
-							if progress_hook:
-								progress_hook(num_processed, total_jobs)
+							progress.update(ERROR)
 
 					# now for all of our downloaded images, write the csv with info if we can
 					info_futures = []
 					for future in as_completed(download_futures):
+						stop_if_cancelled(cancel_event, chain(download_futures, info_futures))
 						photo_id, secret, url = download_futures[future]
 						filename = future.result()
 						if not filename:
-							# image download error, so don't count this image for jobs
+							# image download error, so there is no info to write
 							download_errors += 1
-							total_jobs -= 1
-							pbar.total = total_jobs
-							pbar.refresh()
-							if progress_hook:
-								progress_hook(num_processed, total_jobs)
+							progress.update(ERROR)
+							continue
 						info_futures.append(
 							executor.submit(
 								write_photo_csv,
@@ -120,19 +121,15 @@ def download_flickr(
 
 					# wait for all our final csv jobs to finish
 					for _ in as_completed(info_futures):
+						stop_if_cancelled(cancel_event, info_futures)
 						# update our progress bar for the finished image download and csv write
-						pbar.update(1)
 						downloaded_images += 1
-						num_processed += 1
-						if progress_hook:
-							progress_hook(num_processed, total_jobs)
+						progress.update(OK)
 
 				# update our progress to be 100%
 				# (because original number of images reported from flickr api search can be incorrect)
-				pbar.update(total_jobs-num_processed)
+				progress.set_total(progress.done)
 			print(f"Downloaded {downloaded_images}\nSearch errors: {search_errors} | Duplicates: {duplicates} | Download errors: {download_errors} | Found {search_imgs} images")
-			if progress_hook:
-				progress_hook(total_jobs, total_jobs)
 	except Exception:
 		raise
 
@@ -149,8 +146,9 @@ def parse_search_xml(xml):
 
 
 def images_from_search(page_index, base_url, search_params):
-	search_params['page'] = page_index
-	response = requests.get(url=base_url, params=search_params, timeout=30)
+	# the search pages run at the same time, so each gets its own copy of the params
+	with metrics.timer('flickr_search'):
+		response = requests.get(url=base_url, params={**search_params, 'page': page_index}, timeout=30)
 	if response.ok:
 		return parse_search_xml(response.content)
 	return []
@@ -208,8 +206,9 @@ def get_photo_info(url, api_key, photo_id, secret) -> Tuple[Optional[str], Optio
 
 def write_photo_csv(directory, base_url, api_key, img_filename, url, photo_id, secret, lock):
 	out_file = os.path.join(directory, 'images.csv')
-	latitude, longitude, accuracy = get_photo_location(url=base_url, api_key=api_key, photo_id=photo_id)
-	user_id, title, date_taken = get_photo_info(url=base_url, api_key=api_key, photo_id=photo_id, secret=secret)
+	with metrics.timer('flickr_photo_info'):
+		latitude, longitude, accuracy = get_photo_location(url=base_url, api_key=api_key, photo_id=photo_id)
+		user_id, title, date_taken = get_photo_info(url=base_url, api_key=api_key, photo_id=photo_id, secret=secret)
 	with lock:
 		make_header = not os.path.isfile(out_file)
 		with open(out_file, 'a', newline='', encoding='utf-8') as f:
@@ -235,13 +234,20 @@ if __name__ == '__main__':
 		default=None
 	)
 	parser.add_argument('--search', type=str, help='Search term to use.', default=None)
+	parser.add_argument('--fanout', type=int, default=0, help='Levels of hash-prefix folders to spread the images over.')
+	parser.add_argument('--catalog', action='store_true', help="Record the images in the folder's catalog, creating it if needed.")
+	parser.add_argument('--metrics', help='Directory to write per-stage timing metrics to.')
+	profiling.add_arguments(parser)
 	args = parser.parse_args()
+	if args.metrics:
+		metrics.enable(args.metrics)
 	if args.bbox is not None:
 		min_lat, min_long, max_lat, max_long = [float(arg.strip()) for arg in args.bbox.split(',')]
 	else:
 		min_lat, min_long, max_lat, max_long = None, None, None, None
-	download_flickr(
-		api_key=args.api, directory=args.directory,
-		min_lat=min_lat, min_long=min_long, max_lat=max_lat, max_long=max_long,
-		search=args.search,
-	)
+	with profiling.profiled(args.profile, default_dir=os.path.abspath(args.directory), modes=args.profile_mode):
+		download_flickr(
+			api_key=args.api, directory=args.directory,
+			min_lat=min_lat, min_long=min_long, max_lat=max_lat, max_long=max_long,
+			search=args.search, catalog=args.catalog, fanout=args.fanout,
+		)
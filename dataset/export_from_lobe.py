@@ -7,18 +7,19 @@ import os
 import json
 import sqlite3
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from pathlib import Path
 from threading import Lock
-from tqdm import tqdm
 from PIL import Image
-from dataset.utils import _resolve_filename_conflict
-
-if platform == 'darwin':
-    PROJECTS_DIR_MAC = '~/Library/Application Support/lobe/projects'
-    PROJECTS_DIR = os.path.realpath(os.path.expanduser(PROJECTS_DIR_MAC))
-else:
-    PROJECTS_DIR_WINDOWS = os.path.join(os.getenv('APPDATA'), 'lobe', 'projects')
-    PROJECTS_DIR = os.path.realpath(PROJECTS_DIR_WINDOWS)
+from dataset.utils import _resolve_filename_conflict, fanout_dir, mark_fanout, stop_if_cancelled, JobCancelled
+from dataset.catalog import open_catalog
+from dataset.progress import Progress, OK, ERROR
+from dataset import metrics, profiling
 
+PROJECTS_DIR_ENV = 'LOBE_PROJECTS_DIR'
+PROJECTS_DIR_MAC = '~/Library/Application Support/lobe/projects'
+# Lobe doesn't run on linux, so this is only the default for synthetic or copied projects
+PROJECTS_DIR_LINUX = '~/.config/lobe/projects'
 PROJECT_JSON_FILE = 'project.json'
 PROJECT_ID_KEY = 'id'
 PROJECT_META_KEY = 'meta'
@@ -27,13 +28,32 @@ PROJECT_DB_FILE = 'db.sqlite'
 PROJECT_BLOBS = os.path.join('data', 'blobs')
 
 
-def get_projects():
+def get_projects_dir(projects_dir=None):
+    """
+    Returns the Lobe projects directory: the given one, the LOBE_PROJECTS_DIR environment variable,
+    or where the Lobe app keeps its projects on this platform
+    """
+    projects_dir = projects_dir or os.getenv(PROJECTS_DIR_ENV)
+    if not projects_dir:
+        if platform == 'darwin':
+            projects_dir = PROJECTS_DIR_MAC
+        elif os.getenv('APPDATA'):
+            projects_dir = os.path.join(os.getenv('APPDATA'), 'lobe', 'projects')
+        else:
+            projects_dir = PROJECTS_DIR_LINUX
+    return os.path.realpath(os.path.expanduser(projects_dir))
+
+
+def get_projects(projects_dir=None):
     """
     Returns tuples of (project name, project id) from Lobe's appdata directory, sorted by modified date
     """
+    projects_dir = get_projects_dir(projects_dir)
+    if not os.path.isdir(projects_dir):
+        return []
     projects = []
-    for project in os.listdir(PROJECTS_DIR):
-        project_dir = os.path.join(PROJECTS_DIR, project)
+    for project in os.listdir(projects_dir):
+        project_dir = os.path.join(projects_dir, project)
         if os.path.isdir(project_dir):
             try:
                 project_json_file = os.path.join(project_dir, PROJECT_JSON_FILE)
@@ -50,14 +70,21 @@ def get_projects():
     return [info for info, _ in projects]
 
 
-def export_dataset(project_id, destination_dir, progress_hook=None, batch_size=1000):
+def export_dataset(
+        project_id, destination_dir, progress_hook=None, batch_size=1000, projects_dir=None, cancel_event=None,
+        catalog=False, fanout=0
+):
     """
-    Given a project id and a destination export parent directory, copy the images into a subfolder structure
+    Given a project id and a destination export parent directory, copy the images into a subfolder structure.
+    The project is looked up in projects_dir, which defaults to get_projects_dir().
+    An optional threading.Event cancel_event stops the export with JobCancelled when set.
+    The exported images are recorded in the destination's catalog (see dataset.catalog) if catalog is True.
+    With a fanout of levels, the images of each label are spread over that many levels of hash-prefix folders.
     """
     # make the desired destination if it doesn't exist
     os.makedirs(destination_dir, exist_ok=True)
     # project directory doesn't include the '-' from the project uuid
-    project_dir = os.path.join(PROJECTS_DIR, project_id.replace('-', ''))
+    project_dir = os.path.join(get_projects_dir(projects_dir), project_id.replace('-', ''))
     blob_dir = os.path.join(project_dir, PROJECT_BLOBS)
     # connect to our project db
     db_file = os.path.join(project_dir, PROJECT_DB_FILE)
@@ -74,7 +101,7 @@ def export_dataset(project_id, destination_dir, progress_hook=None, batch_size=1
             print(f"Didn't find any images for project {project_id}")
         else:
             num_images = num_images[0]
-            futures = []
+            futures = {}
             lock = Lock()
             examples_query = """
             SELECT example_images.hash, example_labels.label
@@ -83,9 +110,12 @@ def export_dataset(project_id, destination_dir, progress_hook=None, batch_size=1
             LIMIT ?
             OFFSET ?
             """
-            with tqdm(total=num_images) as pbar:
-                with ThreadPoolExecutor() as executor:
+            mark_fanout(destination_dir, fanout)
+            with open_catalog(destination_dir, catalog) or nullcontext() as catalog_db, \
+                    Progress(total=num_images, progress_hook=progress_hook) as progress:
+                with ThreadPoolExecutor(thread_name_prefix='export') as executor:
                     for offset in range(0, num_images, batch_size):
+                        stop_if_cancelled(cancel_event, futures)
                         cursor.execute(examples_query, [batch_size, offset])
                         res = cursor.fetchall()
                         for row in res:
@@ -94,20 +124,24 @@ def export_dataset(project_id, destination_dir, progress_hook=None, batch_size=1
                             img_filepath = os.path.join(blob_dir, img_hash)
                             # if we had a label, make the destination directory the subdirectory with label name
                             dest_dir = os.path.join(destination_dir, label) if label is not None else destination_dir
-                            futures.append(
-                                executor.submit(
-                                    _export_blob, blob_path=img_filepath, destination_dir=dest_dir, lock=lock
-                                )
+                            future = executor.submit(
+                                _export_blob, blob_path=img_filepath, destination_dir=dest_dir, lock=lock,
+                                label=label, catalog=catalog_db, fanout=fanout,
                             )
+                            futures[future] = (img_filepath, label)
 
-                    num_processed = 0
                     # wait for all our futures
-                    for _ in as_completed(futures):
+                    for future in as_completed(futures):
+                        stop_if_cancelled(cancel_event, futures)
+                        error = future.exception()
+                        if error and catalog_db:
+                            img_filepath, label = futures[future]
+                            catalog_db.add_error(Path(img_filepath).as_uri(), label=label, error=str(error))
                         # update our progress bar for the finished image
-                        pbar.update(1)
-                        num_processed += 1
-                        if progress_hook:
-                            progress_hook(num_processed, num_images)
+                        progress.update(ERROR if error else OK)
+                print(progress.summary())
+    except JobCancelled:
+        raise
     except Exception as e:
         print(f"Error exporting project {project_id} to {destination_dir}:\n{e}")
     finally:
@@ -115,16 +149,19 @@ def export_dataset(project_id, destination_dir, progress_hook=None, batch_size=1
             conn.close()
 
 
-def _export_blob(blob_path, destination_dir, lock=None):
+def _export_blob(blob_path, destination_dir, lock=None, label=None, catalog=None, fanout=0):
     """
-    Export the image to the destination, resolving names on conflict
+    Export the image to the destination, resolving names on conflict, and record it in the catalog if given
     """
-    os.makedirs(destination_dir, exist_ok=True)
     # get our image and save it with the native format in our new directory
     # get the blob id from the blob path
     blob_id = os.path.basename(blob_path)
-    img = Image.open(blob_path)
+    with metrics.timer('decode'):
+        img = Image.open(blob_path)
+        img.load()
     img_filename = f'{blob_id}.{img.format.lower()}'
+    destination_dir = fanout_dir(destination_dir, img_filename, fanout)
+    os.makedirs(destination_dir, exist_ok=True)
     # look for file name conflict and resolve
     if lock:
         with lock:
@@ -136,21 +173,36 @@ def _export_blob(blob_path, destination_dir, lock=None):
         img_filename = _resolve_filename_conflict(directory=destination_dir, filename=img_filename)
     # now save the file
     destination_file = os.path.join(destination_dir, img_filename)
-    img.save(destination_file, quality=100)
+    with metrics.timer('write'):
+        img.save(destination_file, quality=100)
+    if catalog is not None:
+        catalog.add_file(destination_file, label=label, source_url=Path(blob_path).as_uri())
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Export an image dataset from Lobe.')
     parser.add_argument('project', help='Your project name.', type=str)
     parser.add_argument('dest', help='Your destination export directory.', type=str, default='.')
+    parser.add_argument('--projects-dir', help=f'Your Lobe projects directory, defaults to ${PROJECTS_DIR_ENV} or where Lobe keeps them.')
+    parser.add_argument('--fanout', type=int, default=0, help='Levels of hash-prefix folders to spread each label over.')
+    parser.add_argument('--catalog', action='store_true', help="Record the images in the export's catalog, creating it if needed.")
+    parser.add_argument('--metrics', help='Directory to write per-stage timing metrics to.')
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    if args.metrics:
+        metrics.enable(args.metrics)
     project_name, project_id = None, None
-    for name_, id_ in get_projects():
+    projects = get_projects(args.projects_dir)
+    for name_, id_ in projects:
         if name_ == args.project:
             project_name = name_
             project_id = id_
             break
     if project_name:
-        export_dataset(project_id=project_id, destination_dir=os.path.join(os.path.abspath(args.dest), project_name))
+        with profiling.profiled(args.profile, default_dir=os.path.abspath(args.dest), modes=args.profile_mode):
+            export_dataset(
+                project_id=project_id, destination_dir=os.path.join(os.path.abspath(args.dest), project_name),
+                projects_dir=args.projects_dir, catalog=args.catalog, fanout=args.fanout,
+            )
     else:
-        print(f"Couldn't find project with name {args.project}.\nAvailable projects: {[name_ for name_, _ in get_projects()]}")
+        print(f"Couldn't find project with name {args.project}.\nAvailable projects: {[name_ for name_, _ in projects]}")
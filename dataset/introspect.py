@@ -0,0 +1,166 @@
+"""
+Fast introspection of the csv, xlsx, txt, parquet, and arrow url files: read only the header row, estimate the number
+of rows without parsing the whole file, and stream the rows in chunks with only the columns a job needs.
+"""
+import os
+from collections import namedtuple
+from threading import Lock
+import pandas as pd
+from dataset import columnar
+
+TABLE_EXTENSIONS = ['.txt', '.csv', '.xlsx'] + columnar.COLUMNAR_EXTENSIONS
+# bytes read from the start of a text file to estimate its row count
+SAMPLE_BYTES = 1024 * 1024
+CHUNK_ROWS = 10000
+
+FileInfo = namedtuple('FileInfo', ['headers', 'rows', 'exact'])
+
+_cache = {}
+_cache_lock = Lock()
+
+
+def _extension(filepath):
+	return os.path.splitext(filepath)[1].lower()
+
+
+def has_header(filepath):
+	# txt files are just urls, the other formats use their first row for column names
+	return _extension(filepath) != '.txt'
+
+
+def inspect_file(filepath):
+	"""
+	Return the FileInfo (headers, estimated rows, and whether that estimate is exact) for a url file.
+	Results are cached by path, size, and modification time, so picking columns in the app and the job that runs
+	afterwards only pay for this once. Headers for a txt file are the column numbers.
+	"""
+	filepath = os.path.abspath(filepath)
+	stat = os.stat(filepath)
+	key = (filepath, stat.st_size, stat.st_mtime)
+	with _cache_lock:
+		info = _cache.get(key)
+	if info is None:
+		headers = read_headers(filepath)
+		rows, exact = estimate_rows(filepath)
+		info = FileInfo(headers=headers, rows=rows, exact=exact)
+		with _cache_lock:
+			_cache[key] = info
+	return info
+
+
+def read_headers(filepath):
+	"""
+	Return the list of column names for a url file, reading only its first row.
+	"""
+	ext = _extension(filepath)
+	if columnar.is_columnar(filepath):
+		return columnar.read_headers(filepath)
+	if ext == '.xlsx':
+		from openpyxl import load_workbook
+		workbook = load_workbook(filepath, read_only=True)
+		try:
+			first_row = next(workbook.active.iter_rows(max_row=1, values_only=True), ())
+		finally:
+			workbook.close()
+		# name empty headers the same way pandas does
+		return [header if header is not None else f"Unnamed: {i}" for i, header in enumerate(first_row)]
+	if has_header(filepath):
+		return list(pd.read_csv(filepath, header=0, nrows=0).columns)
+	# without a header the columns are numbered, so look at the first row for how many there are
+	return list(pd.read_csv(filepath, header=None, nrows=1).columns)
+
+
+def estimate_rows(filepath):
+	"""
+	Return a tuple of (rows, exact) for a url file. Text files are estimated from the line lengths at the start
+	of the file, and are exact if the whole file fits in the sample. Workbooks use their stored dimensions.
+	Parquet and arrow files, and files with an up to date cached parquet copy, are exact from their metadata.
+	"""
+	ext = _extension(filepath)
+	if columnar.is_columnar(filepath):
+		return columnar.count_rows(filepath), True
+	cached = columnar.valid_cache(filepath)
+	if cached:
+		return columnar.count_rows(cached), True
+	header_rows = 1 if has_header(filepath) else 0
+	if ext == '.xlsx':
+		from openpyxl import load_workbook
+		workbook = load_workbook(filepath, read_only=True)
+		try:
+			max_row = workbook.active.max_row or 0
+		finally:
+			workbook.close()
+		return max(max_row - header_rows, 0), False
+	size = os.path.getsize(filepath)
+	with open(filepath, 'rb') as f:
+		sample = f.read(SAMPLE_BYTES)
+	lines = sample.count(b'\n')
+	if sample and not sample.endswith(b'\n') and len(sample) == size:
+		# the last line doesn't end with a newline
+		lines += 1
+	if len(sample) == size:
+		return max(lines - header_rows, 0), True
+	if not lines:
+		return 0, False
+	return max(int(size / (len(sample) / lines)) - header_rows, 0), False
+
+
+def column_index(headers, col, kind="Image url"):
+	"""
+	Return the index of the column named col, raising a ValueError if it doesn't exist.
+	"""
+	try:
+		return list(headers).index(col)
+	except ValueError:
+		raise ValueError(f"{kind} column {col} not found in csv headers {headers}")
+
+
+def iter_rows(filepath, columns=None, chunksize=CHUNK_ROWS, cache=False):
+	"""
+	Stream the rows of a url file as tuples, reading it in chunks so the first rows are available right away.
+
+	:param filepath: path to a txt, csv, xlsx, parquet, or arrow file.
+	:param columns: an optional list of column indexes to read -- each tuple then has just those values, in that order.
+	:param chunksize: the number of rows to parse at a time.
+	:param cache: a flag for whether to read a txt, csv, or xlsx file from its cached parquet copy, writing that copy
+		first if it's missing or the file changed since. Values read through the cache are strings.
+	"""
+	if columnar.is_columnar(filepath):
+		yield from columnar.iter_rows(filepath, columns=columns, chunksize=chunksize)
+		return
+	if not cache:
+		yield from _iter_table_rows(filepath, columns=columns, chunksize=chunksize)
+		return
+	cached = columnar.valid_cache(filepath)
+	if cached:
+		yield from columnar.iter_rows(cached, columns=columns, chunksize=chunksize)
+		return
+	# the cached copy needs every column, so parse the whole file this once
+	rows = columnar.iter_rows_caching(
+		filepath, _iter_table_rows(filepath, chunksize=chunksize), read_headers(filepath), chunksize,
+	)
+	for row in rows:
+		yield tuple(row[i] for i in columns) if columns is not None else row
+
+
+def _iter_table_rows(filepath, columns=None, chunksize=CHUNK_ROWS):
+	ext = _extension(filepath)
+	if ext == '.xlsx':
+		from openpyxl import load_workbook
+		workbook = load_workbook(filepath, read_only=True)
+		try:
+			for row in workbook.active.iter_rows(min_row=2, values_only=True):
+				yield tuple(row[i] if i < len(row) else None for i in columns) if columns is not None else row
+		finally:
+			workbook.close()
+		return
+	usecols = sorted(set(columns)) if columns is not None else None
+	reader = pd.read_csv(
+		filepath, header=0 if has_header(filepath) else None, usecols=usecols, chunksize=chunksize,
+	)
+	with reader:
+		for chunk in reader:
+			if columns is not None:
+				# pandas gives us the columns in file order, so put them back in the order we asked for
+				chunk = chunk.iloc[:, [usecols.index(i) for i in columns]]
+			yield from chunk.itertuples(index=False, name=None)
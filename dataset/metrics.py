@@ -0,0 +1,293 @@
+"""
+Per-stage timing metrics for the dataset and model jobs. Stages record into histograms and counters that are written
+as a JSONL event stream and a Prometheus textfile, so a slow run can be broken down into DNS, connect, time to first
+byte, body transfer, disk writes, decoding, inference, and file moves.
+
+Metrics are off unless enable() is called or the IMAGE_TOOLS_METRICS environment variable is set to a directory.
+When they are off, timer() returns a shared no-op context manager and observe() and count() return right away.
+"""
+import atexit
+import json
+import os
+import socket
+import time
+from collections import defaultdict
+from threading import Event, Lock, Thread, local
+
+METRICS_ENV = 'IMAGE_TOOLS_METRICS'
+EVENTS_FILE = 'events.jsonl'
+PREFIX = 'image_tools'
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FLUSH_INTERVAL = 5.0
+
+_enabled = False
+_directory = None
+_lock = Lock()
+# (stage, labels) -> [bucket counts..., +Inf bucket count, count, sum]
+_histograms = defaultdict(lambda: [0] * (len(BUCKETS) + 3))
+# (name, labels) -> total
+_counters = defaultdict(float)
+_events = []
+_stop = Event()
+_local = local()
+
+
+class _NullTimer:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+	def __init__(self, stage, labels):
+		self.stage = stage
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		observe(self.stage, time.perf_counter() - self.start, **self.labels)
+		return False
+
+
+def enabled():
+	return _enabled
+
+
+def enable(directory):
+	"""
+	Start recording metrics to directory: every process appends its events to events.jsonl and writes its own
+	image_tools_<pid>.prom textfile. Worker processes started afterwards record to the same directory.
+	"""
+	global _enabled, _directory
+	if _enabled:
+		return
+	_directory = os.path.abspath(directory)
+	os.makedirs(_directory, exist_ok=True)
+	# spawned worker processes pick this up when they import this module
+	os.environ[METRICS_ENV] = _directory
+	_enabled = True
+	_stop.clear()
+	_instrument_connections()
+	Thread(target=_run, daemon=True).start()
+	atexit.register(flush)
+	# pool worker processes exit without running atexit, but they do run multiprocessing's finalizers
+	from multiprocessing.util import Finalize
+	Finalize(None, flush, exitpriority=10)
+
+
+def disable():
+	global _enabled
+	flush()
+	_enabled = False
+	_stop.set()
+	os.environ.pop(METRICS_ENV, None)
+
+
+def _labels_key(labels):
+	return tuple(sorted(labels.items()))
+
+
+def timer(stage, **labels):
+	"""
+	A context manager that records how long its block takes to the stage histogram.
+	"""
+	if not _enabled:
+		return _NULL_TIMER
+	return _Timer(stage, labels)
+
+
+def observe(stage, seconds, **labels):
+	"""
+	Record a duration in seconds to the stage histogram.
+	"""
+	if not _enabled:
+		return
+	key = (stage, _labels_key(labels))
+	with _lock:
+		histogram = _histograms[key]
+		for i, bound in enumerate(BUCKETS):
+			if seconds <= bound:
+				histogram[i] += 1
+				break
+		else:
+			histogram[len(BUCKETS)] += 1
+		histogram[-2] += 1
+		histogram[-1] += seconds
+		_events.append({'ts': time.time(), 'pid': os.getpid(), 'stage': stage, 'seconds': seconds, **labels})
+
+
+def count(name, n=1, **labels):
+	"""
+	Add n to a counter.
+	"""
+	if not _enabled:
+		return
+	with _lock:
+		_counters[(name, _labels_key(labels))] += n
+		_events.append({'ts': time.time(), 'pid': os.getpid(), 'counter': name, 'n': n, **labels})
+
+
+def snapshot():
+	"""
+	Return {stage: {'count', 'sum'}} and {counter: total} for this process, with labels folded together.
+	"""
+	stages = defaultdict(lambda: {'count': 0, 'sum': 0.0})
+	counters = defaultdict(float)
+	with _lock:
+		for (stage, _), histogram in _histograms.items():
+			stages[stage]['count'] += histogram[-2]
+			stages[stage]['sum'] += histogram[-1]
+		for (name, _), total in _counters.items():
+			counters[name] += total
+	return dict(stages), dict(counters)
+
+
+def take_connect_seconds():
+	"""
+	Return the DNS and connect time spent by this thread since the last call, so a request can report its time to
+	first byte without them.
+	"""
+	if not _enabled:
+		return 0.0
+	seconds = getattr(_local, 'connect_seconds', 0.0)
+	_local.connect_seconds = 0.0
+	return seconds
+
+
+def _instrument_connections():
+	# time the DNS lookup and TCP connect of every new requests/urllib3 connection separately. urllib3's own
+	# create_connection still resolves and tries the addresses as it always does: the getaddrinfo it calls is timed, and
+	# the rest of the call is the connect
+	try:
+		from urllib3.util import connection
+	except ImportError:
+		return
+	create_connection = connection.create_connection
+	if getattr(create_connection, 'instrumented', False):
+		return
+	getaddrinfo = socket.getaddrinfo
+
+	def timed_getaddrinfo(*args, **kwargs):
+		# only counted inside a timed connection -- everywhere else this is just getaddrinfo
+		if getattr(_local, 'dns_seconds', None) is None:
+			return getaddrinfo(*args, **kwargs)
+		start = time.perf_counter()
+		try:
+			return getaddrinfo(*args, **kwargs)
+		finally:
+			_local.dns_seconds += time.perf_counter() - start
+
+	def timed_create_connection(*args, **kwargs):
+		_local.dns_seconds = 0.0
+		start = time.perf_counter()
+		try:
+			sock = create_connection(*args, **kwargs)
+		finally:
+			seconds = time.perf_counter() - start
+			dns_seconds = _local.dns_seconds
+			_local.dns_seconds = None
+		observe('dns', dns_seconds)
+		observe('connect', seconds - dns_seconds)
+		_local.connect_seconds = getattr(_local, 'connect_seconds', 0.0) + seconds
+		return sock
+
+	timed_create_connection.instrumented = True
+	socket.getaddrinfo = timed_getaddrinfo
+	connection.create_connection = timed_create_connection
+
+
+def _format_labels(labels):
+	return ','.join(f'{key}="{value}"' for key, value in labels)
+
+
+def _prometheus_text():
+	lines = []
+	with _lock:
+		histograms = {key: list(values) for key, values in _histograms.items()}
+		counters = dict(_counters)
+	pid = ('pid', str(os.getpid()))
+	if histograms:
+		name = f"{PREFIX}_stage_seconds"
+		lines.append(f"# HELP {name} Time spent in each stage of the image tools jobs.")
+		lines.append(f"# TYPE {name} histogram")
+		for (stage, labels), histogram in sorted(histograms.items()):
+			labels = (('stage', stage), pid, *labels)
+			cumulative = 0
+			for bound, bucket in zip((*BUCKETS, '+Inf'), histogram):
+				cumulative += bucket
+				lines.append(f'{name}_bucket{{{_format_labels(labels)},le="{bound}"}} {cumulative}')
+			lines.append(f"{name}_sum{{{_format_labels(labels)}}} {histogram[-1]}")
+			lines.append(f"{name}_count{{{_format_labels(labels)}}} {histogram[-2]}")
+	for counter in sorted({name for name, _ in counters}):
+		name = f"{PREFIX}_{counter}_total"
+		lines.append(f"# TYPE {name} counter")
+		for (counter_name, labels), total in sorted(counters.items()):
+			if counter_name == counter:
+				lines.append(f"{name}{{{_format_labels((pid, *labels))}}} {total:g}")
+	return '\n'.join(lines) + '\n'
+
+
+def flush():
+	"""
+	Append the buffered events to the JSONL stream and rewrite this process's Prometheus textfile.
+	"""
+	global _events
+	if not _enabled:
+		return
+	with _lock:
+		events, _events = _events, []
+	if events:
+		data = ''.join(json.dumps(event) + '\n' for event in events).encode('utf-8')
+		# a single append per flush, so lines from different processes never interleave
+		fd = os.open(os.path.join(_directory, EVENTS_FILE), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+		try:
+			os.write(fd, data)
+		finally:
+			os.close(fd)
+	# write then rename, so a textfile collector never reads half a file
+	prom_file = os.path.join(_directory, f"{PREFIX}_{os.getpid()}.prom")
+	with open(f"{prom_file}.tmp", 'w', encoding='utf-8') as f:
+		f.write(_prometheus_text())
+	os.replace(f"{prom_file}.tmp", prom_file)
+
+
+def _run():
+	while not _stop.wait(FLUSH_INTERVAL):
+		try:
+			flush()
+		except OSError as e:
+			print(f"Problem writing metrics: {e}")
+
+
+def summarize_events(directory):
+	"""
+	Read the events.jsonl in directory and return {stage: {'count', 'sum'}} and {counter: total} across every process.
+	"""
+	stages = defaultdict(lambda: {'count': 0, 'sum': 0.0})
+	counters = defaultdict(float)
+	events_file = os.path.join(directory, EVENTS_FILE)
+	if not os.path.exists(events_file):
+		return {}, {}
+	with open(events_file, encoding='utf-8') as f:
+		for line in f:
+			event = json.loads(line)
+			if 'stage' in event:
+				stages[event['stage']]['count'] += 1
+				stages[event['stage']]['sum'] += event['seconds']
+			else:
+				counters[event['counter']] += event['n']
+	return dict(stages), dict(counters)
+
+
+# worker processes record to the same directory as the process that started them
+if os.getenv(METRICS_ENV):
+	enable(os.getenv(METRICS_ENV))
@@ -0,0 +1,314 @@
+"""
+Pack a dataset into one contiguous file, so training jobs and repeated predictions read one memory-mapped file
+instead of opening hundreds of thousands of small ones. A pack holds either the images' encoded bytes, copied as they
+are, or fixed size uint8 RGB arrays already center cropped and resized to a model's input size, along with an index
+of where each image is and its label, so any image can be read without reading the others.
+
+Layout, little-endian:
+	header   magic, version, kind, image count, index offset, metadata offset
+	data     the images back to back
+	index    (offset, length, label number, 0) for each image
+	metadata json with the label names, the image names, and for arrays the (width, height)
+
+python -m dataset.pack path/to/dataset dataset.pack
+python -m dataset.pack 'Lobe Project Name' project.pack --lobe --size 224x224
+"""
+import argparse
+import json
+import mmap
+import os
+import sqlite3
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from dataset.utils import walk_images, image_label, read_fanout, stop_if_cancelled
+from dataset.progress import Progress, OK, ERROR
+from dataset import metrics, profiling
+
+MAGIC = b'IMGPACK\x00'
+VERSION = 1
+PACK_EXTENSION = '.pack'
+HEADER = struct.Struct('<8sIIQQQ')
+INDEX_ENTRY = struct.Struct('<QQII')
+ENCODED = 0
+ARRAYS = 1
+KINDS = {'encoded': ENCODED, 'arrays': ARRAYS}
+# the images read ahead of the one being written
+READ_AHEAD = 64
+
+
+def is_pack(path):
+	"""
+	Return whether path is a pack file, from its magic bytes.
+	"""
+	try:
+		with open(path, 'rb') as f:
+			return f.read(len(MAGIC)) == MAGIC
+	except OSError:
+		return False
+
+
+class Pack:
+	"""
+	A pack file opened for reading through mmap. Every process maps it once, and the images are read straight from
+	the mapped pages, so the processes of a job share one copy of them in the OS cache.
+
+	:param path: the pack file.
+	"""
+
+	def __init__(self, path):
+		self.path = os.path.abspath(path)
+		with open(self.path, 'rb') as f:
+			self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, self.kind, self.count, self._index_offset, meta_offset = HEADER.unpack_from(self._mmap, 0)
+		if magic != MAGIC:
+			raise ValueError(f"{path} isn't a pack file.")
+		if version != VERSION:
+			raise ValueError(f"{path} is pack version {version}, this reads version {VERSION}.")
+		meta = json.loads(self._mmap[meta_offset:].decode('utf-8'))
+		self.labels = meta['labels']
+		self.names = meta['names']
+		self.size = tuple(meta['size']) if meta.get('size') else None
+
+	def __len__(self):
+		return self.count
+
+	def close(self):
+		self._mmap.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def entry(self, i):
+		"""
+		Return the (offset, length, label) of image i, where label is None for an unlabeled image.
+		"""
+		if not 0 <= i < self.count:
+			raise IndexError(f"Image {i} isn't in a pack of {self.count}")
+		offset, length, label, _ = INDEX_ENTRY.unpack_from(self._mmap, self._index_offset + i * INDEX_ENTRY.size)
+		return offset, length, self.labels[label] if label else None
+
+	def data(self, i):
+		"""
+		Return a memoryview of the bytes of image i in the mapped file, without copying them.
+		"""
+		offset, length, _ = self.entry(i)
+		return memoryview(self._mmap)[offset:offset + length]
+
+	def label(self, i):
+		return self.entry(i)[2]
+
+	def image(self, i, size=None):
+		"""
+		Return image i as a PIL image: decoded, at a reduced resolution for size if given, or made from the array.
+		"""
+		from PIL import Image
+		if self.kind == ARRAYS:
+			return Image.frombuffer('RGB', self.size, self.data(i), 'raw', 'RGB', 0, 1)
+		from model.decode import open_image
+		return open_image(self.data(i), size=size)
+
+	def label_counts(self):
+		"""
+		Return the number of images of each label, read from the index.
+		"""
+		counts = {}
+		for i in range(self.count):
+			label = self.label(i)
+			counts[label] = counts.get(label, 0) + 1
+		return counts
+
+
+# pack file -> Pack, shared by the threads of a process
+_packs = {}
+_packs_lock = Lock()
+
+
+def load_pack(pack_file):
+	"""
+	Return the Pack of a file, opening and mapping it once per process.
+	"""
+	with _packs_lock:
+		pack = _packs.get(pack_file)
+		if pack is None:
+			pack = Pack(pack_file)
+			_packs[pack_file] = pack
+	return pack
+
+
+def write_pack(out_file, items, kind='encoded', size=None, total=None, workers=None, progress_hook=None, cancel_event=None):
+	"""
+	Write a pack from (name, label, read) items, where read() returns the encoded bytes of the image. The images are
+	read in a pool of threads and written in order. Images that can't be read are left out.
+
+	:param out_file: the pack file to write.
+	:param items: an iterable of (name, label, read).
+	:param kind: 'encoded' to store the bytes as they are, or 'arrays' for uint8 RGB arrays of size.
+	:param size: the (width, height) to center crop and resize the images to for 'arrays'.
+	:param total: an optional number of items, for the progress bar.
+	:param workers: an optional number of threads to read the images with.
+	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
+	:param cancel_event: an optional threading.Event that stops the packing when set, leaving no pack file.
+	:return: the number of images packed.
+	"""
+	if kind not in KINDS:
+		raise ValueError(f"Kind {kind} is not one of {list(KINDS)}")
+	if kind == 'arrays' and not size:
+		raise ValueError("Packing arrays needs the size to resize the images to.")
+
+	def load(item):
+		name, label, read = item
+		try:
+			with metrics.timer('pack_read'):
+				data = read()
+			if kind == 'arrays':
+				from model.decode import open_image, center_crop_resize
+				with metrics.timer('preprocess'):
+					data = center_crop_resize(open_image(data, size=size), tuple(size)).tobytes()
+			return name, label, data
+		except Exception as e:
+			print(f"Problem packing image {name}: {e}")
+		return name, label, None
+
+	labels = [None]
+	label_numbers = {}
+	names = []
+	index = []
+	tmp_file = f"{out_file}.tmp"
+	try:
+		with open(tmp_file, 'wb') as f, Progress(total=total or 0, progress_hook=progress_hook) as progress:
+			f.write(HEADER.pack(MAGIC, VERSION, KINDS[kind], 0, 0, 0))
+			offset = HEADER.size
+			with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pack') as executor:
+				for name, label, data in _map_ahead(executor, load, items):
+					stop_if_cancelled(cancel_event)
+					if data is None:
+						progress.update(ERROR)
+						continue
+					if label is not None and label not in label_numbers:
+						label_numbers[label] = len(labels)
+						labels.append(label)
+					with metrics.timer('write'):
+						f.write(data)
+					index.append(INDEX_ENTRY.pack(offset, len(data), label_numbers.get(label, 0), 0))
+					names.append(name)
+					offset += len(data)
+					progress.update(OK)
+			if not total:
+				progress.set_total(progress.done)
+			index_offset = offset
+			f.write(b''.join(index))
+			meta_offset = index_offset + len(index) * INDEX_ENTRY.size
+			meta = {'labels': labels, 'names': names, 'size': list(size) if kind == 'arrays' else None}
+			f.write(json.dumps(meta).encode('utf-8'))
+			f.seek(0)
+			f.write(HEADER.pack(MAGIC, VERSION, KINDS[kind], len(names), index_offset, meta_offset))
+		print(progress.summary())
+		os.replace(tmp_file, out_file)
+	finally:
+		if os.path.exists(tmp_file):
+			os.remove(tmp_file)
+	return len(names)
+
+
+def _map_ahead(executor, fn, items):
+	# executor.map submits every item up front, so keep a bounded window of them in flight instead
+	pending = deque()
+	for item in items:
+		pending.append(executor.submit(fn, item))
+		if len(pending) >= READ_AHEAD:
+			yield pending.popleft().result()
+	for future in pending:
+		yield future.result()
+
+
+def _read_file(path):
+	with open(path, 'rb') as f:
+		return f.read()
+
+
+def pack_folder(directory, out_file, kind='encoded', size=None, workers=None, progress_hook=None, cancel_event=None):
+	"""
+	Pack a dataset folder, with its images' labels from the folders they are in. The images are packed sorted by
+	their relative path, which is their name in the pack.
+
+	See write_pack for the other parameters.
+	"""
+	directory = os.path.abspath(directory)
+	paths = sorted(walk_images(directory))
+	fanout = read_fanout(directory)
+	items = (
+		(os.path.relpath(path, directory).replace(os.sep, '/'), image_label(os.path.relpath(path, directory), fanout),
+		 lambda path=path: _read_file(path))
+		for path in paths
+	)
+	return write_pack(
+		out_file, items, kind=kind, size=size, total=len(paths), workers=workers, progress_hook=progress_hook,
+		cancel_event=cancel_event,
+	)
+
+
+def pack_lobe_project(project_id, out_file, projects_dir=None, kind='encoded', size=None, workers=None, progress_hook=None, cancel_event=None):
+	"""
+	Pack the images and labels of a Lobe project straight from its blobs, without exporting them first. The images
+	are named after their blob hash.
+
+	See write_pack for the other parameters.
+	"""
+	from dataset.export_from_lobe import get_projects_dir, PROJECT_BLOBS, PROJECT_DB_FILE
+	project_dir = os.path.join(get_projects_dir(projects_dir), project_id.replace('-', ''))
+	blob_dir = os.path.join(project_dir, PROJECT_BLOBS)
+	conn = sqlite3.connect(os.path.join(project_dir, PROJECT_DB_FILE))
+	try:
+		rows = conn.execute(
+			"""
+			SELECT example_images.hash, example_labels.label
+			FROM example_images LEFT JOIN example_labels
+			ON example_images.example_id = example_labels.example_id
+			ORDER BY example_images.hash
+			"""
+		).fetchall()
+	finally:
+		conn.close()
+	items = (
+		(img_hash, label, lambda path=os.path.join(blob_dir, img_hash): _read_file(path)) for img_hash, label in rows
+	)
+	return write_pack(
+		out_file, items, kind=kind, size=size, total=len(rows), workers=workers, progress_hook=progress_hook,
+		cancel_event=cancel_event,
+	)
+
+
+def _size_arg(value):
+	# argparse type for WIDTHxHEIGHT, or a single number for a square
+	width, _, height = value.lower().partition('x')
+	return int(width), int(height or width)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Pack a dataset folder or Lobe project into one memory-mappable file.')
+	parser.add_argument('source', help='Path to your dataset folder, or your Lobe project name with --lobe.')
+	parser.add_argument('out', help=f'Path to write the pack to, usually ending in {PACK_EXTENSION}.')
+	parser.add_argument('--lobe', action='store_true', help='Pack a Lobe project instead of a folder.')
+	parser.add_argument('--projects-dir', help='Your Lobe projects directory, for --lobe.')
+	parser.add_argument('--size', type=_size_arg, help='Store the images center cropped and resized to WIDTHxHEIGHT arrays instead of encoded.')
+	parser.add_argument('--metrics', help='Directory to write per-stage timing metrics to.')
+	profiling.add_arguments(parser)
+	args = parser.parse_args()
+	if args.metrics:
+		metrics.enable(args.metrics)
+	kind = 'arrays' if args.size else 'encoded'
+	with profiling.profiled(args.profile, default_dir=os.path.dirname(os.path.abspath(args.out)), modes=args.profile_mode):
+		if args.lobe:
+			from dataset.export_from_lobe import get_projects
+			project_ids = {name: id_ for name, id_ in get_projects(args.projects_dir)}
+			if args.source not in project_ids:
+				raise SystemExit(f"Couldn't find project with name {args.source}.\nAvailable projects: {list(project_ids)}")
+			count = pack_lobe_project(project_ids[args.source], args.out, projects_dir=args.projects_dir, kind=kind, size=args.size)
+		else:
+			count = pack_folder(args.source, args.out, kind=kind, size=args.size)
+	print(f"Packed {count} images into {args.out}")
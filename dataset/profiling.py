@@ -0,0 +1,186 @@
+"""
+A --profile option for the command line scripts: run the job under cProfile, a sampling profiler that sees every
+thread, and tracemalloc, and dump the reports to a directory next to the job's output.
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+MODES = ('cprofile', 'sampling', 'memory')
+SAMPLE_INTERVAL = 0.005
+TOP = 40
+# thread pool threads are named <prefix>_<n>, so strip the number to group them by pool
+POOL_NAME = re.compile(r'^(.*?)(?:_\d+)?$')
+
+
+def add_arguments(parser):
+	parser.add_argument(
+		'--profile', nargs='?', const='', default=None, metavar='DIR',
+		help='Profile the job and write the reports to DIR, or to a profile folder next to the output if no DIR is given.',
+	)
+	parser.add_argument(
+		'--profile-mode', nargs='+', choices=MODES, default=list(MODES), help='Which profilers to run with --profile.',
+	)
+
+
+def _pool_name(thread):
+	if thread is None:
+		return 'unknown'
+	if thread is threading.main_thread():
+		return 'main'
+	return POOL_NAME.match(thread.name).group(1)
+
+
+class SamplingProfiler:
+	"""
+	Sample the stack of every thread at a fixed interval from a background thread. Unlike cProfile, which only sees the
+	thread that started it, this shows where the worker pools spend their wall-clock time.
+	"""
+
+	def __init__(self, interval=SAMPLE_INTERVAL):
+		self.interval = interval
+		self.samples = 0
+		# pool -> number of thread samples
+		self.pool_samples = Counter()
+		# pool -> Counter of the function each thread was in
+		self.pool_leaves = defaultdict(Counter)
+		# collapsed stacks for flame graphs
+		self.stacks = Counter()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+	def start(self):
+		self._start = time.perf_counter()
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+		self.seconds = time.perf_counter() - self._start
+
+	def _run(self):
+		own_id = threading.get_ident()
+		while not self._stop.wait(self.interval):
+			threads = {thread.ident: thread for thread in threading.enumerate()}
+			self.samples += 1
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_id:
+					continue
+				pool = _pool_name(threads.get(thread_id))
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+					frame = frame.f_back
+				self.pool_samples[pool] += 1
+				self.pool_leaves[pool][stack[0]] += 1
+				self.stacks[';'.join([pool, *reversed(stack)])] += 1
+
+	def report(self):
+		# the sampler falls behind its interval when the job holds the GIL, so weight each sample by the real time
+		period = self.seconds / max(self.samples, 1)
+		lines = [f"{self.samples} samples, one every {period * 1000:.1f}ms over {self.seconds:.1f}s", '']
+		lines.append('Thread-seconds by pool (wall-clock time summed over each pool\'s threads):')
+		for pool, count in self.pool_samples.most_common():
+			lines.append(f"  {pool}: {count * period:.2f}s ({count / max(self.samples, 1):.1f} threads on average)")
+		for pool, count in self.pool_samples.most_common():
+			lines.append('')
+			lines.append(f"{pool} -- where its threads were:")
+			for leaf, leaf_count in self.pool_leaves[pool].most_common(15):
+				lines.append(f"  {leaf_count / count:6.1%}  {leaf}")
+		return '\n'.join(lines) + '\n'
+
+	def folded(self):
+		# one "frame;frame;frame count" line per stack, the input format for flamegraph.pl and speedscope
+		return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+@contextmanager
+def profiled(directory, default_dir='.', modes=MODES):
+	"""
+	Run the block under the given profilers and write their reports to directory. Does nothing if directory is None,
+	so the scripts can pass their --profile argument straight through.
+
+	:param directory: the directory to write the reports to, '' for a new profile folder in default_dir, or None.
+	:param default_dir: where the job writes its output.
+	:param modes: which of 'cprofile', 'sampling', and 'memory' to run.
+	"""
+	if directory is None:
+		yield
+		return
+	if not directory:
+		directory = os.path.join(default_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}")
+	directory = os.path.abspath(directory)
+	profiler = cProfile.Profile() if 'cprofile' in modes else None
+	sampler = SamplingProfiler() if 'sampling' in modes else None
+	if 'memory' in modes:
+		tracemalloc.start(25)
+	if sampler:
+		sampler.start()
+	if profiler:
+		profiler.enable()
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		seconds = time.perf_counter() - start
+		if profiler:
+			profiler.disable()
+		if sampler:
+			sampler.stop()
+		os.makedirs(directory, exist_ok=True)
+		# snapshot memory first, so the other reports' allocations aren't in it
+		if 'memory' in modes:
+			_write_memory(directory)
+			tracemalloc.stop()
+		with open(os.path.join(directory, 'summary.txt'), 'w', encoding='utf-8') as f:
+			f.write(f"{' '.join(sys.argv)}\nWall time: {seconds:.2f}s\n")
+		if profiler:
+			_write_cprofile(profiler, directory)
+		if sampler:
+			with open(os.path.join(directory, 'sampling.txt'), 'w', encoding='utf-8') as f:
+				f.write(sampler.report())
+			with open(os.path.join(directory, 'stacks.folded'), 'w', encoding='utf-8') as f:
+				f.write(sampler.folded())
+		print(f"Wrote profile to {directory}")
+
+
+def _write_cprofile(profiler, directory):
+	profiler.dump_stats(os.path.join(directory, 'cprofile.pstats'))
+	out = io.StringIO()
+	stats = pstats.Stats(profiler, stream=out)
+	out.write('Main thread, by cumulative time:\n')
+	stats.sort_stats('cumulative').print_stats(TOP)
+	out.write('\nMain thread, by own time:\n')
+	stats.sort_stats('tottime').print_stats(TOP)
+	with open(os.path.join(directory, 'cprofile.txt'), 'w', encoding='utf-8') as f:
+		f.write(out.getvalue())
+
+
+def _write_memory(directory):
+	current, peak = tracemalloc.get_traced_memory()
+	snapshot = tracemalloc.take_snapshot().filter_traces([
+		tracemalloc.Filter(False, tracemalloc.__file__),
+		tracemalloc.Filter(False, __file__),
+		tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+	])
+	lines = [
+		f"Traced memory: {current / 1024 ** 2:.1f}MB at the end, {peak / 1024 ** 2:.1f}MB peak", '',
+		'Top allocation sites still holding memory at the end:',
+	]
+	for stat in snapshot.statistics('lineno')[:TOP]:
+		lines.append(f"  {stat.size / 1024:10.1f}KB  {stat.count:8d} blocks  {stat.traceback[0]}")
+	lines += ['', 'Top allocation tracebacks:']
+	for stat in snapshot.statistics('traceback')[:10]:
+		lines.append(f"  {stat.size / 1024:.1f}KB in {stat.count} blocks")
+		lines += [f"    {line}" for line in stat.traceback.format(limit=8)]
+	with open(os.path.join(directory, 'memory.txt'), 'w', encoding='utf-8') as f:
+		f.write('\n'.join(lines) + '\n')
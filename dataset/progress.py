@@ -0,0 +1,107 @@
+"""
+Aggregated progress reporting for the dataset and model jobs
+"""
+import time
+from collections import Counter
+from threading import Event, Lock, Thread
+from tqdm import tqdm
+
+OK = 'ok'
+ERROR = 'error'
+DUPLICATE = 'duplicate'
+SKIPPED = 'skipped'
+
+
+class Progress:
+	"""
+	Count finished items by outcome and report them at a fixed rate, instead of on every item. Updates only
+	take a lock and bump a counter -- the progress bar and progress_hook are driven from a background reporter
+	thread, so a slow hook never blocks the threads doing the work.
+
+	:param total: the number of items expected, which can grow or shrink with set_total while the job runs.
+	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
+	:param interval: the seconds between reports.
+	"""
+
+	def __init__(self, total=0, progress_hook=None, interval=0.2):
+		self.total = total
+		self.progress_hook = progress_hook
+		self.interval = interval
+		self.counts = Counter()
+		self.done = 0
+		self._lock = Lock()
+		self._stop = Event()
+		self._reported = None
+		self._start = time.perf_counter()
+		self._pbar = tqdm(total=total)
+		self._thread = Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def update(self, outcome=OK, n=1):
+		with self._lock:
+			self.counts[outcome] += n
+			self.done += n
+
+	def set_total(self, total):
+		with self._lock:
+			self.total = total
+
+	def add_total(self, n=1):
+		with self._lock:
+			self.total += n
+
+	@property
+	def elapsed(self):
+		return time.perf_counter() - self._start
+
+	@property
+	def rate(self):
+		# items per second
+		elapsed = self.elapsed
+		return self.done / elapsed if elapsed > 0 else 0.0
+
+	@property
+	def eta(self):
+		# seconds left, or None if we can't tell yet
+		rate = self.rate
+		if not rate or self.total < self.done:
+			return None
+		return (self.total - self.done) / rate
+
+	def snapshot(self):
+		with self._lock:
+			done, total, counts = self.done, self.total, dict(self.counts)
+		return {'done': done, 'total': total, 'rate': self.rate, 'eta': self.eta, 'counts': counts}
+
+	def summary(self):
+		counts = ' | '.join(f"{outcome}: {count}" for outcome, count in sorted(self.counts.items()))
+		return f"{self.done} items in {self.elapsed:.1f}s ({self.rate:.1f}/s) | {counts}"
+
+	def _report(self):
+		with self._lock:
+			done, total = self.done, self.total
+			counts = dict(self.counts)
+		if (done, total) == self._reported:
+			return
+		self._pbar.total = total
+		self._pbar.set_postfix(counts, refresh=False)
+		self._pbar.update(done - self._pbar.n)
+		if self.progress_hook and total:
+			self.progress_hook(done, total)
+		self._reported = (done, total)
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			self._report()
+
+	def close(self):
+		self._stop.set()
+		self._thread.join()
+		self._report()
+		self._pbar.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
@@ -1,48 +1,232 @@
 """
 Generic download of image files from URLs
 """
+import hashlib
 import os
+import shutil
+import time
 from pathlib import Path
-import requests
+from queue import Queue
+from urllib.parse import urlparse, urlunparse
+from urllib.request import url2pathname
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+from dataset import metrics
 
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff'}
+# the fan-out layout spreads the images of a label over levels of hash-prefix folders, like label/ab/cd/image.jpg,
+# so no folder gets big enough to slow down listing it or checking for a file in it
+FANOUT_WIDTH = 2
+MAX_FANOUT = 3
+# the file in a dataset folder recording its fan-out, so the labels are read back from the right level
+FANOUT_FILE = '.fanout'
+_HEX = set('0123456789abcdef')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# the linux ioctl that clones a file's extents on copy-on-write filesystems like btrfs and xfs
+FICLONE = 0x40049409
 
-def download_image(url, directory, lock, label=None):
+
+def local_path(url):
+	"""
+	Return the file path of a file:// URL or of a plain local path, or None for a remote or malformed URL.
+	"""
+	if not isinstance(url, str):
+		return None
+	url = url.strip()
+	try:
+		parsed = urlparse(url)
+	except ValueError:
+		# like an unclosed ipv6 bracket -- left for the download to fail on
+		return None
+	if parsed.scheme == 'file':
+		path = url2pathname(parsed.path)
+		# file://server/share/image.jpg is a network share
+		if parsed.netloc and parsed.netloc != 'localhost':
+			path = f"//{parsed.netloc}{path}"
+		return path
+	# a windows drive letter parses as a one letter scheme
+	if url and (not parsed.scheme or len(parsed.scheme) == 1):
+		return url
+	return None
+
+
+def normalize_url(url):
+	"""
+	Return a canonical form of an image url, so the same image written differently is only fetched once: the scheme
+	and host are lowercased, default ports and fragments are dropped, and local paths and file:// urls become absolute
+	paths. Returns None for a value that isn't a url, or a malformed one, like with a port out of range, so it is
+	fetched as it is and fails there like any other bad url.
+	"""
+	if not isinstance(url, str) or not url.strip():
+		return None
+	source = local_path(url)
+	if source is not None:
+		return os.path.normcase(os.path.abspath(source))
+	try:
+		parsed = urlparse(url.strip())
+		port = parsed.port
+	except ValueError:
+		return None
+	scheme = parsed.scheme.lower()
+	host = (parsed.hostname or '').lower()
+	if ':' in host:
+		# an ipv6 address
+		host = f"[{host}]"
+	if port and port != DEFAULT_PORTS.get(scheme):
+		host = f"{host}:{port}"
+	if parsed.username or parsed.password:
+		host = f"{parsed.netloc.rsplit('@', 1)[0]}@{host}"
+	return urlunparse((scheme, host, parsed.path or '/', parsed.params, parsed.query, ''))
+
+
+def download_image(url, directory, lock, label=None, catalog=None, fanout=0, hardlink=True):
+	# local files and file:// urls are linked or copied in instead of going through http
+	source = local_path(url)
+	if source is not None:
+		return ingest_image(source, directory, lock, label=label, catalog=catalog, fanout=fanout, hardlink=hardlink)
+	# requests is slow to import, so the app only pays for it once a download starts
+	import requests
 	filepath = None
+	error = None
 	try:
 		# get our image save location
 		save_dir = os.path.abspath(directory)
 		if label is not None:
 			save_dir = os.path.join(save_dir, label)
-		# make our destination directory if it doesn't exist
-		Path(save_dir).mkdir(parents=True, exist_ok=True)
 		with lock:
-			img_file = _get_filepath(url=url, save_dir=save_dir)
-		response = requests.get(url, timeout=30)
-		if response.ok:
-			# save the image!
-			with open(img_file, 'wb') as f:
-				f.write(response.content)
-			filepath = os.path.abspath(img_file)
-			success = True
-		else:
-			success = False
-	except Exception:
+			img_file = _get_filepath(url=url, save_dir=save_dir, fanout=fanout)
+		start = time.perf_counter()
+		# stream so the time to the headers and the time reading the body are measured separately
+		with requests.get(url, timeout=30, stream=True) as response:
+			# the dns and connect time are recorded on their own, so leave them out of the time to first byte
+			metrics.observe('ttfb', time.perf_counter() - start - metrics.take_connect_seconds())
+			if response.ok:
+				with metrics.timer('body'):
+					content = response.content
+				# save the image!
+				with metrics.timer('write'):
+					with open(img_file, 'wb') as f:
+						f.write(content)
+				metrics.count('download_bytes', len(content))
+				filepath = os.path.abspath(img_file)
+				success = True
+			else:
+				error = f"HTTP {response.status_code}"
+				success = False
+	except Exception as e:
+		error = str(e)
 		success = False
+	metrics.count('downloads', outcome='ok' if success else 'error')
 	if not success:
 		# with failure, also delete any bit of the temp file we made
 		try:
 			os.remove(img_file)
 		except Exception:
 			pass
+	# record the image, or the failure, in the dataset catalog if the job keeps one
+	if catalog is not None:
+		if success:
+			catalog.add_file(filepath, label=label, source_url=url)
+		else:
+			catalog.add_error(url, label=label, error=error)
+	return filepath
+
+
+def ingest_image(path, directory, lock, label=None, catalog=None, fanout=0, hardlink=True, source_url=None):
+	"""
+	Add a local image file to a dataset folder the way download_image adds a downloaded one, without copying its
+	bytes through Python: see place_file. Returns the path of the new file, or None if it couldn't be added.
+
+	:param hardlink: a flag for whether the dataset file can be a hardlink to the original, sharing its contents.
+		Otherwise it is a copy-on-write clone or a copy.
+	:param source_url: the url to record in the catalog, defaults to the file:// url of path.
+	"""
+	filepath = None
+	error = None
+	path = os.path.abspath(path)
+	try:
+		if not os.path.isfile(path):
+			raise FileNotFoundError(f"No file {path}")
+		save_dir = os.path.abspath(directory)
+		if label is not None:
+			save_dir = os.path.join(save_dir, label)
+		with lock:
+			img_file = _get_filepath(url=path, save_dir=save_dir, fanout=fanout, filename=os.path.basename(path))
+		with metrics.timer('ingest'):
+			method = place_file(path, img_file, hardlink=hardlink)
+		metrics.count('ingests', method=method)
+		filepath = img_file
+	except Exception as e:
+		error = str(e)
+		metrics.count('ingests', method='error')
+		try:
+			os.remove(img_file)
+		except Exception:
+			pass
+	if catalog is not None:
+		source_url = source_url or Path(path).as_uri()
+		if filepath:
+			catalog.add_file(filepath, label=label, source_url=source_url)
+		else:
+			catalog.add_error(source_url, label=label, error=error)
 	return filepath
 
 
-def _get_filepath(url, save_dir):
+def place_file(src, dest, hardlink=True):
+	"""
+	Make dest the same file as src with as little copying as the filesystem allows: a hardlink, then a copy-on-write
+	clone (reflink), then copy_file_range, which copies inside the kernel, and a plain copy last. dest may be an
+	empty placeholder, which is replaced. Returns the method used.
+	"""
+	if hardlink:
+		# link to a temporary name and rename over the placeholder, so the name is never free for another file
+		tmp = f"{dest}.tmp"
+		try:
+			os.link(src, tmp)
+			os.replace(tmp, dest)
+			return 'hardlink'
+		except OSError:
+			try:
+				os.remove(tmp)
+			except OSError:
+				pass
+	with open(src, 'rb') as src_f, open(dest, 'wb') as dest_f:
+		try:
+			import fcntl
+			fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+			return 'reflink'
+		except (ImportError, OSError):
+			pass
+		if hasattr(os, 'copy_file_range'):
+			try:
+				size = os.fstat(src_f.fileno()).st_size
+				copied = 0
+				while copied < size:
+					n = os.copy_file_range(src_f.fileno(), dest_f.fileno(), size - copied)
+					if n == 0:
+						break
+					copied += n
+				if copied == size:
+					return 'copy_file_range'
+			except OSError:
+				pass
+			src_f.seek(0)
+			dest_f.seek(0)
+			dest_f.truncate()
+		shutil.copyfileobj(src_f, dest_f)
+	return 'copy'
+
+
+def _get_filepath(url, save_dir, fanout=0, filename=None):
 	# given a url and download folder, return the full filepath to image to save
-	# get the name from the last url segment
-	filename = str(url.split('/')[-1])
-	# strip out url params from name
-	filename = filename.split('?')[0]
+	if filename is None:
+		# get the name from the last url segment
+		filename = str(url.split('/')[-1])
+		# strip out url params from name
+		filename = filename.split('?')[0]
+	save_dir = fanout_dir(save_dir, filename, fanout)
+	# make our destination directory if it doesn't exist
+	Path(save_dir).mkdir(parents=True, exist_ok=True)
 	# if this file already exists in the path, increment its name
 	# (since different URLs can have the same end filename)
 	filename = _resolve_filename_conflict(directory=save_dir, filename=filename)
@@ -53,9 +237,12 @@ def _get_filepath(url, save_dir):
 	return filename
 
 
-def _resolve_filename_conflict(directory, filename, sep="__"):
-	# if this file already exists in the path, increment its name
-	while os.path.exists(os.path.join(directory, filename)):
+def _resolve_filename_conflict(directory, filename, sep="__", taken=None):
+	# if this file already exists in the path, or is in taken, the set of names known to be there, increment its name
+	def exists(name):
+		return name in taken if taken is not None else os.path.exists(os.path.join(directory, name))
+
+	while exists(filename):
 		name, extension = os.path.splitext(filename)
 		name_parts = name.rsplit(sep, 1)
 		base_name = name_parts[0]
@@ -68,3 +255,167 @@ def _resolve_filename_conflict(directory, filename, sep="__"):
 				base_name = sep.join(name_parts)
 		filename = f"{base_name}{sep}{counter}{extension}"
 	return filename
+
+
+def fanout_dir(directory, filename, levels=0):
+	"""
+	Return the folder under directory that filename goes in with a fan-out of levels hash-prefix folders, or directory
+	itself for no fan-out. The hash is of the name, so files with the same name land in the same folder and their
+	name conflicts are found and resolved there as usual.
+	"""
+	if not levels:
+		return directory
+	if not 0 < levels <= MAX_FANOUT:
+		raise ValueError(f"Fan-out must be between 0 and {MAX_FANOUT} levels, found {levels}")
+	digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+	return os.path.join(directory, *(digest[i * FANOUT_WIDTH:(i + 1) * FANOUT_WIDTH] for i in range(levels)))
+
+
+def is_fanout_dir(name):
+	return len(name) == FANOUT_WIDTH and set(name) <= _HEX
+
+
+def in_fanout(path, directory, levels):
+	"""
+	Return whether a file is in one of the fan-out folders of directory, levels deep. A file renamed on a conflict is
+	in the folder of its original name, so it counts as in place wherever its hash-prefix folders are.
+	"""
+	parts = os.path.relpath(os.path.dirname(os.path.abspath(path)), directory).split(os.sep)
+	return bool(levels) and len(parts) == levels and all(is_fanout_dir(part) for part in parts)
+
+
+def read_fanout(directory):
+	"""
+	Return the fan-out levels recorded in a dataset folder, or 0 if it has none.
+	"""
+	try:
+		with open(os.path.join(directory, FANOUT_FILE), 'r') as f:
+			return int(f.read().strip())
+	except (OSError, ValueError):
+		return 0
+
+
+def mark_fanout(directory, levels):
+	"""
+	Record that a dataset folder's images are spread over levels of fan-out folders. A folder only has one fan-out,
+	since its images' labels are read back by stripping that many folders. Returns whether the marker file was made.
+	"""
+	if not levels:
+		return False
+	if not 0 < levels <= MAX_FANOUT:
+		raise ValueError(f"Fan-out must be between 0 and {MAX_FANOUT} levels, found {levels}")
+	current = read_fanout(directory)
+	if current and current != levels:
+		raise ValueError(f"{directory} already has a fan-out of {current} levels, found {levels}")
+	if current:
+		return False
+	os.makedirs(directory, exist_ok=True)
+	with open(os.path.join(directory, FANOUT_FILE), 'w') as f:
+		f.write(str(levels))
+	return True
+
+
+def image_label(relative_path, fanout=0):
+	"""
+	Return the label of an image from its path relative to the dataset folder: the top folder it is in, or None for
+	images at the top of the dataset, including the ones in its fan-out folders.
+
+	:param relative_path: the image's path relative to the dataset folder.
+	:param fanout: the dataset's fan-out levels, from read_fanout.
+	"""
+	parts = relative_path.replace(os.sep, '/').split('/')
+	if len(parts) < 2:
+		return None
+	# an unlabeled image in the fan-out is exactly that many hash-prefix folders deep
+	if fanout and len(parts) == fanout + 1 and all(is_fanout_dir(part) for part in parts[:-1]):
+		return None
+	return parts[0]
+
+
+def is_image_file(path):
+	# cheap check of the file's magic bytes so misnamed or non-image files never make it to the model
+	try:
+		with open(path, 'rb') as f:
+			header = f.read(12)
+	except OSError:
+		return False
+	return (
+		header[:3] == b'\xff\xd8\xff'  # jpeg
+		or header[:8] == b'\x89PNG\r\n\x1a\n'
+		or header[:6] in (b'GIF87a', b'GIF89a')
+		or header[:2] == b'BM'
+		or header[:4] in (b'II*\x00', b'MM\x00*')  # tiff
+		or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')
+	)
+
+
+# markers the directory scanning workers put on the results queue
+_SUBDIR = object()
+_SCANNED = object()
+
+
+def walk_images(directory, workers=None, check_magic=True):
+	"""
+	Stream the image files in a directory and all of its subdirectories, yielding absolute paths as they are found.
+	Directories are scanned in parallel with os.scandir, so the first images are available right away
+	instead of after the whole tree has been listed.
+
+	:param directory: the directory to walk.
+	:param workers: an optional number of threads used to scan directories.
+	:param check_magic: a flag for whether to also check the file header bytes, not just the extension.
+	"""
+	directory = os.path.abspath(directory)
+	results = Queue()
+	stop = Event()
+
+	def scan(path):
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					if stop.is_set():
+						break
+					try:
+						if entry.is_dir(follow_symlinks=False):
+							results.put((_SUBDIR, entry.path))
+						elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+							if not check_magic or is_image_file(entry.path):
+								results.put((None, entry.path))
+					except OSError:
+						pass
+		except OSError:
+			pass
+		finally:
+			results.put((_SCANNED, path))
+
+	executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='walk')
+	try:
+		executor.submit(scan, directory)
+		pending_dirs = 1
+		# subdirectories are reported before their parent finishes, so this reaches 0 only when the walk is done
+		while pending_dirs:
+			marker, path = results.get()
+			if marker is _SUBDIR:
+				pending_dirs += 1
+				executor.submit(scan, path)
+			elif marker is _SCANNED:
+				pending_dirs -= 1
+			else:
+				yield path
+	finally:
+		stop.set()
+		executor.shutdown(wait=False)
+
+
+class JobCancelled(Exception):
+	"""
+	Raised by a long running job when it is stopped through its cancel_event.
+	"""
+	pass
+
+
+def stop_if_cancelled(cancel_event, futures=()):
+	# cooperative cancellation: drop any work that hasn't started yet and stop the job
+	if cancel_event is not None and cancel_event.is_set():
+		for future in futures:
+			future.cancel()
+		raise JobCancelled()
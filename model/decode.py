@@ -0,0 +1,64 @@
+"""
+Image decoding for the prediction pipeline. The model only sees a center crop resized to its input size (224x224 for
+most Lobe exports), so decoding every pixel of a 12MP photo is wasted work. JPEGs are decoded with DCT scaling
+(Pillow's draft mode) straight to the smallest power of two reduction that still covers the input size, and other
+formats are box-reduced by a whole factor, before the model's own resize. EXIF orientation is applied, so photos
+taken on their side are predicted upright.
+
+Set the IMAGE_TOOLS_FULL_DECODE environment variable to 1 to always decode at full resolution.
+"""
+import io
+import os
+
+FULL_DECODE_ENV = 'IMAGE_TOOLS_FULL_DECODE'
+ORIENTATION_TAG = 0x0112
+# the modes Image.reduce supports
+REDUCE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'I', 'F')
+
+
+def full_decode():
+	return os.getenv(FULL_DECODE_ENV, '') not in ('', '0')
+
+
+def open_image(source, size=None, reduce=None):
+	"""
+	Open and decode an image, upright and no smaller than needed to center crop and resize it to size.
+
+	:param source: a path, file object, or the bytes of an image.
+	:param size: the (width, height) the image will be resized to, or None to decode at full resolution.
+	:param reduce: a flag for whether to decode at a reduced resolution, defaults to on unless IMAGE_TOOLS_FULL_DECODE is set.
+	"""
+	from PIL import Image, ImageOps
+	if isinstance(source, (bytes, bytearray, memoryview)):
+		source = io.BytesIO(source)
+	image = Image.open(source)
+	if reduce is None:
+		reduce = not full_decode()
+	# the center crop is a square the size of the shorter side, which has to cover the longer side of the input
+	side = max(size) if size else None
+	if reduce and side:
+		if image.format == 'JPEG':
+			# draft picks the largest 1/2, 1/4, or 1/8 scale that keeps both sides at least this big
+			image.draft(image.mode, (side, side))
+			image.load()
+		else:
+			image.load()
+			factor = min(image.size) // side
+			if factor >= 2 and image.mode in REDUCE_MODES:
+				image = image.reduce(factor)
+	else:
+		image.load()
+	if image.getexif().get(ORIENTATION_TAG, 1) != 1:
+		# applies and clears the orientation tag, so the model's preprocessing doesn't rotate it again
+		image = ImageOps.exif_transpose(image)
+	return image
+
+
+def center_crop_resize(image, size):
+	"""
+	The same center crop and resize to the model's input size that lobe does before handing the pixels to the model.
+	"""
+	width, height = image.size
+	side = min(width, height)
+	left, top = (width - side) // 2, (height - side) // 2
+	return image.convert('RGB').crop((left, top, left + side, top + side)).resize(size)
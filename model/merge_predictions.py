@@ -0,0 +1,134 @@
+"""
+Merge the per-shard prediction csvs from model.predict_from_file or model.predict_from_folder with --shard
+into one output in the original row order, checking that every row was predicted exactly once.
+"""
+import argparse
+import os
+from contextlib import contextmanager
+from itertools import chain
+from csv import reader as csv_reader, writer as csv_writer
+from model.shard import SHARD_FILE_PATTERN, path_key
+from dataset import columnar, profiling
+
+ROW_COL = 'row'
+
+
+def merge_predictions(shard_files, out_file, expected_rows=None, base_dir=None):
+	"""
+	Combine shard prediction csvs into a single csv without the shard row column, sorted by the original row.
+
+	:param shard_files: the list of shard csv or parquet paths to merge.
+	:param out_file: the path to write the merged csv to, or a .parquet path to write parquet.
+	:param expected_rows: an optional collection of every row key that should be covered -- row numbers for a url file,
+		or relative image paths for a folder. Row numbers are always checked for gaps.
+	:param base_dir: for folder predictions, an optional directory to rebase the File column on, in case the folder
+		is mounted somewhere else on this machine.
+	"""
+	_check_shard_set(shard_files)
+	header = None
+	rows = {}
+	for shard_file in shard_files:
+		with _read_shard(shard_file) as reader:
+			shard_header = next(reader, None)
+			if not shard_header or shard_header[0] != ROW_COL:
+				raise ValueError(f"{shard_file} isn't a shard prediction file, it has no '{ROW_COL}' column.")
+			if header is None:
+				header = shard_header
+			elif shard_header != header:
+				raise ValueError(f"{shard_file} has headers {shard_header}, expected {header}")
+			for row in reader:
+				key = row[0]
+				if key in rows:
+					raise ValueError(f"Row {key} is in more than one shard file.")
+				if base_dir:
+					row[1] = os.path.join(base_dir, key)
+				rows[key] = row[1:]
+
+	numeric = all(key.isdigit() for key in rows)
+	if numeric:
+		order = sorted(rows, key=int)
+		if expected_rows is None and order:
+			expected_rows = range(int(order[-1]) + 1)
+	else:
+		order = sorted(rows)
+	if expected_rows is not None:
+		missing = [key for key in map(str, expected_rows) if key not in rows]
+		if missing:
+			raise ValueError(f"{len(missing)} rows are missing from the shard files, starting with {missing[:5]}")
+		if len(rows) > len(expected_rows):
+			print(f"Warning: the shard files have {len(rows)} rows, expected {len(expected_rows)}.")
+
+	if columnar.is_columnar(out_file):
+		# confidence, or confidence_<model> for each model when several were compared
+		float_columns = [name for name in header[1:] if name.lower() == 'confidence' or name.lower().startswith('confidence_')]
+		writer = columnar.ParquetRowWriter(out_file, header[1:], float_columns=float_columns)
+		writer.writerows(rows[key] for key in order)
+		writer.close()
+	else:
+		with open(out_file, 'w', encoding="utf-8", newline='') as f:
+			writer = csv_writer(f)
+			writer.writerow(header[1:])
+			writer.writerows(rows[key] for key in order)
+	print(f"Merged {len(rows)} rows from {len(shard_files)} shards into {out_file}")
+
+
+@contextmanager
+def _read_shard(shard_file):
+	# an iterator of the header and then each row of a shard, as lists of strings
+	if columnar.is_columnar(shard_file):
+		header = columnar.read_headers(shard_file)
+		rows = (['' if value is None else str(value) for value in row] for row in columnar.iter_rows(shard_file))
+		yield chain([header], rows)
+		return
+	with open(shard_file, 'r', encoding="utf-8", newline='') as f:
+		yield csv_reader(f)
+
+
+def _check_shard_set(shard_files):
+	# when the files are named by shard, make sure we have exactly one of each
+	specs = [SHARD_FILE_PATTERN.search(os.path.basename(shard_file)) for shard_file in shard_files]
+	if not all(specs):
+		return
+	counts = {int(spec.group(2)) for spec in specs}
+	if len(counts) > 1:
+		raise ValueError(f"The shard files come from different shard counts: {sorted(counts)}")
+	count = counts.pop()
+	indexes = sorted(int(spec.group(1)) for spec in specs)
+	if indexes != list(range(count)):
+		missing = sorted(set(range(count)) - set(indexes))
+		raise ValueError(f"Expected one file for each of {count} shards. Missing shards: {missing}")
+
+
+def _expected_rows_from_input(filepath):
+	# the row numbers of the original url file
+	from dataset.introspect import inspect_file, iter_rows
+	info = inspect_file(filepath)
+	if info.exact:
+		return range(info.rows)
+	return range(sum(1 for _ in iter_rows(filepath, columns=[0])))
+
+
+def _expected_rows_from_folder(img_dir):
+	# the relative paths of every image in the original folder
+	from dataset.utils import walk_images
+	return {path_key(path, img_dir) for path in walk_images(img_dir)}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Merge sharded prediction csvs into one output.')
+	parser.add_argument('out', help='Path to write the merged csv to, or a .parquet path to write parquet.')
+	parser.add_argument('shards', nargs='+', help='The shard prediction csv or parquet files.')
+	parser.add_argument('--input', help='The original url file, to check that every row was predicted.')
+	parser.add_argument('--dir', help='The original image folder, to check every image was predicted and rebase the file paths.')
+	profiling.add_arguments(parser)
+	args = parser.parse_args()
+	with profiling.profiled(args.profile, default_dir=os.path.dirname(os.path.abspath(args.out)), modes=args.profile_mode):
+		expected = None
+		if args.input:
+			expected = _expected_rows_from_input(args.input)
+		elif args.dir:
+			expected = _expected_rows_from_folder(os.path.abspath(args.dir))
+		merge_predictions(
+			shard_files=args.shards, out_file=args.out, expected_rows=expected,
+			base_dir=os.path.abspath(args.dir) if args.dir else None,
+		)
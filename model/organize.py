@@ -0,0 +1,200 @@
+"""
+Apply a prediction plan to a folder of images: move, hardlink, or symlink each image into a subdirectory named
+after its predicted label. Every change is recorded in an undo log so the reorganization can be reversed.
+"""
+import argparse
+import os
+from csv import reader as csv_reader, writer as csv_writer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataset.progress import Progress, OK, ERROR
+from dataset.utils import fanout_dir, in_fanout, mark_fanout, _resolve_filename_conflict, FANOUT_FILE
+from dataset import metrics, profiling
+
+PLAN_HEADER = ['File', 'Label', 'Confidence']
+UNDO_HEADER = ['Mode', 'Source', 'Destination']
+MODES = ('move', 'hardlink', 'symlink')
+# the undo log mode for the fan-out marker apply_plan made, removed once the files are back
+MARKER = 'marker'
+
+
+def read_plan(plan_file):
+	"""
+	Yield the (file, label, confidence) rows of a plan csv.
+	"""
+	with open(plan_file, 'r', encoding="utf-8", newline='') as f:
+		reader = csv_reader(f)
+		next(reader, None)  # header
+		for row in reader:
+			if len(row) >= 2 and row[1]:
+				yield row[0], row[1], row[2] if len(row) > 2 else ''
+
+
+def plan_destinations(plan_rows, dest_root, fanout=0):
+	"""
+	Given the (file, label, confidence) plan rows, return a list of (file, destination, label, confidence).
+	Each label directory is listed once and filename conflicts are resolved in memory, instead of checking
+	the filesystem for every file, with the same name__N suffixes as the downloads. The destination is the file itself
+	if it is already in the right folder. With a fanout, the destinations are spread over that many levels of
+	hash-prefix folders in each label directory, and files already somewhere in their label's fan-out stay there.
+	"""
+	dest_root = os.path.abspath(dest_root)
+	taken = {}
+	ops = []
+	for img_file, label, confidence in plan_rows:
+		img_file = os.path.abspath(img_file)
+		filename = os.path.basename(img_file)
+		label_dir = os.path.join(dest_root, label)
+		dest_dir = fanout_dir(label_dir, filename, fanout)
+		if os.path.dirname(img_file) == dest_dir or in_fanout(img_file, label_dir, fanout):
+			ops.append((img_file, img_file, label, confidence))
+			continue
+		names = taken.get(dest_dir)
+		if names is None:
+			try:
+				names = set(os.listdir(dest_dir))
+			except OSError:
+				names = set()
+			taken[dest_dir] = names
+		# rename the file if there is a conflict
+		filename = _resolve_filename_conflict(dest_dir, filename, taken=names)
+		names.add(filename)
+		ops.append((img_file, os.path.join(dest_dir, filename), label, confidence))
+	return ops
+
+
+def _apply_op(src, dest, mode):
+	with metrics.timer('organize', mode=mode):
+		_place(src, dest, mode)
+
+
+def _place(src, dest, mode):
+	if mode == 'move':
+		# os.rename fails across devices instead of silently copying like shutil.move
+		os.rename(src, dest)
+	elif mode == 'hardlink':
+		os.link(src, dest)
+	else:
+		os.symlink(src, dest)
+
+
+def apply_plan(
+		plan_file, dest_root, mode='move', dry_run=False, undo_log=None, workers=None, progress_hook=None, fanout=0
+):
+	"""
+	Reorganize the images listed in a plan csv into label subdirectories of dest_root.
+
+	:param plan_file: path to a csv with File, Label, Confidence columns.
+	:param dest_root: the directory to create the label subdirectories in.
+	:param mode: one of 'move', 'hardlink', or 'symlink'.
+	:param dry_run: a flag for whether to only report what would happen without touching any files.
+	:param undo_log: an optional csv path to record every change to, so it can be reversed with undo_plan.
+	:param workers: an optional number of threads used to apply the changes.
+	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
+	:param fanout: an optional number of levels of hash-prefix folders to spread each label directory over.
+	:return: list of (file, destination, label, confidence), where destination is the file itself if it wasn't changed.
+	"""
+	if mode not in MODES:
+		raise ValueError(f"Mode {mode} is not one of {MODES}")
+	ops = plan_destinations(read_plan(plan_file), dest_root, fanout=fanout)
+	changes = [(src, dest) for src, dest, _, _ in ops if src != dest]
+	if dry_run:
+		print(f"Dry run: would {mode} {len(changes)} of {len(ops)} files into {dest_root}")
+		for src, dest in changes[:10]:
+			print(f"  {src} -> {dest}")
+		return ops
+
+	marked = mark_fanout(dest_root, fanout)
+	# make all of our label directories up front
+	for dest_dir in {os.path.dirname(dest) for _, dest in changes}:
+		os.makedirs(dest_dir, exist_ok=True)
+
+	failed = set()
+	undo_f = open(undo_log, 'w', encoding="utf-8", newline='') if undo_log else None
+	try:
+		undo_writer = None
+		if undo_f:
+			undo_writer = csv_writer(undo_f)
+			undo_writer.writerow(UNDO_HEADER)
+			if marked:
+				undo_writer.writerow([MARKER, '', os.path.join(dest_root, FANOUT_FILE)])
+		with Progress(total=len(changes), progress_hook=progress_hook) as progress:
+			with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='organize') as executor:
+				futures = {executor.submit(_apply_op, src, dest, mode): (src, dest) for src, dest in changes}
+				for future in as_completed(futures):
+					src, dest = futures[future]
+					try:
+						future.result()
+						if undo_writer:
+							undo_writer.writerow([mode, src, dest])
+						progress.update(OK)
+					except Exception as e:
+						failed.add(src)
+						print(f"Problem with {mode} of {src}: {e}")
+						progress.update(ERROR)
+	finally:
+		if undo_f:
+			undo_f.close()
+	if failed:
+		print(f"Couldn't {mode} {len(failed)} files.")
+	# files we couldn't change stay where they were
+	return [(src, src if src in failed else dest, label, confidence) for src, dest, label, confidence in ops]
+
+
+def undo_plan(undo_log, workers=None):
+	"""
+	Reverse the changes recorded in an undo log from apply_plan, including the fan-out marker it made.
+	"""
+	with open(undo_log, 'r', encoding="utf-8", newline='') as f:
+		reader = csv_reader(f)
+		next(reader, None)  # header
+		entries = [row for row in reader if len(row) == 3]
+	markers = [dest for mode, _, dest in entries if mode == MARKER]
+	entries = [entry for entry in entries if entry[0] != MARKER]
+
+	def undo_op(mode, src, dest):
+		if mode == 'move':
+			os.makedirs(os.path.dirname(src), exist_ok=True)
+			os.rename(dest, src)
+		else:
+			os.remove(dest)
+
+	with Progress(total=len(entries)) as progress:
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='undo') as executor:
+			futures = {executor.submit(undo_op, *entry): entry for entry in entries}
+			for future in as_completed(futures):
+				try:
+					future.result()
+					progress.update(OK)
+				except Exception as e:
+					print(f"Problem undoing {futures[future]}: {e}")
+					progress.update(ERROR)
+	# the folder is only read as fanned out once the files are back where they were
+	for marker in markers:
+		try:
+			os.remove(marker)
+		except FileNotFoundError:
+			pass
+	print(f"Undid {progress.counts[OK]} of {len(entries)} changes.")
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Organize images into label folders from a prediction plan.')
+	parser.add_argument('plan', help='Path to your plan csv, or to an undo log with --undo.')
+	parser.add_argument('dest', nargs='?', help='Directory to create the label folders in.')
+	parser.add_argument('--mode', choices=MODES, default='move', help='How to place the images in the label folders.')
+	parser.add_argument('--dry-run', action='store_true', help='Only report what would change.')
+	parser.add_argument('--undo-log', help='Path to write the undo log to.')
+	parser.add_argument('--fanout', type=int, default=0, help='Levels of hash-prefix folders to spread each label over.')
+	parser.add_argument('--undo', action='store_true', help='Reverse the changes recorded in the given undo log.')
+	profiling.add_arguments(parser)
+	args = parser.parse_args()
+	if not args.undo and not args.dest:
+		parser.error('the dest directory is required unless using --undo')
+	with profiling.profiled(args.profile, default_dir=os.path.dirname(os.path.abspath(args.plan)), modes=args.profile_mode):
+		if args.undo:
+			undo_plan(undo_log=args.plan)
+		else:
+			apply_plan(
+				plan_file=args.plan, dest_root=args.dest, mode=args.mode, dry_run=args.dry_run,
+				undo_log=args.undo_log or os.path.join(args.dest, 'organize_undo.csv'), fanout=args.fanout,
+			)
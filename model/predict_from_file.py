@@ -5,83 +5,149 @@ and write the predicted label and confidence back to the file
 import argparse
 import os
 import pandas as pd
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain, islice
 from csv import writer as csv_writer
-from tqdm import tqdm
-from lobe import ImageModel
-from concurrent.futures import ThreadPoolExecutor
-
-
-def predict_dataset(filepath, model_dir, url_col=None, progress_hook=None):
+from model.workers import (
+	create_workers, predict_url, processes_arg, prediction_header, prediction_columns, top_prediction,
+)
+from model.shard import in_shard, parse_shard, shard_suffix
+from model.merge_predictions import ROW_COL
+from dataset.utils import normalize_url, stop_if_cancelled
+from dataset.progress import Progress, OK, ERROR, DUPLICATE
+from dataset import metrics, profiling
+from dataset.introspect import TABLE_EXTENSIONS, inspect_file, iter_rows, column_index, has_header
+
+AUTOTUNE_SAMPLES = 64
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+
+def predict_dataset(
+		filepath, model_dir, url_col=None, progress_hook=None, processes=None, threads_per_worker=None, shard=None,
+		cache=False, output_format='csv', cancel_event=None
+):
 	"""
 	Given a file with urls to images, predict the given SavedModel on the image and write the label
-	and confidene back to the file.
-
-	:param filepath: path to a valid txt or csv file with image urls to download.
-	:param model_dir: path to the Lobe Tensorflow SavedModel export.
+	and confidene back to the file. Each url is only downloaded and predicted once, and its prediction is written to
+	every row with it.
+
+	:param filepath: path to a valid txt, csv, xlsx, parquet, or arrow file with image urls to download. Local paths
+		and file:// urls are read straight from the file.
+	:param model_dir: path to the Lobe Tensorflow SavedModel export, or a list of them to compare. Each image is
+		downloaded and decoded once for all of the models, and the output gets a label and confidence column for each
+		model, named after its folder, and an agreement column for whether they all predicted the same label.
 	:param url_col: if this is a csv, the column header name for the urls to download.
 	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
+	:param processes: an optional number of worker processes to load the model in, or 'auto' to pick from a warm-up benchmark.
+		By default the model is loaded once and shared by a pool of threads.
+	:param threads_per_worker: the TensorFlow threads for each worker process, defaults to an even split of the cores.
+	:param shard: an optional (i, N) tuple to only predict the rows in shard i of N, partitioned by normalized url, so
+		the repeats of a url are all in one shard.
+		The output then gets a leading row column, so the shards can be combined with model.merge_predictions.
+	:param cache: a flag for whether to read a txt, csv, or xlsx file through a cached parquet copy, which is much faster
+		to read again on later runs.
+	:param output_format: one of 'csv' or 'parquet' for the predictions file.
+	:param cancel_event: an optional threading.Event that stops the prediction with JobCancelled when set.
 	"""
 	print(f"Predicting {filepath}")
 	filepath = os.path.abspath(filepath)
 	filename, ext = _name_and_extension(filepath)
-	# read the file
+	# read just the headers and an estimate of the number of rows -- the rows themselves are streamed in chunks
 	# if this a .txt file, don't treat the first row as a header. Otherwise, use the first row for header column names.
-	if ext != '.xlsx':
-		csv = pd.read_csv(filepath, header=None if ext == '.txt' else 0)
-	else:
-		csv = pd.read_excel(filepath, header=0)
-	if ext in ['.csv', '.xlsx'] and not url_col:
+	info = inspect_file(filepath)
+	if output_format not in OUTPUT_FORMATS:
+		raise ValueError(f"Output format {output_format} is not one of {OUTPUT_FORMATS}")
+	if has_header(filepath) and not url_col:
 		raise ValueError(f"Please specify an image url column for the csv.")
-	url_col_idx = 0
-	if url_col:
-		try:
-			url_col_idx = list(csv.columns).index(url_col)
-		except ValueError:
-			raise ValueError(f"Image url column {url_col} not found in csv headers {csv.columns}")
-
-	num_items = len(csv)
-	print(f"Predicting {num_items} items...")
-
-	# load the model
-	print("Loading model...")
-	model = ImageModel.load(model_path=model_dir)
-	print("Model loaded!")
-
-	# create our output csv
+	url_col_idx = column_index(info.headers, url_col) if url_col else 0
+
+	num_items = info.rows // shard[1] if shard else info.rows
+	print(f"Predicting {'' if info.exact and not shard else '~'}{num_items} items...")
+
+	# keep the original row numbers so sharded outputs can be merged back in order
+	rows = (
+		(i, row) for i, row in enumerate(iter_rows(filepath, cache=cache))
+		if in_shard(normalize_url(row[url_col_idx]) or row[url_col_idx], shard)
+	)
+	samples = None
+	if processes == 'auto':
+		# the first rows are the warm-up benchmark for picking the worker split
+		first_rows = list(islice(rows, AUTOTUNE_SAMPLES))
+		samples = [row[url_col_idx] for _, row in first_rows]
+		rows = chain(first_rows, rows)
+
+	# create our output file
 	fname, ext = os.path.splitext(filepath)
-	out_file = f"{fname}_predictions.csv"
+	out_file = f"{fname}_predictions{shard_suffix(shard) if shard else ''}.{output_format}"
+	row_col = [ROW_COL] if shard else []
+	# our header names from the file's columns
+	header = [*row_col, *[str(col) if not pd.isna(col) else '' for col in info.headers], *prediction_header(model_dir)]
+	# the confidence column, or confidence_<model> for each model being compared
+	float_columns = [name for name in prediction_header(model_dir) if name.startswith('confidence')]
+	with _open_writer(out_file, output_format, header, float_columns=float_columns) as writer:
+
+		def write_result(future, row_idx, row, duplicate):
+			prediction = future.result()
+			row_key = [row_idx] if shard else []
+			with metrics.timer('write'):
+				writer.writerow([*row_key, *[str(col) if not pd.isna(col) else '' for col in row], *prediction_columns(prediction)])
+			label, _ = top_prediction(prediction)
+			progress.update(ERROR if label == '' else DUPLICATE if duplicate else OK)
+
+		# load the model
+		with create_workers(model_dir, processes, threads_per_worker, samples=samples, urls=True) as workers:
+			# iterate over the rows and predict the label
+			with Progress(total=num_items, progress_hook=progress_hook) as progress:
+				model_futures = deque()
+				# normalized url -> its prediction future, which the rows repeating the url share
+				predictions = {}
+				num_items = 0
+				# make our prediction jobs as the rows are read
+				for row_idx, row in rows:
+					stop_if_cancelled(cancel_event, (future for future, _, _, _ in model_futures))
+					num_items += 1
+					url = row[url_col_idx]
+					key = normalize_url(url) or url
+					future = predictions.get(key)
+					duplicate = future is not None
+					if duplicate:
+						metrics.count('duplicate_urls')
+					else:
+						future = predictions[key] = workers.submit_url(url)
+					model_futures.append((future, row_idx, row, duplicate))
+					# write the results that are ready, in the order of the rows
+					while model_futures and model_futures[0][0].done():
+						write_result(*model_futures.popleft())
+				# now we know exactly how many rows there were
+				progress.set_total(num_items)
+
+				while model_futures:
+					stop_if_cancelled(cancel_event, (future for future, _, _, _ in model_futures))
+					write_result(*model_futures.popleft())
+			print(progress.summary())
+			print(f"Unique urls: {len(predictions)} | Duplicate rows: {num_items - len(predictions)}")
+
+
+@contextmanager
+def _open_writer(out_file, output_format, header, float_columns=()):
+	# a csv writer, or a parquet writer with the same writerow interface
+	if output_format == 'parquet':
+		from dataset.columnar import ParquetRowWriter
+		writer = ParquetRowWriter(out_file, header, float_columns=float_columns)
+		try:
+			yield writer
+		finally:
+			writer.close()
+		return
 	with open(out_file, 'w', encoding="utf-8", newline='') as f:
-		# our header names from the pandas columns
 		writer = csv_writer(f)
-		writer.writerow([*[str(col) if not pd.isna(col) else '' for col in csv.columns], 'label', 'confidence'])
-
-	# iterate over the rows and predict the label
-	with tqdm(total=len(csv)) as pbar:
-		with ThreadPoolExecutor() as executor:
-			model_futures = []
-			# make our prediction jobs
-			for i, row in enumerate(csv.itertuples(index=False)):
-				url = row[url_col_idx]
-				model_futures.append(executor.submit(predict_image_url, url=url, model=model, row=row))
-
-			# write the results from the predict (this should go in order of the futures)
-			for i, future in enumerate(model_futures):
-				label, confidence, row = future.result()
-				with open(out_file, 'a', encoding="utf-8", newline='') as f:
-					writer = csv_writer(f)
-					writer.writerow([*[str(col) if not pd.isna(col) else '' for col in row], label, confidence])
-				pbar.update(1)
-				if progress_hook:
-					progress_hook(i+1, len(csv))
-
-
-def predict_image_url(url, model: ImageModel, row):
-	label, confidence = '', ''
-	try:
-		result = model.predict_from_url(url=url)
-		label, confidence = result.labels[0]
-	except Exception as e:
-		print(f"Problem predicting image from url: {e}")
+		writer.writerow(header)
+		yield writer
+
+
+def predict_image_url(url, model, row):
+	label, confidence = predict_url(model, url)
 	return label, confidence, row
 
 
@@ -98,7 +164,7 @@ def _name_and_extension(filepath):
 
 def _valid_file(filepath):
 	# file must exist and have a valid extension
-	valid_extensions = ['.txt', '.csv', '.xlsx']
+	valid_extensions = TABLE_EXTENSIONS
 	_, extension = _name_and_extension(filepath)
 	if extension not in valid_extensions:
 		raise ValueError(f"File {filepath} doesn't have one of the valid extensions: {valid_extensions}")
@@ -108,8 +174,22 @@ def _valid_file(filepath):
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Label an image dataset from csv or txt file.')
-	parser.add_argument('file', help='Path to your csv or txt file.')
-	parser.add_argument('model_dir', help='Path to your SavedModel from Lobe.')
+	parser.add_argument('file', help='Path to your csv, xlsx, txt, parquet, or arrow file.')
+	parser.add_argument('model_dir', nargs='+', help='Path to your SavedModel from Lobe, or several to compare them.')
 	parser.add_argument('--url', help='If this is a csv with column headers, the column that contains the image urls to download.')
+	parser.add_argument('--processes', type=processes_arg, help="Number of model worker processes, or 'auto' to benchmark.")
+	parser.add_argument('--threads-per-worker', type=int, help='TensorFlow threads for each worker process.')
+	parser.add_argument('--shard', type=parse_shard, help='Only predict shard i of N of the rows, given as i/N.')
+	parser.add_argument('--cache', action='store_true', help='Read the file through a cached parquet copy, creating it if needed.')
+	parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help='The file format for the predictions.')
+	parser.add_argument('--metrics', help='Directory to write per-stage timing metrics to.')
+	profiling.add_arguments(parser)
 	args = parser.parse_args()
-	predict_dataset(filepath=args.file, model_dir=args.model_dir, url_col=args.url)
+	if args.metrics:
+		metrics.enable(args.metrics)
+	with profiling.profiled(args.profile, default_dir=os.path.dirname(os.path.abspath(args.file)), modes=args.profile_mode):
+		predict_dataset(
+			filepath=args.file, model_dir=args.model_dir[0] if len(args.model_dir) == 1 else args.model_dir, url_col=args.url,
+			processes=args.processes, threads_per_worker=args.threads_per_worker, shard=args.shard,
+			cache=args.cache, output_format=args.format,
+		)
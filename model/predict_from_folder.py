@@ -4,110 +4,289 @@ them into a subdirectory structure where their directory is the predicted label
 """
 import argparse
 import os
-import shutil
-from tqdm import tqdm
-from lobe import ImageModel
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain, islice
 from csv import writer as csv_writer
+from dataset.utils import walk_images, stop_if_cancelled
+from dataset.progress import Progress, OK, ERROR
+from dataset import metrics, profiling
+from dataset.catalog import open_catalog
+from dataset.pack import is_pack, load_pack
+from model.organize import apply_plan, PLAN_HEADER, MODES
+from model.workers import (
+	create_workers, predict_file, processes_arg, prediction_header, prediction_columns, top_prediction,
+)
+from model.registry import input_size, is_model_list, model_names
+from model.tensor_cache import TensorCache, CACHE_DIR
+from model.shard import in_shard, parse_shard, shard_suffix, path_key
+from model.merge_predictions import ROW_COL
 
+PLAN_FILE = 'organize_plan.csv'
+UNDO_FILE = 'organize_undo.csv'
+AUTOTUNE_SAMPLES = 64
 
-def predict_folder(img_dir, model_dir, progress_hook=None, move=True, csv=False):
+
+def predict_folder(
+		img_dir, model_dir, progress_hook=None, move=True, csv=False, mode='move', dry_run=False,
+		processes=None, threads_per_worker=None, shard=None, tensor_cache=None, catalog=None, fanout=0,
+		cancel_event=None
+):
 	"""
 	Run your model on a directory of images. This will also go through any images in existing subdirectories.
 	Move each image into a subdirectory structure based on the prediction -- the predicted label
 	becomes the directory name where the image goes.
 
-	:param img_dir: the filepath to your directory of images.
-	:param model_dir: path to the Lobe Tensorflow SavedModel export.
+	Predictions are first written to a plan file, and the files are only reorganized once prediction has finished,
+	so moving files never holds up the model or changes the folder while it is being walked.
+
+	:param img_dir: the filepath to your directory of images, or a pack file from dataset.pack, which is predicted
+		straight from the pack with predict_pack instead of reorganized.
+	:param model_dir: path to the Lobe Tensorflow SavedModel export, or a list of them to compare. Each image is read
+		and decoded once for all of the models, the csv gets a Label and Confidence column for each model, named after
+		its folder, and an Agreement column, and the images are organized by the first model's predictions.
 	:param progress_hook: an optional function that will be run with progress_hook(currentProgress, totalProgress) when progress updates.
 	:param move: a flag for whether you want to physically move the image files into a subfolder structure based on the predicted label
 	:param csv: a flag for whether you want to create an output csv showing the image filenames and their predictions
+	:param mode: how to place the images in the label folders when move is set: 'move', 'hardlink', or 'symlink'.
+	:param dry_run: a flag for whether to only report how the images would be reorganized.
+	:param processes: an optional number of worker processes to load the model in, or 'auto' to pick from a warm-up benchmark.
+		By default the model is loaded once and shared by a pool of threads.
+	:param threads_per_worker: the TensorFlow threads for each worker process, defaults to an even split of the cores.
+	:param shard: an optional (i, N) tuple to only predict the images in shard i of N, partitioned by relative path.
+		Sharded runs only write a predictions csv with a leading row column and don't reorganize the folder -- combine
+		the shards with model.merge_predictions and apply the merged plan with model.organize.
+	:param tensor_cache: an optional directory to cache the decoded and resized images in, or True for a .tensor_cache
+		folder in img_dir. Later runs with a model of the same input size only decode the new and changed images.
+	:param catalog: a flag for whether to record each model's predictions, and where the images were moved, in the
+		folder's catalog (see dataset.catalog). By default they are recorded if the folder already has a catalog.
+		Sharded runs never update the catalog, since the shards may be on several machines sharing the folder over a
+		network filesystem, where SQLite isn't safe to write from several of them.
+	:param fanout: an optional number of levels of hash-prefix folders to spread the images of each label over, like
+		label/ab/cd/image.jpg. Images already organized with the same fanout stay where they are.
+	:param cancel_event: an optional threading.Event that stops the prediction with JobCancelled when set.
+		Nothing is reorganized when a run is cancelled.
 	"""
+	if os.path.isfile(img_dir) and is_pack(img_dir):
+		return predict_pack(
+			img_dir, model_dir, progress_hook=progress_hook, processes=processes, threads_per_worker=threads_per_worker,
+			shard=shard, cancel_event=cancel_event,
+		)
 	print(f"Predicting {img_dir}")
 	img_dir = os.path.abspath(img_dir)
 	# if this a .txt file, don't treat the first row as a header. Otherwise, use the first row for header column names.
 	if not os.path.isdir(img_dir):
 		raise ValueError(f"Please specify a directory to images. Found {img_dir}")
+	if mode not in MODES:
+		raise ValueError(f"Mode {mode} is not one of {MODES}")
+
+	image_files = walk_images(img_dir)
+	if shard:
+		# the other shards are still reading this folder, so only organize once they are merged
+		move = False
+		image_files = (path for path in image_files if in_shard(path_key(path, img_dir), shard))
+	cache = None
+	if tensor_cache:
+		# preprocess every new or changed image up front, so prediction reads them all from the cache
+		size = input_size(model_dir)
+		cache = TensorCache(
+			os.path.join(img_dir, CACHE_DIR) if tensor_cache is True else tensor_cache, img_dir, size,
+			name=f"tensors-{size[0]}x{size[1]}{shard_suffix(shard) if shard else ''}",
+		)
+		image_files = list(image_files)
+		print("Preprocessing new and changed images into the tensor cache...")
+		added = cache.update(image_files, cancel_event=cancel_event)
+		print(f"Preprocessed {added} of {len(image_files)} images.")
+		stop_if_cancelled(cancel_event)
+	samples = []
+	if processes == 'auto':
+		# the first images found are the warm-up benchmark for picking the worker split. The cache has made the
+		# images a list by now, which islice wouldn't consume, so chain would yield the samples twice
+		image_files = iter(image_files)
+		samples = list(islice(image_files, AUTOTUNE_SAMPLES))
+		image_files = chain(samples, image_files)
+
+	# our predictions go to a plan file first -- when we aren't reorganizing, that is just the output csv
+	out_csv = os.path.join(img_dir, f"predictions{shard_suffix(shard) if shard else ''}.csv")
+	plan_file = os.path.join(img_dir, PLAN_FILE) if move else out_csv
+	if not move and not csv and not shard:
+		plan_file = None
+
+	# iterate over the images as they are found and predict the label
+	num_items = 0
+	no_labels = 0
+
+	# the plan's File, Label, Confidence columns, or File and a Label and Confidence for each model, where the first
+	# model's pair is in the plan's columns so it is the one the images are organized by
+	header = [PLAN_HEADER[0], *prediction_header(model_dir, *PLAN_HEADER[1:], 'Agreement')]
+	# file -> the other models' columns, to add back to the output csv once the images have been organized
+	other_columns = {}
+
+	# the catalog names each model's predictions after its folder, like the csv columns
+	models = model_names(model_dir if is_model_list(model_dir) else [model_dir])
+
+	def process_result(future, img_file):
+		nonlocal no_labels
+		prediction = future.result()
+		label, _ = top_prediction(prediction)
+		if catalog_db:
+			catalog_db.add_predictions(img_file, models, prediction if isinstance(prediction, list) else [prediction])
+		if label is None:
+			no_labels += 1
+		# a shard keeps a row for every image, with empty predictions if it failed, so the merge can check them all
+		if plan_writer and (label is not None or shard):
+			row_key = [path_key(img_file, img_dir)] if shard else []
+			columns = prediction_columns(prediction)
+			with metrics.timer('write'):
+				plan_writer.writerow([*row_key, img_file, *columns])
+			if len(columns) > 2 and move and csv:
+				other_columns[img_file] = columns[2:]
+		progress.update(ERROR if label is None else OK)
 
-	num_items = sum(len(files) for _, _, files in os.walk(img_dir))
-	print(f"Predicting {num_items} items...")
+	plan_f = open(plan_file, 'w', encoding="utf-8", newline='') if plan_file else None
+	catalog_db = None if shard else open_catalog(img_dir, catalog)
+	try:
+		plan_writer = None
+		if plan_f:
+			plan_writer = csv_writer(plan_f)
+			plan_writer.writerow([ROW_COL, *header] if shard else header)
+		# load the model
+		with create_workers(model_dir, processes, threads_per_worker, samples=samples) as workers:
+			# the total grows as the walk finds images
+			with Progress(progress_hook=progress_hook) as progress:
+				model_futures = deque()
+				# make our prediction jobs as the walk finds images
+				for image_file in image_files:
+					stop_if_cancelled(cancel_event, (future for future, _ in model_futures))
+					num_items += 1
+					progress.add_total()
+					cached = cache.lookup(image_file) if cache else None
+					future = workers.submit_cached(*cached) if cached else workers.submit_file(image_file)
+					model_futures.append((future, image_file))
+					# handle any finished predictions in order without waiting on the rest of the walk
+					while model_futures and model_futures[0][0].done():
+						process_result(*model_futures.popleft())
+				print(f"Found {num_items} images.")
+
+				while model_futures:
+					stop_if_cancelled(cancel_event, (future for future, _ in model_futures))
+					process_result(*model_futures.popleft())
+			print(progress.summary())
+	finally:
+		if plan_f:
+			plan_f.close()
+		if catalog_db:
+			catalog_db.close()
+	print(f"Done! Number of images without predicted labels: {no_labels}")
 
-	# load the model
-	print("Loading model...")
-	model = ImageModel.load(model_path=model_dir)
-	print("Model loaded!")
+	if move:
+		print("Organizing images...")
+		ops = apply_plan(
+			plan_file=plan_file, dest_root=img_dir, mode=mode, dry_run=dry_run,
+			undo_log=os.path.join(img_dir, UNDO_FILE), fanout=fanout,
+		)
+		if cache and not dry_run:
+			cache.moved([(src, dest_file) for src, dest_file, _, _ in ops if src != dest_file], copy=mode != 'move')
+		if catalog_db and not dry_run:
+			# the predictions follow the images to their label folders
+			with open_catalog(img_dir) as catalog_db:
+				for src, dest_file, label, _ in ops:
+					if src != dest_file:
+						catalog_db.move(src, dest_file, label, copy=mode != 'move')
+		# write the results with where each file ended up to a csv
+		if csv and not dry_run:
+			with open(out_csv, 'w', encoding="utf-8", newline='') as f:
+				writer = csv_writer(f)
+				writer.writerow(header)
+				writer.writerows(
+					[dest_file, label, confidence, *other_columns.get(src, [])] for src, dest_file, label, confidence in ops
+				)
 
-	# create our output csv
-	out_csv = os.path.join(img_dir, "predictions.csv")
-	if csv:
-		with open(out_csv, 'w', encoding="utf-8", newline='') as f:
-			writer = csv_writer(f)
-			writer.writerow(['File', 'Label', 'Confidence'])
 
-	# iterate over the rows and predict the label
-	curr_progress = 0
+def predict_pack(
+		pack_file, model_dir, progress_hook=None, processes=None, threads_per_worker=None, shard=None, cancel_event=None
+):
+	"""
+	Run your model on the images in a pack from dataset.pack, reading them straight from the memory-mapped file, and
+	write a <pack name>_predictions.csv next to it with each image's name, its label in the pack, and the predictions.
+
+	:param pack_file: the path to the pack.
+	:param shard: an optional (i, N) tuple to only predict the images in shard i of N, partitioned by name. The csv then
+		has a leading row column with each image's number in the pack, for model.merge_predictions.
+	See predict_folder for the other parameters.
+	"""
+	print(f"Predicting {pack_file}")
+	pack_file = os.path.abspath(pack_file)
+	pack = load_pack(pack_file)
+	indexes = [i for i, name in enumerate(pack.names) if in_shard(name, shard)]
+	out_csv = f"{os.path.splitext(pack_file)[0]}_predictions{shard_suffix(shard) if shard else ''}.csv"
+	header = [PLAN_HEADER[0], 'Pack Label', *prediction_header(model_dir, *PLAN_HEADER[1:], 'Agreement')]
 	no_labels = 0
-	with tqdm(total=num_items) as pbar:
-		with ThreadPoolExecutor() as executor:
-			model_futures = []
-			# make our prediction jobs
-			for root, _, files in os.walk(img_dir):
-				for filename in files:
-					image_file = os.path.abspath(os.path.join(root, filename))
-					model_futures.append(
-						(executor.submit(predict_label_from_image_file, image_file=image_file, model=model), image_file)
-					)
-
-			for future, img_file in model_futures:
-				label, confidence = future.result()
-				if label is None:
-					no_labels += 1
-				else:
-					# move the file
-					dest_file = img_file
-					if move:
-						filename = os.path.split(img_file)[-1]
-						name, ext = os.path.splitext(filename)
-						dest_dir = os.path.join(img_dir, label)
-						os.makedirs(dest_dir, exist_ok=True)
-						dest_file = os.path.abspath(os.path.join(dest_dir, filename))
-						# only move if the destination is different than the file
-						if dest_file != img_file:
-							try:
-								# rename the file if there is a conflict
-								rename_idx = 0
-								while os.path.exists(dest_file):
-									new_name = f'{name}_{rename_idx}{ext}'
-									dest_file = os.path.abspath(os.path.join(dest_dir, new_name))
-									rename_idx += 1
-								shutil.move(img_file, dest_file)
-							except Exception as e:
-								print(f"Problem moving file: {e}")
-					# write the results to a csv
-					if csv:
-						with open(out_csv, 'a', encoding="utf-8", newline='') as f:
-							writer = csv_writer(f)
-							writer.writerow(
-								[dest_file, label, confidence])
-				pbar.update(1)
-				if progress_hook:
-					curr_progress += 1
-					progress_hook(curr_progress, num_items)
+	with open(out_csv, 'w', encoding="utf-8", newline='') as f:
+		writer = csv_writer(f)
+		writer.writerow([ROW_COL, *header] if shard else header)
+
+		def process_result(future, index):
+			nonlocal no_labels
+			prediction = future.result()
+			label, _ = top_prediction(prediction)
+			if label is None:
+				no_labels += 1
+			# like a folder's shards, a pack's keep a row for every image so the merge finds no gaps
+			if label is not None or shard:
+				row_key = [index] if shard else []
+				with metrics.timer('write'):
+					writer.writerow([*row_key, pack.names[index], pack.label(index) or '', *prediction_columns(prediction)])
+			progress.update(ERROR if label is None else OK)
+
+		with create_workers(model_dir, processes, threads_per_worker) as workers:
+			with Progress(total=len(indexes), progress_hook=progress_hook) as progress:
+				model_futures = deque()
+				for index in indexes:
+					stop_if_cancelled(cancel_event, (future for future, _ in model_futures))
+					model_futures.append((workers.submit_packed(pack_file, index), index))
+					# write the finished predictions in the order of the pack
+					while model_futures and model_futures[0][0].done():
+						process_result(*model_futures.popleft())
+				while model_futures:
+					stop_if_cancelled(cancel_event, (future for future, _ in model_futures))
+					process_result(*model_futures.popleft())
+			print(progress.summary())
 	print(f"Done! Number of images without predicted labels: {no_labels}")
 
 
-def predict_label_from_image_file(image_file, model: ImageModel):
-	try:
-		result = model.predict_from_file(path=image_file)
-		return result.labels[0]
-	except Exception as e:
-		print(f"Problem predicting image from file: {e}")
-	return None, None
+def predict_label_from_image_file(image_file, model):
+	return predict_file(model, image_file)
 
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Predict an image dataset from a folder of images.')
-	parser.add_argument('dir', help='Directory path to your images.')
-	parser.add_argument('model_dir', help='Path to your SavedModel from Lobe.')
+	parser.add_argument('dir', help='Directory path to your images, or a pack file from dataset.pack.')
+	parser.add_argument('model_dir', nargs='+', help='Path to your SavedModel from Lobe, or several to compare them.')
+	parser.add_argument('--mode', choices=MODES, default='move', help='How to place the images in the label folders.')
+	parser.add_argument('--dry-run', action='store_true', help='Only report how the images would be reorganized.')
+	parser.add_argument('--processes', type=processes_arg, help="Number of model worker processes, or 'auto' to benchmark.")
+	parser.add_argument('--threads-per-worker', type=int, help='TensorFlow threads for each worker process.')
+	parser.add_argument('--shard', type=parse_shard, help='Only predict shard i of N of the images, given as i/N.')
+	parser.add_argument(
+		'--tensor-cache', nargs='?', const=True, metavar='DIR',
+		help='Cache the resized images for later runs, in DIR or a .tensor_cache folder in the image directory.',
+	)
+	parser.add_argument('--fanout', type=int, default=0, help='Levels of hash-prefix folders to spread each label over.')
+	parser.add_argument(
+		'--catalog', action='store_const', const=True,
+		help="Record the predictions in the folder's catalog, creating it if needed. By default they are recorded if it has one.",
+	)
+	parser.add_argument('--metrics', help='Directory to write per-stage timing metrics to.')
+	profiling.add_arguments(parser)
 	args = parser.parse_args()
-	predict_folder(img_dir=args.dir, model_dir=args.model_dir, move=True, csv=True)
+	if args.metrics:
+		metrics.enable(args.metrics)
+	# the profile goes next to the folder, so it isn't walked as part of it
+	profile_dir = os.path.dirname(os.path.abspath(args.dir))
+	with profiling.profiled(args.profile, default_dir=profile_dir, modes=args.profile_mode):
+		predict_folder(
+			img_dir=args.dir, model_dir=args.model_dir[0] if len(args.model_dir) == 1 else args.model_dir,
+			move=True, csv=True, mode=args.mode, dry_run=args.dry_run,
+			processes=args.processes, threads_per_worker=args.threads_per_worker, shard=args.shard,
+			tensor_cache=args.tensor_cache, catalog=args.catalog, fanout=args.fanout,
+		)
@@ -0,0 +1,195 @@
+"""
+A process-wide cache of loaded Lobe models, so the app tabs and the prediction scripts only pay for loading
+a SavedModel once. Models are keyed by their directory and its modification time, so a re-exported model is
+loaded again, and the least recently used models are dropped once the cache grows past its memory budget.
+"""
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+# rough budget for the loaded models, estimated from their size on disk
+MEMORY_BUDGET = int(os.getenv('IMAGE_TOOLS_MODEL_CACHE_BYTES', 2 * 1024 ** 3))
+DEFAULT_INPUT_SIZE = (224, 224)
+SIGNATURE_FILE = 'signature.json'
+
+_lock = Lock()
+# key -> (model, estimated bytes), in least to most recently used order
+_models = OrderedDict()
+# key -> Future for the models that are being loaded right now, so concurrent requests share one load
+_loading = {}
+
+
+def _model_key(model_dir):
+	# the model directory and the latest modification time of it or its top level files
+	model_dir = os.path.realpath(model_dir)
+	mtime = os.path.getmtime(model_dir)
+	with os.scandir(model_dir) as entries:
+		for entry in entries:
+			try:
+				mtime = max(mtime, entry.stat().st_mtime)
+			except OSError:
+				pass
+	return model_dir, mtime
+
+
+def _model_size(model_dir):
+	# estimate the memory for a model by the size of its files
+	size = 0
+	for root, _, files in os.walk(model_dir):
+		for filename in files:
+			try:
+				size += os.path.getsize(os.path.join(root, filename))
+			except OSError:
+				pass
+	return size
+
+
+def is_model_list(model_dirs):
+	# several models to run on the same images, see get_models
+	return isinstance(model_dirs, (list, tuple))
+
+
+def input_size(model):
+	"""
+	Return the (width, height) the model resizes its images to, or the largest of them for a list of models, so one
+	decode of an image covers every model.
+
+	:param model: a loaded model, or the path to a Lobe export, which is read from its signature.json without loading it.
+	"""
+	if is_model_list(model):
+		sizes = [input_size(m) for m in model]
+		return max(width for width, _ in sizes), max(height for _, height in sizes)
+	if is_model_path(model):
+		try:
+			with open(os.path.join(model, SIGNATURE_FILE), encoding='utf-8') as f:
+				inputs = json.load(f)['inputs']
+			# the image input's shape is [batch, height, width, channels]
+			shape = next(iter(inputs.values()))['shape']
+			return int(shape[2]), int(shape[1])
+		except (OSError, ValueError, KeyError, IndexError, TypeError, StopIteration):
+			return DEFAULT_INPUT_SIZE
+	size = getattr(getattr(model, 'signature', None), 'input_image_size', None) or DEFAULT_INPUT_SIZE
+	return tuple(size)
+
+
+def warm_up(model):
+	"""
+	Run one prediction on a blank image, so the first real prediction doesn't pay for graph setup.
+	"""
+	from PIL import Image
+	model.predict(Image.new('RGB', input_size(model)))
+
+
+def _load(model_dir, warm):
+	from lobe import ImageModel
+	print(f"Loading model {model_dir}...")
+	model = ImageModel.load(model_path=model_dir)
+	if warm:
+		try:
+			warm_up(model)
+		except Exception as e:
+			print(f"Problem warming up model: {e}")
+	print("Model loaded!")
+	return model
+
+
+def _evict():
+	# drop the least recently used models until we are under budget, always keeping the newest one
+	total = sum(size for _, size in _models.values())
+	while total > MEMORY_BUDGET and len(_models) > 1:
+		_, (_, size) = _models.popitem(last=False)
+		total -= size
+
+
+def is_model_path(model_dir):
+	# a SavedModel directory rather than a model object, like the stub model the benchmarks use
+	return isinstance(model_dir, (str, bytes, os.PathLike))
+
+
+def get_model(model_dir, warm=True):
+	"""
+	Return the loaded model for a Lobe Tensorflow SavedModel export directory, loading it if it isn't cached.
+
+	:param model_dir: path to the Lobe Tensorflow SavedModel export, or an already loaded model, which is returned as is.
+	:param warm: a flag for whether to run a warm-up prediction when the model is first loaded.
+	"""
+	if not is_model_path(model_dir):
+		return model_dir
+	key = _model_key(model_dir)
+	with _lock:
+		if key in _models:
+			_models.move_to_end(key)
+			return _models[key][0]
+		future = _loading.get(key)
+		owner = future is None
+		if owner:
+			future = Future()
+			_loading[key] = future
+	if not owner:
+		return future.result()
+	try:
+		model = _load(key[0], warm)
+		size = _model_size(key[0])
+		with _lock:
+			# forget older versions of the same model directory
+			for stale in [k for k in _models if k[0] == key[0]]:
+				del _models[stale]
+			_models[key] = (model, size)
+			_evict()
+		future.set_result(model)
+		return model
+	except Exception as e:
+		future.set_exception(e)
+		raise
+	finally:
+		with _lock:
+			_loading.pop(key, None)
+
+
+def get_models(model_dirs, warm=True):
+	"""
+	Return get_model(model_dirs) for a single model, or a list of the loaded models for a list, loading them in parallel.
+	"""
+	if not is_model_list(model_dirs):
+		return get_model(model_dirs, warm=warm)
+	for model_dir in model_dirs[1:]:
+		preload(model_dir)
+	return [get_model(model_dir, warm=warm) for model_dir in model_dirs]
+
+
+def model_names(model_dirs):
+	"""
+	Return a short, unique name for each model in a list, for the output column names: the export folder's name, or
+	model1, model2, ... for model objects.
+	"""
+	names = []
+	for i, model_dir in enumerate(model_dirs):
+		name = os.path.basename(os.path.normpath(model_dir)) if is_model_path(model_dir) else f"model{i + 1}"
+		# two exports can have the same folder name in different places
+		unique, n = name, 2
+		while unique in names:
+			unique, n = f"{name}_{n}", n + 1
+		names.append(unique)
+	return names
+
+
+def preload(model_dir):
+	"""
+	Start loading a model in the background, so it is ready by the time it is needed.
+	"""
+	def load():
+		try:
+			get_model(model_dir)
+		except Exception as e:
+			print(f"Problem preloading model {model_dir}: {e}")
+	Thread(target=load, daemon=True).start()
+
+
+def clear():
+	"""
+	Drop every cached model.
+	"""
+	with _lock:
+		_models.clear()
@@ -0,0 +1,49 @@
+"""
+Split prediction jobs across machines. Each row of a url file, or each image of a folder, belongs to exactly one
+of N shards by a stable hash of its url or relative path, so every node can pick its own work without coordinating.
+"""
+import argparse
+import hashlib
+import os
+import re
+
+SHARD_FILE_PATTERN = re.compile(r'\.shard-(\d+)-of-(\d+)\.')
+
+
+def parse_shard(value):
+	"""
+	Parse a shard spec of the form 'i/N' (0 <= i < N) into a tuple of (i, N). Can be used as an argparse type.
+	"""
+	try:
+		index, count = [int(part) for part in value.split('/')]
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"Shard {value} should look like i/N, for example 0/4.")
+	if count < 1 or not 0 <= index < count:
+		raise argparse.ArgumentTypeError(f"Shard {value} needs 0 <= i < N.")
+	return index, count
+
+
+def in_shard(key, shard):
+	"""
+	Return whether the key (a url or relative path) belongs to the shard. Every key is in the shard if shard is None.
+	"""
+	if shard is None:
+		return True
+	index, count = shard
+	# hashlib rather than hash() -- it has to be the same on every machine and every run
+	digest = hashlib.md5(str(key).encode('utf-8')).digest()
+	return int.from_bytes(digest[:8], 'big') % count == index
+
+
+def path_key(path, directory):
+	"""
+	Return the shard key of an image in a folder: its path relative to the folder with / separators, so a Windows
+	and a POSIX node put it in the same shard and the merge matches it to the same image.
+	"""
+	return os.path.relpath(path, directory).replace(os.sep, '/')
+
+
+def shard_suffix(shard):
+	# the name suffix for a shard's output file, which the merge uses to check every shard is present
+	index, count = shard
+	return f".shard-{index}-of-{count}"
@@ -0,0 +1,213 @@
+"""
+A cache of preprocessed images, for predicting the same folder with several models or more than once. Each image is
+decoded, center cropped, and resized to the model's input size once, and stored as uint8 pixels in a .npy pack.
+Later runs memory-map the packs and hand the model images made straight from the mapped pixels instead of decoding
+the files again, and only new or changed files are preprocessed. Worker processes map the same packs, so they share
+one copy of the pages in the OS cache.
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from dataset import metrics
+from model.decode import open_image, center_crop_resize
+
+CACHE_DIR = '.tensor_cache'
+INDEX_VERSION = 1
+# compact the packs into one once fewer than this fraction of their slots are still used, or there are too many
+COMPACT_RATIO = 0.5
+MAX_PACKS = 16
+
+# pack file -> memory-mapped array, shared by the threads of a process
+_packs = {}
+_packs_lock = Lock()
+
+
+def load_pack(pack_file):
+	"""
+	Return the memory-mapped (images, height, width, 3) array of a pack, mapping it once per process.
+	"""
+	import numpy as np
+	with _packs_lock:
+		pack = _packs.get(pack_file)
+		if pack is None:
+			pack = np.load(pack_file, mmap_mode='r')
+			_packs[pack_file] = pack
+	return pack
+
+
+def cached_image(pack_file, slot):
+	"""
+	Return one slot of a pack as a PIL image. The only work is one copy of the mapped pixels -- Pillow keeps RGB images
+	four bytes a pixel, so it can't use the three byte pixels in place.
+	"""
+	from PIL import Image
+	pixels = load_pack(pack_file)[slot]
+	height, width = pixels.shape[:2]
+	return Image.frombuffer('RGB', (width, height), pixels, 'raw', 'RGB', 0, 1)
+
+
+class TensorCache:
+	"""
+	The preprocessed images of one folder at one input size: .npy packs of uint8 pixels, and a json index from each
+	image's path to its pack and slot, with the file size and modification time the pixels were made from.
+
+	:param cache_dir: the directory to keep the packs and index in.
+	:param root: the folder of images -- the index is keyed by paths relative to it, so the folder can be moved.
+	:param size: the (width, height) model input size.
+	:param name: an optional name for the index and packs, so the shards of a folder can keep separate caches.
+	"""
+
+	def __init__(self, cache_dir, root, size, name=None):
+		self.cache_dir = os.path.abspath(cache_dir)
+		self.root = os.path.abspath(root)
+		self.size = tuple(size)
+		self.name = name or f"tensors-{self.size[0]}x{self.size[1]}"
+		self.index_file = os.path.join(self.cache_dir, f"{self.name}.json")
+		# relative path -> [pack, slot, file size, mtime in ns]
+		self.entries = {}
+		# pack -> number of slots
+		self.packs = {}
+		self._load()
+
+	def _load(self):
+		try:
+			with open(self.index_file, encoding='utf-8') as f:
+				index = json.load(f)
+		except (OSError, ValueError):
+			return
+		if index.get('version') != INDEX_VERSION or tuple(index.get('size', ())) != self.size:
+			return
+		self.packs = {
+			pack: slots for pack, slots in index['packs'].items() if os.path.exists(os.path.join(self.cache_dir, pack))
+		}
+		self.entries = {path: entry for path, entry in index['entries'].items() if entry[0] in self.packs}
+
+	def _key(self, path):
+		return os.path.relpath(os.path.abspath(path), self.root)
+
+	def lookup(self, path):
+		"""
+		Return the (pack file, slot) of an image if its cached pixels are still current, or None.
+		"""
+		entry = self.entries.get(self._key(path))
+		if entry is None:
+			return None
+		pack, slot, file_size, mtime = entry
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		if stat.st_size != file_size or stat.st_mtime_ns != mtime:
+			return None
+		return os.path.join(self.cache_dir, pack), slot
+
+	def moved(self, moves, copy=False):
+		"""
+		Follow images that were organized to new paths, so the next run still finds their cached pixels. A move or
+		link keeps the file's size and modification time, so the entries stay current.
+
+		:param moves: (src, dest) pairs of the images that were moved.
+		:param copy: a flag for whether the images were hardlinked or symlinked, so src is still there too.
+		"""
+		for src, dest in moves:
+			entry = self.entries.get(self._key(src)) if copy else self.entries.pop(self._key(src), None)
+			if entry is not None:
+				self.entries[self._key(dest)] = list(entry)
+		self.save()
+
+	def update(self, paths, workers=None, cancel_event=None):
+		"""
+		Bring the cache up to date with the images in paths: preprocess the new and changed ones into a new pack,
+		forget the images that are gone, and save the index. Returns the number of images preprocessed.
+
+		:param paths: every image in the folder.
+		:param workers: an optional number of threads to preprocess with.
+		:param cancel_event: an optional threading.Event that skips the remaining images when set.
+		"""
+		import numpy as np
+		paths = list(paths)
+		current = {self._key(path) for path in paths}
+		self.entries = {key: entry for key, entry in self.entries.items() if key in current}
+		stale = [path for path in paths if self.lookup(path) is None]
+		metrics.count('tensor_cache', len(paths) - len(stale), outcome='hit')
+		metrics.count('tensor_cache', len(stale), outcome='miss')
+		done = []
+		if stale:
+			os.makedirs(self.cache_dir, exist_ok=True)
+			pack = f"{self.name}-{time.time_ns():x}.npy"
+			width, height = self.size
+			pixels = np.lib.format.open_memmap(
+				os.path.join(self.cache_dir, pack), mode='w+', dtype=np.uint8, shape=(len(stale), height, width, 3),
+			)
+
+			def preprocess(slot, path):
+				if cancel_event is not None and cancel_event.is_set():
+					return None
+				try:
+					# stat first, so a file that changes while we read it is preprocessed again next time
+					stat = os.stat(path)
+					with metrics.timer('decode'):
+						image = open_image(path, size=self.size)
+					with metrics.timer('preprocess'):
+						pixels[slot] = np.asarray(center_crop_resize(image, self.size))
+					return slot, path, stat
+				except Exception as e:
+					print(f"Problem preprocessing image {path}: {e}")
+				return None
+
+			with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preprocess') as executor:
+				done = [result for result in executor.map(preprocess, range(len(stale)), stale) if result]
+			pixels.flush()
+			del pixels
+			for slot, path, stat in done:
+				self.entries[self._key(path)] = [pack, slot, stat.st_size, stat.st_mtime_ns]
+			self.packs[pack] = len(stale)
+		self._compact()
+		self.save()
+		return len(done)
+
+	def _compact(self):
+		for pack in set(self.packs) - {entry[0] for entry in self.entries.values()}:
+			del self.packs[pack]
+			_remove(os.path.join(self.cache_dir, pack))
+		# copy the slots still in use into one new pack once the old ones are mostly stale or too many
+		used = len(self.entries)
+		if len(self.packs) < 2 or (used >= sum(self.packs.values()) * COMPACT_RATIO and len(self.packs) <= MAX_PACKS):
+			return
+		import numpy as np
+		pack = f"{self.name}-{time.time_ns():x}.npy"
+		width, height = self.size
+		pixels = np.lib.format.open_memmap(
+			os.path.join(self.cache_dir, pack), mode='w+', dtype=np.uint8, shape=(used, height, width, 3),
+		)
+		entries = {}
+		old_pixels = {old_pack: np.load(os.path.join(self.cache_dir, old_pack), mmap_mode='r') for old_pack in self.packs}
+		for slot, (key, (old_pack, old_slot, file_size, mtime)) in enumerate(sorted(self.entries.items())):
+			pixels[slot] = old_pixels[old_pack][old_slot]
+			entries[key] = [pack, slot, file_size, mtime]
+		pixels.flush()
+		del pixels, old_pixels
+		old_packs = self.packs
+		self.entries, self.packs = entries, {pack: used}
+		self.save()
+		for old_pack in old_packs:
+			_remove(os.path.join(self.cache_dir, old_pack))
+
+	def save(self):
+		index = {'version': INDEX_VERSION, 'size': list(self.size), 'packs': self.packs, 'entries': self.entries}
+		# write then rename, so a crash never leaves half an index
+		with open(f"{self.index_file}.tmp", 'w', encoding='utf-8') as f:
+			json.dump(index, f)
+		os.replace(f"{self.index_file}.tmp", self.index_file)
+
+
+def _remove(pack_file):
+	with _packs_lock:
+		_packs.pop(pack_file, None)
+	try:
+		os.remove(pack_file)
+	except OSError:
+		# still mapped by another process on windows -- it isn't in the index any more, so it is just unused
+		pass
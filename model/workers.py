@@ -0,0 +1,316 @@
+"""
+Prediction workers for the model entry points. By default one loaded model is shared by a pool of threads,
+or the model can be loaded once in each of several worker processes, with each process's TensorFlow threads
+pinned to its own slice of the CPU cores.
+
+The model can also be a list of models, to compare them in one pass: each image is read and decoded once, every
+model predicts it, and the predict functions return a list with each model's top (label, confidence).
+"""
+import os
+import time
+import multiprocessing
+from itertools import chain
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from model.registry import get_models, is_model_path, is_model_list, input_size, model_names
+from model.decode import open_image
+from model.tensor_cache import cached_image
+from dataset import metrics
+from dataset.utils import local_path
+from dataset.pack import load_pack
+
+# the model loaded in a worker process
+_worker_model = None
+
+
+def _infer(model, image, failed):
+	# the top (label, confidence) of the model, or of each model in a list, where one model failing doesn't lose the others
+	if not is_model_list(model):
+		with metrics.timer('inference'):
+			return model.predict(image).labels[0]
+	results = []
+	for i, each_model in enumerate(model):
+		try:
+			with metrics.timer('inference', model=str(i)):
+				results.append(each_model.predict(image).labels[0])
+		except Exception as e:
+			print(f"Problem predicting image with model {i + 1}: {e}")
+			results.append(failed)
+	return results
+
+
+def _failed(model, failed):
+	return [failed] * len(model) if is_model_list(model) else failed
+
+
+def predict_file(model, path):
+	"""
+	Return the top (label, confidence) for an image file, or (None, None) if it couldn't be predicted.
+	"""
+	try:
+		# decode here instead of in model.predict_from_file, so decoding and inference are timed separately, and at
+		# a reduced resolution close to the model's input size
+		with metrics.timer('decode'):
+			image = open_image(path, size=input_size(model))
+		return _infer(model, image, (None, None))
+	except Exception as e:
+		print(f"Problem predicting image from file: {e}")
+	return _failed(model, (None, None))
+
+
+def predict_cached(model, pack_file, slot):
+	"""
+	Return the top (label, confidence) for an image from the tensor cache, or (None, None) if it couldn't be predicted.
+	"""
+	try:
+		return _infer(model, cached_image(pack_file, slot), (None, None))
+	except Exception as e:
+		print(f"Problem predicting cached image: {e}")
+	return _failed(model, (None, None))
+
+
+def predict_packed(model, pack_file, index):
+	"""
+	Return the top (label, confidence) for an image in a pack, or (None, None) if it couldn't be predicted.
+	"""
+	try:
+		with metrics.timer('decode'):
+			image = load_pack(pack_file).image(index, size=input_size(model))
+		return _infer(model, image, (None, None))
+	except Exception as e:
+		print(f"Problem predicting packed image {index}: {e}")
+	return _failed(model, (None, None))
+
+
+def predict_url(model, url):
+	"""
+	Return the top (label, confidence) for an image url, or ('', '') if it couldn't be predicted. A local path or
+	file:// url is decoded straight from the file.
+	"""
+	try:
+		source = local_path(url)
+		if source is None:
+			import requests
+			with metrics.timer('download'):
+				response = requests.get(url, timeout=30)
+				response.raise_for_status()
+			source = response.content
+		with metrics.timer('decode'):
+			image = open_image(source, size=input_size(model))
+		return _infer(model, image, ('', ''))
+	except Exception as e:
+		print(f"Problem predicting image from url: {e}")
+	return _failed(model, ('', ''))
+
+
+def prediction_header(model_dir, label_col='label', confidence_col='confidence', agreement_col='agreement'):
+	"""
+	Return the output column names for the predictions: label and confidence, or a pair for each model in a list
+	named after the model, followed by whether they all agree.
+	"""
+	if not is_model_list(model_dir):
+		return [label_col, confidence_col]
+	pairs = ((f"{label_col}_{name}", f"{confidence_col}_{name}") for name in model_names(model_dir))
+	return [*chain.from_iterable(pairs), agreement_col]
+
+
+def prediction_columns(prediction):
+	"""
+	Return the output columns for a (label, confidence) prediction, or for a list of them from several models.
+	"""
+	if not isinstance(prediction, list):
+		return list(prediction)
+	labels = [label for label, _ in prediction]
+	agree = all(labels) and len(set(labels)) == 1
+	return [*chain.from_iterable(prediction), agree]
+
+
+def top_prediction(prediction):
+	# the (label, confidence) of the model, or of the first model in a list, which is the one used to organize
+	return prediction[0] if isinstance(prediction, list) else prediction
+
+
+def available_cores():
+	# the cores this process is allowed to run on
+	if hasattr(os, 'sched_getaffinity'):
+		return sorted(os.sched_getaffinity(0))
+	return list(range(os.cpu_count() or 1))
+
+
+class ThreadWorkers:
+	"""
+	Run predictions on a thread pool that shares one loaded model.
+	"""
+
+	def __init__(self, model, max_workers=None):
+		self.model = model
+		self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='predict')
+
+	def submit_file(self, path):
+		return self.executor.submit(predict_file, self.model, path)
+
+	def submit_cached(self, pack_file, slot):
+		return self.executor.submit(predict_cached, self.model, pack_file, slot)
+
+	def submit_packed(self, pack_file, index):
+		return self.executor.submit(predict_packed, self.model, pack_file, index)
+
+	def submit_url(self, url):
+		return self.executor.submit(predict_url, self.model, url)
+
+	def shutdown(self, wait=True):
+		self.executor.shutdown(wait=wait)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.shutdown()
+
+
+def _init_worker(model_dir, threads, inter_op_threads, core_slices):
+	global _worker_model
+	# claim a slice of cores for this process before TensorFlow starts any threads
+	try:
+		cores = core_slices.get_nowait()
+	except Empty:
+		cores = None
+	if cores and hasattr(os, 'sched_setaffinity'):
+		os.sched_setaffinity(0, cores)
+	os.environ['OMP_NUM_THREADS'] = str(threads)
+	if any(is_model_path(m) for m in (model_dir if is_model_list(model_dir) else [model_dir])):
+		import tensorflow as tf
+		tf.config.threading.set_intra_op_parallelism_threads(threads)
+		tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+	_worker_model = get_models(model_dir)
+
+
+def _worker_ready():
+	return os.getpid()
+
+
+def _worker_predict_file(path):
+	return predict_file(_worker_model, path)
+
+
+def _worker_predict_cached(pack_file, slot):
+	return predict_cached(_worker_model, pack_file, slot)
+
+
+def _worker_predict_packed(pack_file, index):
+	return predict_packed(_worker_model, pack_file, index)
+
+
+def _worker_predict_url(url):
+	return predict_url(_worker_model, url)
+
+
+class ProcessWorkers:
+	"""
+	Run predictions on a pool of worker processes, each loading the model once. The processes pull their
+	work from the pool's shared call queue.
+
+	:param model_dir: path to the Lobe Tensorflow SavedModel export, or a picklable model object, or a list of them.
+	:param processes: the number of worker processes.
+	:param threads_per_worker: the TensorFlow intra-op threads for each process, defaults to an even split of the cores.
+	:param inter_op_threads: the TensorFlow inter-op threads for each process.
+	"""
+
+	def __init__(self, model_dir, processes, threads_per_worker=None, inter_op_threads=1):
+		cores = available_cores()
+		self.processes = processes
+		self.threads_per_worker = threads_per_worker or max(1, len(cores) // processes)
+		# spawn fresh interpreters -- TensorFlow doesn't survive being forked
+		context = multiprocessing.get_context('spawn')
+		core_slices = context.Queue()
+		for i in range(processes):
+			core_slice = cores[i * self.threads_per_worker:(i + 1) * self.threads_per_worker]
+			core_slices.put(core_slice or None)
+		self.executor = ProcessPoolExecutor(
+			max_workers=processes, mp_context=context, initializer=_init_worker,
+			initargs=(model_dir, self.threads_per_worker, inter_op_threads, core_slices),
+		)
+		print(f"Loading model in {processes} worker processes with {self.threads_per_worker} threads each...")
+		# make sure every process has started and loaded its model
+		wait([self.executor.submit(_worker_ready) for _ in range(processes)])
+		print("Model loaded!")
+
+	def submit_file(self, path):
+		return self.executor.submit(_worker_predict_file, path)
+
+	def submit_cached(self, pack_file, slot):
+		# only the pack and slot go to the worker, which maps the pack itself and shares its pages with the other workers
+		return self.executor.submit(_worker_predict_cached, pack_file, slot)
+
+	def submit_packed(self, pack_file, index):
+		# each worker maps the pack itself, so only the index is sent
+		return self.executor.submit(_worker_predict_packed, pack_file, index)
+
+	def submit_url(self, url):
+		return self.executor.submit(_worker_predict_url, url)
+
+	def shutdown(self, wait=True):
+		self.executor.shutdown(wait=wait)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.shutdown()
+
+
+def autotune(model_dir, samples, urls=False, candidates=None):
+	"""
+	Try a few process and thread splits of the cores on a short warm-up benchmark and return the
+	fastest pool, which is left running for the real job.
+
+	:param model_dir: path to the Lobe Tensorflow SavedModel export.
+	:param samples: a list of image files (or urls) to benchmark with.
+	:param urls: a flag for whether the samples are urls.
+	:param candidates: an optional list of (processes, threads_per_worker) to try.
+	"""
+	num_cores = len(available_cores())
+	if candidates is None:
+		candidates = []
+		processes = 1
+		while processes <= num_cores:
+			candidates.append((processes, num_cores // processes))
+			processes *= 2
+	best, best_rate = None, 0
+	for processes, threads in candidates:
+		workers = ProcessWorkers(model_dir, processes=processes, threads_per_worker=threads)
+		submit = workers.submit_url if urls else workers.submit_file
+		# warm up each process before timing
+		wait([submit(sample) for sample in samples[:processes]])
+		start = time.perf_counter()
+		wait([submit(sample) for sample in samples])
+		rate = len(samples) / (time.perf_counter() - start)
+		print(f"Autotune: {processes} processes x {threads} threads: {rate:.1f} images/sec")
+		if rate > best_rate:
+			if best:
+				best.shutdown()
+			best, best_rate = workers, rate
+		else:
+			workers.shutdown()
+	print(f"Using {best.processes} processes x {best.threads_per_worker} threads")
+	return best
+
+
+def create_workers(model_dir, processes=None, threads_per_worker=None, samples=None, urls=False):
+	"""
+	Load the model for prediction. With no processes the model is fetched from the model registry and shared by
+	a thread pool, otherwise it is loaded in that many worker processes. Use processes='auto' to pick the
+	split from a warm-up benchmark over the given samples.
+	"""
+	if processes == 'auto':
+		if samples:
+			return autotune(model_dir, samples=samples, urls=urls)
+		processes = None
+	if processes:
+		return ProcessWorkers(model_dir, processes=int(processes), threads_per_worker=threads_per_worker)
+	return ThreadWorkers(get_models(model_dir))
+
+
+def processes_arg(value):
+	# argparse type for --processes: a number of worker processes or 'auto'
+	return value if value == 'auto' else int(value)
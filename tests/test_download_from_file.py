@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+from dataset.utils import local_path, normalize_url
+
+BAD_PORT = 'http://example.com:99999/a.jpg'
+BAD_IPV6 = 'http://[bad/a.jpg'
+
+
+class MalformedUrlTest(unittest.TestCase):
+
+	def test_helpers_return_none(self):
+		for url in (BAD_PORT, BAD_IPV6):
+			self.assertIsNone(local_path(url))
+			self.assertIsNone(normalize_url(url))
+
+	def test_bad_port_row_is_an_error_row(self):
+		# one malformed url fails its own row instead of the whole job
+		from dataset.download_from_file import create_dataset
+		from PIL import Image
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			image = os.path.join(tmp_dir, 'good.png')
+			Image.new('RGB', (8, 8)).save(image)
+			url_file = os.path.join(tmp_dir, 'urls.txt')
+			with open(url_file, 'w') as f:
+				f.write(f"{BAD_PORT}\n{BAD_IPV6}\n{image}\n")
+			create_dataset(url_file, destination_directory=tmp_dir)
+			self.assertEqual(os.listdir(os.path.join(tmp_dir, 'urls')), ['good.png'])
+			with open(os.path.join(tmp_dir, 'urls_errors.csv')) as f:
+				errors = f.read()
+			self.assertIn(BAD_PORT, errors)
+			self.assertIn(BAD_IPV6, errors)
+
+
+if __name__ == '__main__':
+	unittest.main()